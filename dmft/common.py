@@ -11,7 +11,9 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 from numpy.fft import fft, ifft
+from numpy.polynomial.legendre import legval
 from scipy.linalg import lstsq
+from scipy.special import spherical_jn
 
 
 def matsubara_freq(beta=16., size=256, fer=1):
@@ -239,6 +241,67 @@ def gw_invfouriertrans(g_iwn, tau, w_n, tail_coef=(1., 0., 0.)):
     return (g_tau * 2 / beta).real + time_tail
 
 
+def legendre_gtau(g_l, tau, beta):
+    r"""Evaluates the imaginary time Green function from its Legendre
+    coefficients [legendre]_
+
+    .. math:: G(\tau) = \sum_l \frac{\sqrt{2l+1}}{\beta}
+        P_l(x(\tau)) G_l \quad x(\tau) = \frac{2\tau}{\beta} - 1
+
+    Parameters
+    ----------
+    g_l : real float array
+            Legendre coefficients along the last axis
+    tau : real float array
+            Imaginary time points
+    beta : float
+            Inverse temperature
+
+    Returns
+    -------
+    real ndarray
+            Green function with the times along the last axis
+
+    References
+    ----------
+    .. [legendre] Boehnke, L. et al. Phys. Rev. B 84, 075145 (2011)
+    """
+    norm = np.sqrt(2 * np.arange(g_l.shape[-1]) + 1) / beta
+    return legval(2 * np.asarray(tau) / beta - 1,
+                  np.moveaxis(g_l * norm, -1, 0))
+
+
+def legendre_giw(g_l, w_n, beta):
+    r"""Transforms analytically the Legendre coefficients of the Green
+    function into fermionic Matsubara frequencies [legendre]_
+
+    .. math:: G(i\omega_n) = \sum_l T_{nl} G_l \quad
+        T_{nl} = (-1)^n i^{l+1} \sqrt{2l+1} j_l\left(\frac{\omega_n\beta}{2}
+        \right)
+
+    where :math:`j_l` are the spherical Bessel functions.
+
+    Parameters
+    ----------
+    g_l : real float array
+            Legendre coefficients along the last axis
+    w_n : real float array
+            fermionic matsubara frequencies. Only use the positive ones
+    beta : float
+            Inverse temperature
+
+    Returns
+    -------
+    complex ndarray
+            Green function with the frequencies along the last axis
+    """
+    l = np.arange(g_l.shape[-1])
+    n = np.rint((w_n * beta / np.pi - 1) / 2).reshape(-1, 1)
+    t_nl = (-1)**n * 1j**(l + 1) * np.sqrt(2 * l + 1) * \
+        spherical_jn(l, w_n.reshape(-1, 1) * beta / 2)
+    return np.dot(g_l, t_nl.T)
+
+
 def tail(w_n, coef, powers):
     return np.sum([c / w_n**p for c, p in zip(coef, powers)], 0)
 
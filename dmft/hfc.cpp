@@ -19,54 +19,480 @@
 
 #include "hfc.h"
 
-void cgnew(size_t N, double *g, double dv, size_t k){
-    double ee, a;
+/* Random numbers
+ *
+ * xoshiro256** by D. Blackman and S. Vigna http://prng.di.unimi.it
+ * The state is seeded with splitmix64. Independent streams are obtained
+ * jumping ahead the sequence: every rank starts 2^192 numbers apart and
+ * every stream within a rank 2^128 numbers apart.
+ */
+
+static inline uint64_t rotl(const uint64_t x, int k){
+    return (x << k) | (x >> (64 - k));
+}
+
+void rng_seed(xoshiro256 *rng, uint64_t seed){
+    uint64_t z;
+    for(int i=0; i<4; i++){
+        z = (seed += 0x9e3779b97f4a7c15);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111eb;
+        rng->s[i] = z ^ (z >> 31);
+    }
+}
+
+uint64_t rng_next(xoshiro256 *rng){
+    uint64_t *s = rng->s;
+    const uint64_t result = rotl(s[1] * 5, 7) * 9;
+    const uint64_t t = s[1] << 17;
+
+    s[2] ^= s[0];
+    s[3] ^= s[1];
+    s[1] ^= s[2];
+    s[0] ^= s[3];
+    s[2] ^= t;
+    s[3] = rotl(s[3], 45);
+
+    return result;
+}
+
+double rng_uniform(xoshiro256 *rng){
+    return (rng_next(rng) >> 11) * (1. / 9007199254740992.);  // 2^-53
+}
+
+static void rng_jump_poly(xoshiro256 *rng, const uint64_t *poly){
+    uint64_t s[4] = {0, 0, 0, 0};
+    for(int i=0; i<4; i++)
+        for(int b=0; b<64; b++){
+            if(poly[i] & UINT64_C(1) << b)
+                for(int w=0; w<4; w++)
+                    s[w] ^= rng->s[w];
+            rng_next(rng);
+        }
+    std::copy (s, s + 4, rng->s);
+}
+
+void rng_jump(xoshiro256 *rng){
+    static const uint64_t JUMP[] = {0x180ec6d33cfd0aba, 0xd5a61266f0c9392c,
+                                    0xa9582618e03fc9aa, 0x39abdc4529b1661c};
+    rng_jump_poly(rng, JUMP);
+}
 
-    ee = exp(dv)-1.;
-    a = ee/(1. + (1.-g[k*N + k])*ee);
+void rng_long_jump(xoshiro256 *rng){
+    static const uint64_t LONG_JUMP[] = {0x76e15d3efefdcbbf, 0xc5004e441c522fb3,
+                                         0x77710069854ee241, 0x39109bb02acbe635};
+    rng_jump_poly(rng, LONG_JUMP);
+}
+
+void rng_stream(xoshiro256 *rng, uint64_t seed, size_t rank, size_t stream){
+    rng_seed(rng, seed);
+    for(size_t i=0; i<rank; i++)
+        rng_long_jump(rng);
+    for(size_t i=0; i<stream; i++)
+        rng_jump(rng);
+}
+
+/* The update functions receive a preallocated workspace, cgnew needs 2N
+ * doubles and cg2flip 4N+4 doubles and a pivot array of size 2. The
+ * versions without workspace allocate it on each call. The _ee versions
+ * take the flip factor ee = exp(dv) - 1 instead of dv, such that the
+ * sweeps can look it up from a table.
+ */
 
-    std::vector<double> x(N);
-    std::copy (g + k*N, g + (k+1)*N, x.begin());//column fortran
+void cgnew_ee(size_t N, double *g, double ee, size_t k, double *work){
+    double a = ee/(1. + (1.-g[k*N + k])*ee);
+
+    double *x = work;
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
     x[k] -= 1;
 
-    std::vector<double> y(N);
+    double *y = work + N;
 
     for(unsigned int i=0; i<N; i++)
         y[i] = g[i*N + k];//row fortran
 
-    cblas_dger (CblasColMajor, N, N, a, &x[0], 1, &y[0], 1, &g[0], N);
+    cblas_dger (CblasColMajor, N, N, a, x, 1, y, 1, &g[0], N);
+}
+
+void cgnew(size_t N, double *g, double dv, size_t k, double *work){
+    cgnew_ee(N, g, exp(dv)-1., k, work);
+}
+
+void cgnew(size_t N, double *g, double dv, size_t k){
+    std::vector<double> work(2*N);
+    cgnew(N, g, dv, k, &work[0]);
+}
+
+void cg2flip_ee(size_t N, double *g, double *ee, size_t l, size_t k,
+                double *work, int *ipiv){
+  double *U = work;
+  std::copy (g + l*N, g + (l+1)*N, U);//column fortran
+  std::copy (g + k*N, g + (k+1)*N, U + N);//column fortran
+  U[l] -= 1.;
+  U[N+k] -= 1.;
+
+  cblas_dscal(N, ee[0], U, 1);
+  cblas_dscal(N, ee[1], U + N, 1);
+
+  double *V = work + 2*N;
+  for(size_t i=0; i<N; i++){
+      V[i*2] = g[i*N + l];
+      V[i*2+1] = g[i*N + k];
+  }
 
-    x.clear();
-    y.clear();
+  double *mat = work + 4*N;
+  mat[0] = U[l] - 1.;
+  mat[1] = U[k];
+  mat[2] = U[l+N];
+  mat[3] = U[k+N] - 1.;
+  int n = 2;
+  LAPACKE_dgesv(LAPACK_COL_MAJOR, n, N, mat, n, ipiv, V, n);
+  cblas_dgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+	       N, N, n, -1, U, N, V, n, 1., &g[0], N);
+}
 
+void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k,
+             double *work, int *ipiv){
+  double ee[2] = {exp(dv[0])-1., exp(dv[1])-1.};
+  cg2flip_ee(N, g, ee, l, k, work, ipiv);
 }
 
 void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k){
-  std::valarray<double> id2 (0., 4);
-  id2[0] = id2[3] = 1.;
+  std::vector<double> work(4*N + 4);
+  int ipiv[2];
+  cg2flip(N, g, dv, l, k, &work[0], ipiv);
+}
+
+/* Interacting Green function from the Weiss field g0 and the effective
+ * Ising fields v, solving B g = g0 where
+ * B_ij = delta_ij - (exp(v_j) - 1)(g0_ij - delta_ij)
+ * b is an NxN workspace and ipiv holds N integers.
+ */
+int cgnewclean(size_t N, double *g, double *g0, double *v,
+               double *b, int *ipiv){
+    double u;
+    for(size_t j=0; j<N; j++){
+        u = exp(v[j]) - 1.;
+        for(size_t i=0; i<N; i++)
+            b[j*N + i] = -u * g0[j*N + i];
+        b[j*N + j] += 1. + u;
+    }
+    std::copy (g0, g0 + N*N, g);
+    return LAPACKE_dgesv(LAPACK_COL_MAJOR, N, N, b, N, ipiv, g, N);
+}
+
+/* Logarithm of the absolute value of the determinant of the LU factored
+ * matrix lu with pivots ipiv, as left by dgesv or dgetrf. Its sign is
+ * stored in sign.
+ */
+double cglulogdet(size_t N, double *lu, int *ipiv, double *sign){
+    double logdet = 0.;
+    *sign = 1.;
+    for(size_t j=0; j<N; j++){
+        if(lu[j*N + j] < 0.)
+            *sign = -*sign;
+        if(ipiv[j] != (int)j + 1)
+            *sign = -*sign;
+        logdet += log(fabs(lu[j*N + j]));
+    }
+    return logdet;
+}
+
+/* Logarithm of |det B| of the Weiss field g0 and the effective Ising
+ * fields v, B as in cgnewclean. Up to the constant det g0 it is the weight
+ * of the configuration. b is an NxN workspace and ipiv holds N integers.
+ */
+double cglogdet(size_t N, double *g0, double *v, double *b, int *ipiv,
+                double *sign){
+    double u;
+    for(size_t j=0; j<N; j++){
+        u = exp(v[j]) - 1.;
+        for(size_t i=0; i<N; i++)
+            b[j*N + i] = -u * g0[j*N + i];
+        b[j*N + j] += 1. + u;
+    }
+    LAPACKE_dgetrf(LAPACK_COL_MAJOR, N, N, b, N, ipiv);
+    return cglulogdet(N, b, ipiv, sign);
+}
+
+/* Delayed updates
+ *
+ * Accepted flips are not applied right away to g, instead the rank-1
+ * corrections are stored column wise in X (scaled by alpha) and Y such that
+ * the effective Green function is g + X Y^T. Only the entries needed by the
+ * Monte Carlo are computed from this low rank correction and after m flips
+ * the complete update is done with a single dgemm.
+ */
+
+double cgdiag(size_t N, double *g, double *X, double *Y, size_t m, size_t j){
+    double gjj = g[j*N + j];
+    for(size_t p=0; p<m; p++)
+        gjj += X[p*N + j] * Y[p*N + j];
+    return gjj;
+}
+
+void cgnew_delayed_ee(size_t N, double *g, double ee, size_t k,
+                      double *X, double *Y, size_t m){
+    double a = ee/(1. + (1.-cgdiag(N, g, X, Y, m, k))*ee);
+
+    double *x = X + m*N;
+    double *y = Y + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    for(size_t i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    if(m > 0){
+        cblas_dgemv(CblasColMajor, CblasNoTrans, N, m, 1., X, N, Y + k, N,
+                    1., x, 1);
+        cblas_dgemv(CblasColMajor, CblasNoTrans, N, m, 1., Y, N, X + k, N,
+                    1., y, 1);
+    }
+    x[k] -= 1;
+    cblas_dscal(N, a, x, 1);
+}
+
+void cgnew_delayed(size_t N, double *g, double dv, size_t k,
+                   double *X, double *Y, size_t m){
+    cgnew_delayed_ee(N, g, exp(dv)-1., k, X, Y, m);
+}
+
+void cgflush(size_t N, double *g, double *X, double *Y, size_t m){
+    if(m > 0)
+        cblas_dgemm(CblasColMajor, CblasNoTrans, CblasTrans,
+                    N, N, m, 1., X, N, Y, N, 1., g, N);
+}
+
+/* Single precision Green functions
+ *
+ * The same fast updates for float32 Green functions, they halve the memory
+ * traffic of the sweeps. The flip factors are given in double precision,
+ * the clean updates are always done in double precision.
+ */
+
+void cgnew_ee(size_t N, float *g, double ee, size_t k, float *work){
+    float a = ee/(1. + (1.-g[k*N + k])*ee);
+
+    float *x = work;
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    x[k] -= 1;
+
+    float *y = work + N;
+
+    for(size_t i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    cblas_sger (CblasColMajor, N, N, a, x, 1, y, 1, &g[0], N);
+}
 
-  std::valarray<double> U (2*N);
-  std::copy (g + l*N, g + (l+1)*N, std::begin(U));//column fortran
-  std::copy (g + k*N, g + (k+1)*N, std::begin(U) + N);//column fortran
+void cg2flip_ee(size_t N, float *g, double *ee, size_t l, size_t k,
+                float *work, int *ipiv){
+  float *U = work;
+  std::copy (g + l*N, g + (l+1)*N, U);//column fortran
+  std::copy (g + k*N, g + (k+1)*N, U + N);//column fortran
   U[l] -= 1.;
   U[N+k] -= 1.;
 
-  U[std::slice(0, N, 1)] *= std::valarray<double>(exp(dv[0])-1., N);
-  U[std::slice(N, N, 1)] *= std::valarray<double>(exp(dv[1])-1., N);
+  cblas_sscal(N, ee[0], U, 1);
+  cblas_sscal(N, ee[1], U + N, 1);
 
-  std::valarray<double> V (2*N);
+  float *V = work + 2*N;
   for(size_t i=0; i<N; i++){
       V[i*2] = g[i*N + l];
       V[i*2+1] = g[i*N + k];
   }
 
-  size_t sel[] = {l, k, l+N, k+N};
-  std::valarray<size_t> myselection (sel,4);
-  std::valarray<double> mat (U[myselection]);
-  mat -= id2;
-  int n = 2, info;
-  std::valarray<int> ipiv(n);
-  info = LAPACKE_dgesv(LAPACK_COL_MAJOR, n, N, &mat[0], n, &ipiv[0], &V[0], n);
-  cblas_dgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
-	       N, N, n, -1, &U[0], N, &V[0], n, 1., &g[0], N);
+  float *mat = work + 4*N;
+  mat[0] = U[l] - 1.;
+  mat[1] = U[k];
+  mat[2] = U[l+N];
+  mat[3] = U[k+N] - 1.;
+  int n = 2;
+  LAPACKE_sgesv(LAPACK_COL_MAJOR, n, N, mat, n, ipiv, V, n);
+  cblas_sgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+	       N, N, n, -1, U, N, V, n, 1., &g[0], N);
+}
+
+float cgdiag(size_t N, float *g, float *X, float *Y, size_t m, size_t j){
+    float gjj = g[j*N + j];
+    for(size_t p=0; p<m; p++)
+        gjj += X[p*N + j] * Y[p*N + j];
+    return gjj;
+}
+
+void cgnew_delayed_ee(size_t N, float *g, double ee, size_t k,
+                      float *X, float *Y, size_t m){
+    float a = ee/(1. + (1.-cgdiag(N, g, X, Y, m, k))*ee);
+
+    float *x = X + m*N;
+    float *y = Y + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    for(size_t i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    if(m > 0){
+        cblas_sgemv(CblasColMajor, CblasNoTrans, N, m, 1., X, N, Y + k, N,
+                    1., x, 1);
+        cblas_sgemv(CblasColMajor, CblasNoTrans, N, m, 1., Y, N, X + k, N,
+                    1., y, 1);
+    }
+    x[k] -= 1;
+    cblas_sscal(N, a, x, 1);
+}
+
+void cgflush(size_t N, float *g, float *X, float *Y, size_t m){
+    if(m > 0)
+        cblas_sgemm(CblasColMajor, CblasNoTrans, CblasTrans,
+                    N, N, m, 1., X, N, Y, N, 1., g, N);
+}
+
+/* Complex Green functions
+ *
+ * The same updates for complex128 Green functions, as they appear with
+ * complex hybridizations. The Ising fields and thus the flip factors are
+ * real. The low rank corrections are transposes, not adjoints.
+ */
+
+void cgnew_ee(size_t N, zdouble *g, double ee, size_t k, zdouble *work){
+    zdouble a = ee/(1. + (1.-g[k*N + k])*ee);
+
+    zdouble *x = work;
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    x[k] -= 1;
+
+    zdouble *y = work + N;
+    for(size_t i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    cblas_zgeru(CblasColMajor, N, N, &a, x, 1, y, 1, g, N);
+}
+
+void cgnew(size_t N, zdouble *g, double dv, size_t k, zdouble *work){
+    cgnew_ee(N, g, exp(dv)-1., k, work);
+}
+
+void cgnew(size_t N, zdouble *g, double dv, size_t k){
+    std::vector<zdouble> work(2*N);
+    cgnew(N, g, dv, k, &work[0]);
+}
+
+void cg2flip_ee(size_t N, zdouble *g, double *ee, size_t l, size_t k,
+                zdouble *work, int *ipiv){
+  zdouble *U = work;
+  std::copy (g + l*N, g + (l+1)*N, U);//column fortran
+  std::copy (g + k*N, g + (k+1)*N, U + N);//column fortran
+  U[l] -= 1.;
+  U[N+k] -= 1.;
+
+  cblas_zdscal(N, ee[0], U, 1);
+  cblas_zdscal(N, ee[1], U + N, 1);
+
+  zdouble *V = work + 2*N;
+  for(size_t i=0; i<N; i++){
+      V[i*2] = g[i*N + l];
+      V[i*2+1] = g[i*N + k];
+  }
+
+  zdouble *mat = work + 4*N;
+  mat[0] = U[l] - 1.;
+  mat[1] = U[k];
+  mat[2] = U[l+N];
+  mat[3] = U[k+N] - 1.;
+  int n = 2;
+  zdouble alpha = -1., beta = 1.;
+  LAPACKE_zgesv(LAPACK_COL_MAJOR, n, N, mat, n, ipiv, V, n);
+  cblas_zgemm (CblasColMajor, CblasNoTrans, CblasNoTrans,
+	       N, N, n, &alpha, U, N, V, n, &beta, g, N);
+}
+
+void cg2flip(size_t N, zdouble *g, double *dv, size_t l, size_t k,
+             zdouble *work, int *ipiv){
+  double ee[2] = {exp(dv[0])-1., exp(dv[1])-1.};
+  cg2flip_ee(N, g, ee, l, k, work, ipiv);
+}
+
+void cg2flip(size_t N, zdouble *g, double *dv, size_t l, size_t k){
+  std::vector<zdouble> work(4*N + 4);
+  int ipiv[2];
+  cg2flip(N, g, dv, l, k, &work[0], ipiv);
+}
+
+int cgnewclean(size_t N, zdouble *g, zdouble *g0, double *v,
+               zdouble *b, int *ipiv){
+    double u;
+    for(size_t j=0; j<N; j++){
+        u = exp(v[j]) - 1.;
+        for(size_t i=0; i<N; i++)
+            b[j*N + i] = -u * g0[j*N + i];
+        b[j*N + j] += 1. + u;
+    }
+    std::copy (g0, g0 + N*N, g);
+    return LAPACKE_zgesv(LAPACK_COL_MAJOR, N, N, b, N, ipiv, g, N);
+}
+
+/* As the real cglulogdet, with the phase of the determinant stored in
+ * phase instead of its sign.
+ */
+double cglulogdet(size_t N, zdouble *lu, int *ipiv, zdouble *phase){
+    double logdet = 0., modulus;
+    *phase = 1.;
+    for(size_t j=0; j<N; j++){
+        modulus = std::abs(lu[j*N + j]);
+        *phase *= lu[j*N + j] / modulus;
+        if(ipiv[j] != (int)j + 1)
+            *phase = -*phase;
+        logdet += log(modulus);
+    }
+    return logdet;
+}
+
+double cglogdet(size_t N, zdouble *g0, double *v, zdouble *b, int *ipiv,
+                zdouble *phase){
+    double u;
+    for(size_t j=0; j<N; j++){
+        u = exp(v[j]) - 1.;
+        for(size_t i=0; i<N; i++)
+            b[j*N + i] = -u * g0[j*N + i];
+        b[j*N + j] += 1. + u;
+    }
+    LAPACKE_zgetrf(LAPACK_COL_MAJOR, N, N, b, N, ipiv);
+    return cglulogdet(N, b, ipiv, phase);
+}
+
+zdouble cgdiag(size_t N, zdouble *g, zdouble *X, zdouble *Y, size_t m,
+               size_t j){
+    zdouble gjj = g[j*N + j];
+    for(size_t p=0; p<m; p++)
+        gjj += X[p*N + j] * Y[p*N + j];
+    return gjj;
+}
+
+void cgnew_delayed_ee(size_t N, zdouble *g, double ee, size_t k,
+                      zdouble *X, zdouble *Y, size_t m){
+    zdouble a = ee/(1. + (1.-cgdiag(N, g, X, Y, m, k))*ee);
+    zdouble one = 1.;
+
+    zdouble *x = X + m*N;
+    zdouble *y = Y + m*N;
+
+    std::copy (g + k*N, g + (k+1)*N, x);//column fortran
+    for(size_t i=0; i<N; i++)
+        y[i] = g[i*N + k];//row fortran
+
+    if(m > 0){
+        cblas_zgemv(CblasColMajor, CblasNoTrans, N, m, &one, X, N, Y + k, N,
+                    &one, x, 1);
+        cblas_zgemv(CblasColMajor, CblasNoTrans, N, m, &one, Y, N, X + k, N,
+                    &one, y, 1);
+    }
+    x[k] -= 1;
+    cblas_zscal(N, &a, x, 1);
+}
+
+void cgflush(size_t N, zdouble *g, zdouble *X, zdouble *Y, size_t m){
+    zdouble one = 1.;
+    if(m > 0)
+        cblas_zgemm(CblasColMajor, CblasNoTrans, CblasTrans,
+                    N, N, m, &one, X, N, Y, N, &one, g, N);
 }
@@ -21,16 +21,85 @@
 #define HFC_H
 
 #include <cstdlib>
+#include <cstdint>
 #include <vector>
 #include <valarray>
 #include <iostream>
 #include <cmath>
+#include <complex>
 
+/* The LAPACKE headers take the complex types as given, otherwise they
+ * fall back to the C99 _Complex types that std::complex does not convert
+ * to */
+#define lapack_complex_float std::complex<float>
+#define lapack_complex_double std::complex<double>
 #include <cblas.h>
 #include <lapacke.h>
 
+typedef std::complex<double> zdouble;
+
+
+/* xoshiro256** random number generator with jump ahead streams */
+typedef struct {
+    uint64_t s[4];
+} xoshiro256;
+
+void rng_seed(xoshiro256 *rng, uint64_t seed);
+void rng_stream(xoshiro256 *rng, uint64_t seed, size_t rank, size_t stream);
+uint64_t rng_next(xoshiro256 *rng);
+double rng_uniform(xoshiro256 *rng);
+void rng_jump(xoshiro256 *rng);
+void rng_long_jump(xoshiro256 *rng);
 
 void cgnew(size_t N, double *g, double dv, size_t k);
+void cgnew(size_t N, double *g, double dv, size_t k, double *work);
+void cgnew_ee(size_t N, double *g, double ee, size_t k, double *work);
 void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k);
+void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k,
+             double *work, int *ipiv);
+void cg2flip_ee(size_t N, double *g, double *ee, size_t l, size_t k,
+                double *work, int *ipiv);
+int cgnewclean(size_t N, double *g, double *g0, double *v,
+               double *b, int *ipiv);
+double cglulogdet(size_t N, double *lu, int *ipiv, double *sign);
+double cglogdet(size_t N, double *g0, double *v, double *b, int *ipiv,
+                double *sign);
+
+double cgdiag(size_t N, double *g, double *X, double *Y, size_t m, size_t j);
+void cgnew_delayed(size_t N, double *g, double dv, size_t k,
+                   double *X, double *Y, size_t m);
+void cgnew_delayed_ee(size_t N, double *g, double ee, size_t k,
+                      double *X, double *Y, size_t m);
+void cgflush(size_t N, double *g, double *X, double *Y, size_t m);
+
+/* float32 Green functions for the sweeps, the flip factors remain double */
+void cgnew_ee(size_t N, float *g, double ee, size_t k, float *work);
+void cg2flip_ee(size_t N, float *g, double *ee, size_t l, size_t k,
+                float *work, int *ipiv);
+float cgdiag(size_t N, float *g, float *X, float *Y, size_t m, size_t j);
+void cgnew_delayed_ee(size_t N, float *g, double ee, size_t k,
+                      float *X, float *Y, size_t m);
+void cgflush(size_t N, float *g, float *X, float *Y, size_t m);
+
+/* complex128 Green functions, the Ising fields remain real */
+void cgnew(size_t N, zdouble *g, double dv, size_t k);
+void cgnew(size_t N, zdouble *g, double dv, size_t k, zdouble *work);
+void cgnew_ee(size_t N, zdouble *g, double ee, size_t k, zdouble *work);
+void cg2flip(size_t N, zdouble *g, double *dv, size_t l, size_t k);
+void cg2flip(size_t N, zdouble *g, double *dv, size_t l, size_t k,
+             zdouble *work, int *ipiv);
+void cg2flip_ee(size_t N, zdouble *g, double *ee, size_t l, size_t k,
+                zdouble *work, int *ipiv);
+int cgnewclean(size_t N, zdouble *g, zdouble *g0, double *v,
+               zdouble *b, int *ipiv);
+double cglulogdet(size_t N, zdouble *lu, int *ipiv, zdouble *phase);
+double cglogdet(size_t N, zdouble *g0, double *v, zdouble *b, int *ipiv,
+                zdouble *phase);
+
+zdouble cgdiag(size_t N, zdouble *g, zdouble *X, zdouble *Y, size_t m,
+               size_t j);
+void cgnew_delayed_ee(size_t N, zdouble *g, double ee, size_t k,
+                      zdouble *X, zdouble *Y, size_t m);
+void cgflush(size_t N, zdouble *g, zdouble *X, zdouble *Y, size_t m);
 
 #endif // HFC_H
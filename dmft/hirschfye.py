@@ -5,27 +5,111 @@ QMC Hirsch - Fye Impurity solver
 
 To treat the Anderson impurity model and solve it using the Hirsch - Fye
 Quantum Monte Carlo algorithm
+
+Solver options
+--------------
+
+Besides the model and the sweeps, the parameters of :func:`imp_solver`
+switch on the following features of the run.
+
+With ``checkpoint`` the walkers are stored in the work directory at the
+end of the run. Setting ``restart_dir`` to a checkpointed directory
+starts the chains from the stored Ising fields and random number
+states. Then only ``rethermalize`` sweeps are spent in thermalization,
+which is enough when the Weiss field changed slightly, and with
+``restart_accumulators`` the measurements continue from the stored
+ones, for a resumed run of the same Weiss field.
+
+The improved estimator :math:`F(\\tau)` of the self-energy, see
+:func:`improved_sigma`, is written to ``ftau.npy`` in the work
+directory with the conventional sign and the layout of the returned
+Green functions.
+
+The local spin and charge susceptibilities in imaginary time and
+bosonic Matsubara frequencies are written to the work directory next
+to the occupations, see :func:`local_susceptibility`.
+
+The Green functions are recalculated from scratch every ``clean_every``
+sweeps at the start. When ``clean_tol`` is set the interval then adapts
+to keep the numerical drift of the fast updates below this tolerance,
+up to ``clean_max`` sweeps. The drift statistics of every chain are
+stored in the work directory, see :func:`clean_interval`.
+
+With ``single_precision`` the walkers sweep on float32 Green functions,
+see :class:`dmft.hffast.HFWalker`, for about twice the sweeps per
+second on large systems. The clean updates remain in double precision
+and the tolerance of the drift is raised to at least ``1e-4``, the
+rounding of float32 alone drifts by some ``1e-6`` per sweep.
+
+Complex Weiss fields, as of complex hybridizations, are solved on
+complex Green functions and give a complex :math:`G(\\tau)`. They can
+not be run in single precision nor record their weights.
+
+The chains sample the modulus of the weights. Every measurement is
+weighted by the phase of its configuration, the sign for real Weiss
+fields, and the expectation values are divided by the average sign, the
+average real part of the phases, which is saved as ``average_sign.npy``.
+When it is small against one the sign problem makes the results noisy.
+
+Every chain bins its measurements of :math:`G(\\tau)`, the
+occupations and double occupations logarithmically. Their standard
+errors, integrated autocorrelation times and jackknife bins are saved
+once per run, see :func:`save_errors`.
+
+With ``legendre`` set to a number of coefficients every measurement of
+:math:`G(\\tau)` is also projected onto the Legendre basis, and the
+binned coefficients are saved in ``legendre.npz``, see
+:func:`legendre_projector` and :func:`save_legendre`.
+
+With ``vertex`` set to the numbers of positive fermionic and of
+bosonic frequencies, every ``vertex_every`` measurements the two
+particle Green function of the frequency box is accumulated from the
+Green functions of the configuration by Wick's theorem. The sums of
+all ranks are reduced and written with the generalized susceptibility
+to ``vertex.h5``, see :func:`wick_vertex` and :func:`save_vertex`.
+
+With ``autotune`` set to a number of measurements, every chain tries
+in the middle of its thermalization several update settings for that
+many measurements each, and keeps for the rest of the run the one of
+most independent measurements per second. The settings of every chain
+and its trials are written to ``autotune.json``, see
+:func:`autotune`.
+
+With ``save_logs`` every chain streams its Ising fields and acceptance
+every ``log_every`` measurements to its own file in the work
+directory, see :class:`IsingLog` and :func:`load_ising_log`. With
+``save_weights`` the records also hold the weight of the configuration,
+such that :func:`reweight` moves the measurements to nearby
+interactions and chemical potentials.
 """
 
 from __future__ import division, absolute_import, print_function
 import argparse
+import json
 import os
 import struct
 import time
+from collections import namedtuple
+from glob import glob
 from itertools import combinations, product
 from math import exp
+from multiprocessing.pool import ThreadPool
 
 from mpi4py import MPI
+from scipy.interpolate import interp1d
 from scipy.linalg.blas import dger, zgeru
 import scipy.linalg as la
-import numba
 import numpy as np
+from h5py import File
+from numpy.polynomial.legendre import leggauss, legvander
 
-from dmft.common import tau_wn_setup, gw_invfouriertrans, greenF
+from dmft.common import tau_wn_setup, gw_invfouriertrans, gt_fouriertrans, \
+    greenF
+from dmft.mcstats import LogBinning, reduce_binnings, jackknife
 import dmft.hffast as hffast
 
 
-def ising_v(dtau, U, L, fields=1, polar=0.5):
+def ising_v(dtau, U, L, fields=1, polar=0.5, rng=None):
     """initialize the vector V of Ising fields
     .. math:: V = \\lambda (\\sigma_1, \\sigma_2, \\cdots, \\sigma_L)
     where the vector entries :math:`\\sigma_n=\\pm 1` are randomized subject
@@ -44,180 +128,1771 @@ def ising_v(dtau, U, L, fields=1, polar=0.5):
         Number of auxliary ising fields
     polar : float :math:`\\in (0, 1)`
         polarization threshold, probability of :math:`\\sigma_n=+ 1`
+    rng : :class:`numpy.random.RandomState`
+        Random number generator, defaults to the global NumPy generator
 
     Returns
     -------
     out : single dimension ndarray
     """
     lam = np.arccosh(np.exp(dtau * U / 2))
+    rng = np.random if rng is None else rng
     vis = np.ones((fields, L))
-    rand = np.random.rand(fields, L)
+    rand = rng.rand(fields, L)
     vis[rand > polar] = -1
     return vis * lam
 
 
-def imp_solver(g0_blocks, v, interaction, parms_user):
+def imp_solver(g0_blocks, v, interaction, parms_user, comm=None,
+               replicas=None):
     r"""Impurity solver call. Calcutaltes the interacting Green function
     as given by the contribution of the auxiliary discretized spin field.
+
+    Every MPI rank runs ``walkers_per_rank`` independent Markov chains on a
+    pool of threads. The first walker works in place on the Ising fields
+    v, the others start from a copy of it. For best performance keep the
+    BLAS library single threaded when running many walkers.
+
+    All chains draw their random numbers from non overlapping streams of
+    the single seed ``SEED``, broadcasted from the first rank. The run is
+    reproducible for the same seed, number of ranks and walkers.
+
+    The options of ``parms_user`` for restarts, clean updates, precision,
+    error analysis, extra measurements, tuning and logs are described in
+    the module documentation, see :mod:`dmft.hirschfye`.
+
+    The solver runs on all processes of ``comm``, by default
+    ``MPI.COMM_WORLD``. With the communicator ``replicas`` its chains
+    exchange configurations every ``swap_every`` sweeps with the chains of
+    the neighboring ranks of it, that solve the neighboring interactions,
+    see :func:`tempering_solver`.
     """
 
-    comm = MPI.COMM_WORLD
+    comm = MPI.COMM_WORLD if comm is None else comm
     # Set up default values
     parms = {'global_flip': False,
-             'binned_meas': False,
              'double_flip_prob': 0.,
              't':           0.5,
              'SITES':       1,
              'BANDS':       1,
              'SEED':        struct.unpack("I", os.urandom(4))[0],
              'Heat_bath':   True,
+             'delay':       1,
+             'walkers_per_rank': 1,
+             'checkpoint':  False,
+             'restart_dir': None,
+             'restart_accumulators': False,
+             'rethermalize': None,
+             'clean_every': 500,
+             'clean_tol':   1e-8,
+             'single_precision': False,
+             'clean_max':   5000,
+             'log_every':   1,
+             'save_weights': False,
+             'legendre':    0,
+             'vertex':      None,
+             'vertex_every': 1,
+             'autotune':    0,
+             'swap_every':  10,
              'ofile':       'hf_out.h5',
              'group':       'temp/' + time.asctime(),
              }
     parms.update(parms_user)
+    parms['SEED'] = comm.bcast(parms['SEED'], root=0)
     if not os.path.exists(parms_user['work_dir']) and comm.rank == 0:
         os.makedirs(parms_user['work_dir'])
+    comm.Barrier()
+    if replicas is not None and parms['walkers_per_rank'] > 1:
+        raise ValueError('Replica exchange runs one walker per rank')
 
     # Retarded field includes the Hirsh-Fye minus sign in GF
     GX = [retarded_weiss(gb) for gb in g0_blocks]
-    kroneker = np.eye(GX[0].shape[0])  # assuming all blocks are of same shape
-    Gst = [np.zeros_like(gx) for gx in GX]
-    Gbin = [np.zeros_like(gx) for gx in GX]
-
-    i_pairs = np.array([c.nonzero() for c in interaction.T]).reshape(-1, 2)
-
-    vlog = []
-    ar = []
-
-    acc, anrat = 0, 0
-    flavor_pairs = list(combinations(
-        product(range(2), range(parms['SITES'])), 2))
-    double_occ = np.zeros(len(flavor_pairs))
-
-    flavors = 2 * parms['BANDS'] * parms['SITES']
-    flavors_ind = list(product(range(2), range(parms['SITES'])))
-    occupation = np.zeros(flavors)
-    double_occ = np.zeros(len(flavor_pairs))
+    if parms['save_weights'] and np.iscomplexobj(GX):
+        raise ValueError('The Ising log records the sign of the weights, '
+                         'not the phase of complex Weiss fields')
     ntau = 2 * parms['N_MATSUBARA']
-    chi = np.zeros(ntau)
-    hffast.set_seed(parms['SEED'])
-
-    update = False
-    for mcs in range(parms['sweeps'] + parms['therm']):
-        if mcs % parms['therm'] == 0 and parms['global_flip']:
-            v *= -1
-            update = True
-        if mcs % 500 == 0 or update:  # dirty update clean up
-            int_v = np.dot(interaction, v)
-            g = [gnewclean(g_sp, lv, kroneker) for g_sp, lv in zip(GX, int_v)]
-            update = False
-
-        for _ in range(parms['meas']):
-            for i, (up, dw) in enumerate(i_pairs):
-                acr, nrat = hffast.updateDHS(g[up], g[dw], v[i], ntau,
-                                             parms['double_flip_prob'],
-                                             ['Heat_bath'])
-                acc += acr
-                anrat += nrat
-
-        if mcs > parms['therm']:
-            for i in range(interaction.shape[0]):
-                Gbin[i] += g[i]
-                Gst[i] += g[i]
-            if mcs % parms['therm'] == 0 and parms['binned_meas']:
-                Gbin = np.array(Gbin) / parms['therm']
-                np.save(parms['work_dir'] + '/gtau_bin_mcs{}_r{}'.format(mcs,
-                                                                         comm.rank),
-                        np.squeeze([-1 * avg_g(gst, parms) for gst in Gbin]))
-                Gbin = [np.zeros_like(gx) for gx in GX]
-
-            orbital_occupation(g, occupation, ntau, flavors_ind)
-            double_occupation(g, double_occ, ntau, flavor_pairs)
-            if parms['save_logs']:
-                vlog.append(v > 0)
-                ar.append(acr)
-
-    tGst = np.asarray(Gst)
+    nwalkers = parms['walkers_per_rank']
+    walkers = [hffast.HFWalker(GX, v if w == 0 else np.copy(v), interaction,
+                               ntau, parms['SEED'],
+                               parms['double_flip_prob'], parms['Heat_bath'],
+                               parms['delay'], comm.rank, w,
+                               parms['single_precision'])
+               for w in range(nwalkers)]
+
+    therm = parms['therm']
+    if parms['restart_dir'] is not None and \
+            load_checkpoint(parms['restart_dir'], walkers, comm.rank,
+                            parms['restart_accumulators']):
+        if parms['rethermalize'] is not None:
+            therm = parms['rethermalize']
+
+    if nwalkers > 1:
+        pool = ThreadPool(nwalkers)
+        chains = pool.map(lambda w: markov_chain(walkers[w], parms,
+                                                 comm.rank * nwalkers + w,
+                                                 therm),
+                          range(nwalkers))
+        pool.close()
+    else:
+        chains = [markov_chain(walkers[0], parms, comm.rank, therm,
+                               replicas)]
+
+    if parms['checkpoint']:
+        save_checkpoint(parms['work_dir'], walkers, comm.rank)
+
+    acc = sum(chain.acceptance for chain in chains) / nwalkers
+    anrat = sum(chain.negative_ratios for chain in chains)
+    logs = comm.gather([chain.log for chain in chains], root=0)
+    drift = comm.gather([chain.stability for chain in chains], root=0)
+    binnings = comm.gather([chain.binning for chain in chains], root=0)
+    swaps = comm.reduce(np.sum([chain.swaps for chain in chains], axis=0),
+                        root=0)
+    legendre = comm.gather([chain.legendre for chain in chains], root=0)
+    if parms['vertex']:
+        vertex = [np.sum([chain.vertex[k] for chain in chains], axis=0)
+                  for k in range(2)]
+        for local in vertex:
+            comm.Reduce(local.copy(), local, root=0)
+        vertex_meas = comm.reduce(sum(chain.vertex[2] for chain in chains),
+                                  root=0)
+        vertex_sign = comm.reduce(sum(chain.vertex[3] for chain in chains),
+                                  root=0)
+
+    # Reduce all walkers of the rank into the shared accumulators
+    tGst = np.sum([walker.gtau for walker in walkers], axis=0)
+    density_corr = np.sum([walker.density_corr for walker in walkers], axis=0)
+    exchange = np.sum([walker.exchange for walker in walkers], axis=0)
+    occupation = np.sum([walker.occupation for walker in walkers], axis=0)
+    double_occ = np.sum([walker.double_occ for walker in walkers], axis=0)
+
+    # the measurements are weighted by the sign, normalize by its sum
+    nmeas = sum(walker.nmeas for walker in walkers)
+    sign_sum = sum(walker.sign_sum for walker in walkers)
+    total_sign = comm.allreduce(sign_sum)
+    average_sign = total_sign / comm.allreduce(nmeas)
     Gst = np.zeros_like(tGst)
     comm.Allreduce(tGst, Gst)
-    Gst /= parms['sweeps'] * comm.Get_size()
+    # Recover Conventional GF sign in average
+    Gst /= -ntau * total_sign
+    Fst = np.zeros_like(tGst)
+    comm.Allreduce(np.sum([walker.ftau for walker in walkers], axis=0), Fst)
+    Fst *= -parms['U'] / ntau / total_sign
 
-    acc /= v.size * parms['meas'] * (parms['sweeps'] + parms['therm'])
-    occupation /= 2 * parms['N_MATSUBARA'] * parms['sweeps']
-    double_occ /= 2 * parms['N_MATSUBARA'] * parms['sweeps']
+    tunings = comm.gather([chain.tuning for chain in chains], root=0)
 
-    print('occ', occupation)
-    print('docc', double_occ, 'acc ', acc, 'nsign', anrat, 'rank', comm.rank)
+    print('occ', occupation / ntau / sign_sum)
+    print('docc', double_occ / ntau / sign_sum, 'acc ', acc, 'nsign', anrat,
+          'sign', sign_sum / nmeas, 'rank', comm.rank)
 
     comm.Allreduce(occupation.copy(), occupation)
     comm.Allreduce(double_occ.copy(), double_occ)
-    comm.Allreduce(chi.copy(), chi)
+    comm.Allreduce(density_corr.copy(), density_corr)
+    comm.Allreduce(exchange.copy(), exchange)
+    occupation /= ntau * total_sign
+    double_occ /= ntau * total_sign
+    chi = local_susceptibility(density_corr, exchange, occupation,
+                               total_sign, parms['BETA'])
 
     if comm.rank == 0:
-        save_output(parms, occupation / comm.Get_size(),
-                    double_occ / comm.Get_size(), acc, chi, vlog, ar)
+        save_output(parms, occupation, double_occ, acc, chi,
+                    np.concatenate(drift))
+        np.save(parms['work_dir'] + '/ftau', Fst)
+        np.save(parms['work_dir'] + '/average_sign', average_sign)
+        if replicas is not None:
+            np.save(parms['work_dir'] + '/swap_acceptance',
+                    swaps[1] / max(swaps[0], 1))
+        if parms['save_logs']:
+            save_log_index(parms['work_dir'], sum(logs, []), v.shape,
+                           parms['log_every'], parms['save_weights'])
+        stats = reduce_binnings(sum(binnings, []))
+        save_errors(parms['work_dir'], stats,
+                    [walkers[0].gtau.shape, occupation.shape,
+                     double_occ.shape])
+        if parms['legendre']:
+            save_legendre(parms['work_dir'],
+                          reduce_binnings(sum(legendre, [])),
+                          walkers[0].gtau.shape, parms['BETA'],
+                          stats['mean'][-1].real)
+        if parms['vertex']:
+            save_vertex(parms['work_dir'], vertex[0], vertex[1], vertex_meas,
+                        parms['BETA'], vertex_sign / vertex_meas)
+        if parms['autotune']:
+            with open(os.path.join(parms['work_dir'], 'autotune.json'),
+                      'w') as record:
+                json.dump(sum(tunings, []), record, indent=2)
+
+    return list(Gst)
+
+
+def trotter_extrapolation(g0iw_blocks, w_n, interaction, parms_user,
+                          scales=(1., 1.5, 2.), tail_coef=(1., 0., 0.),
+                          comm=None):
+    r"""Runs the impurity solver on several Trotter slicings and extrapolates
+    its results to :math:`\Delta\tau\rightarrow 0`
+
+    The slicing :math:`L_k` has ``scales[k]`` times the ``N_MATSUBARA`` of
+    the parameters. The processes are split in groups that solve the
+    slicings in parallel, each with its own seed and work directory
+    ``L{L_k}`` inside ``work_dir``. With less processes than slicings the
+    groups solve several ones in turn.
+
+    The double occupations, the potential energy and :math:`G(\tau)` on the
+    imaginary times common to all slicings are extrapolated with
+    :func:`richardson`, and stored in ``trotter_extrapolation.npz`` in the
+    work directory.
+
+    Parameters
+    ----------
+    g0iw_blocks : list of ndarrays
+        Weiss fields of every flavor on the positive Matsubara frequencies,
+        their last axis
+    w_n : 1D ndarray
+        Matsubara frequencies of the Weiss fields, beyond them the
+        transforms to the finer slicings only use the tail
+    interaction : 2D ndarray
+        Interaction matrix, see :func:`interaction_matrix`
+    parms_user : dict
+        Simulation parameters as for :func:`imp_solver`
+    scales : tuple
+        Refinement of each slicing
+    tail_coef : list
+        High frequency moments of the Weiss fields, see
+        :func:`dmft.common.gw_invfouriertrans`
+    comm : MPI communicator
+        Processes to split, by default ``MPI.COMM_WORLD``
+
+    Returns
+    -------
+    dict
+        ``dtau`` of each slicing and for ``double_occ``, ``epot`` and
+        ``gtau`` the values of every slicing, the extrapolated values and
+        their errors with the suffix ``_err``. ``tau`` holds the common
+        imaginary times of ``gtau``
+    """
+    world = MPI.COMM_WORLD if comm is None else comm
+    parms = {'SITES': 1, 'spin_polarization': 0.5,
+             'SEED': struct.unpack("I", os.urandom(4))[0]}
+    parms.update(parms_user)
+    seed = world.bcast(parms['SEED'], root=0)
+    n_freqs = [int(round(scale * parms['N_MATSUBARA'])) for scale in scales]
+    groups = min(world.size, len(scales))
+    color = world.rank % groups
+    comm = world.Split(color, world.rank)
+
+    results = []
+    for k in range(color, len(scales), groups):
+        sparms = dict(parms, N_MATSUBARA=n_freqs[k], SEED=seed + k,
+                      work_dir=os.path.join(parms['work_dir'],
+                                            'L{}'.format(2 * n_freqs[k])))
+        tau, _ = tau_wn_setup(sparms)
+        sparms['dtau_mc'] = tau[1]
+        g0tau = [gw_invfouriertrans(g0iw, tau, w_n, tail_coef)
+                 for g0iw in g0iw_blocks]
+        v = ising_v(tau[1], parms['U'], len(tau) * parms['SITES'],
+                    interaction.shape[1], parms['spin_polarization'],
+                    np.random.RandomState(seed + k))
+        imp_solver(g0tau, v, interaction, sparms, comm)
+        if comm.rank == 0:
+            results.append((k, trotter_observables(sparms['work_dir'],
+                                                   parms['U'])))
+    comm.Free()
+    results = [obs for _, obs in
+               sorted(sum(world.allgather(results), []), key=lambda r: r[0])]
+
+    slices = [2 * n_freq for n_freq in n_freqs]
+    common = slices[0]
+    for length in slices[1:]:
+        while length:
+            common, length = length, common % length
+    for obs, length in zip(results, slices):
+        obs['gtau'] = obs['gtau'][..., ::length // common]
+        obs['gtau_err'] = obs['gtau_err'][..., ::length // common]
+
+    output = {'dtau': np.array([parms['BETA'] / length for length in slices]),
+              'tau': np.arange(common) * parms['BETA'] / common}
+    for name in ['double_occ', 'epot', 'gtau']:
+        values = np.array([obs[name] for obs in results])
+        errors = np.array([obs[name + '_err'] for obs in results])
+        output[name + '_slicings'] = values
+        output[name], output[name + '_err'] = richardson(output['dtau'],
+                                                         values, errors)
+
+    if world.rank == 0:
+        np.savez(os.path.join(parms['work_dir'], 'trotter_extrapolation'),
+                 **output)
+    return output
+
+
+def trotter_observables(work_dir, u_int):
+    r"""Double occupations, potential energy and :math:`G(\tau)` of a
+    finished run with their errors
+
+    The double occupations :math:`\langle n_a n_b \rangle` of the
+    different flavors of the same site are recovered from the hole
+    measurements and their errors estimated by the jackknife of the binned
+    measurements stored by :func:`save_errors`. The potential energy per
+    site is :math:`U` times their sum.
+
+    Parameters
+    ----------
+    work_dir : str
+        Work directory of the run
+    u_int : float
+        Local interaction
+
+    Returns
+    -------
+    dict
+        ``double_occ``, ``epot``, ``gtau`` and their errors ``_err``
+    """
+    with np.load(os.path.join(work_dir, 'meas_errors.npz')) as data:
+        stats = {key: data[key] for key in data.files}
+    flavors, sites = stats['gtau'].shape[:2]
+    orbitals = list(product(range(flavors), range(sites)))
+    local = [(k, orbitals.index(a), orbitals.index(b))
+             for k, (a, b) in enumerate(combinations(orbitals, 2))
+             if a[1] == b[1]]
+    nocc = len(orbitals)
+
+    def observables(bins):
+        holes, hole_pairs = bins[:nocc], bins[nocc:]
+        docc = np.array([1 - holes[a] - holes[b] + hole_pairs[k]
+                         for k, a, b in local])
+        return np.concatenate((docc, [u_int * docc.sum() / sites]))
+
+    bins = np.hstack((stats['occupation_bins'], stats['double_occ_bins']))
+    values, errors = jackknife(bins, observables, stats['bin_weights'])
+    return {'double_occ': values[:-1], 'double_occ_err': errors[:-1],
+            'epot': values[-1], 'epot_err': errors[-1],
+            'gtau': stats['gtau'], 'gtau_err': stats['gtau_err']}
+
+
+def richardson(dtau, values, errors, order=1):
+    r"""Extrapolates to :math:`\Delta\tau\rightarrow 0` results with a
+    Trotter error of order :math:`\Delta\tau^2`
+
+    Fits by weighted least squares
+
+    .. math:: f(\Delta\tau) = f_0 + \sum_{p=1}^{order} a_p \Delta\tau^{2p}
+
+    With as many slicings as parameters it is the Richardson extrapolation.
+    The error of :math:`f_0` is propagated from the errors of the values.
+
+    Parameters
+    ----------
+    dtau : 1D ndarray
+        Time step of each slicing
+    values : ndarray
+        Results of every slicing, first axis enumerates the slicings
+    errors : ndarray
+        Standard errors of the values
+    order : int
+        Highest power of :math:`\Delta\tau^2` fitted, it needs more
+        slicings than order
+
+    Returns
+    -------
+    tuple
+        extrapolated values, their errors
+    """
+    design = np.vander(np.asarray(dtau)**2, order + 1, increasing=True)
+    values = np.asarray(values, dtype=float)
+    shape = values.shape[1:]
+    values = values.reshape(len(design), -1)
+    weights = 1 / np.clip(np.asarray(errors, dtype=float).reshape(
+        len(design), -1), 1e-12, None)
+
+    extrapolated = np.empty(values.shape[1])
+    error = np.empty(values.shape[1])
+    for i in range(values.shape[1]):
+        wdesign = design * weights[:, i, None]
+        cov = la.pinv(np.dot(wdesign.T, wdesign))
+        coef = np.dot(cov, np.dot(wdesign.T, values[:, i] * weights[:, i]))
+        extrapolated[i], error[i] = coef[0], np.sqrt(cov[0, 0])
+    return extrapolated.reshape(shape), error.reshape(shape)
+
+
+def multigrid_gtau(gtau, g0iw, w_n, u_int, fine_slices,
+                   tail_coef=(1., 0., 0.25)):
+    r"""Reconstructs on a fine imaginary time grid the Green function
+    measured on a coarse Trotter slicing
+
+    Following Blümer the reference model, here the IPT solution for the
+    same Weiss field, is solved on the fine grid. Its difference to the QMC
+    result is smooth and is interpolated by a cubic spline from the coarse
+    grid, using the antiperiodicity of the difference at :math:`\beta`
+
+    .. math:: G(\tau) = G_{ref}(\tau) +
+        \mathrm{spline}\left[G_{QMC}(\tau_l) - G_{ref}(\tau_l)\right](\tau)
+
+    The fine :math:`G(\tau)` spares the self-consistency the
+    discretization error of transforming the coarse grid, such that the QMC
+    runs with fewer time slices at the same accuracy.
+
+    Parameters
+    ----------
+    gtau : ndarray
+        QMC Green functions on the coarse slicing, its last axis
+    g0iw : complex ndarray
+        Weiss fields of the same blocks on the Matsubara frequencies
+    w_n : 1D ndarray
+        Matsubara frequencies
+    u_int : float
+        Local interaction
+    fine_slices : int
+        Number of time slices of the fine grid
+    tail_coef : list
+        High frequency moments of the reference Green function, see
+        :func:`dmft.common.gw_invfouriertrans`
+
+    Returns
+    -------
+    tuple
+        fine imaginary times, Green functions on them
+    """
+    from dmft.ipt_imag import single_band_ipt_solver
+
+    beta = np.pi / w_n[0]
+    slices = gtau.shape[-1]
+    tau = np.arange(slices) * beta / slices
+    fine_tau = np.arange(fine_slices) * beta / fine_slices
+
+    coarse = np.reshape(gtau, (-1, slices))
+    blocks = np.broadcast_to(g0iw, gtau.shape[:-1] + w_n.shape)
+    fine = np.empty((len(coarse), fine_slices))
+    for k, (g_qmc, g0_iw) in enumerate(zip(coarse,
+                                           blocks.reshape(-1, len(w_n)))):
+        g_ref_iw, _ = single_band_ipt_solver(u_int, g0_iw, w_n, fine_tau)
+        delta = g_qmc - gw_invfouriertrans(g_ref_iw, tau, w_n, tail_coef)
+        spline = interp1d(np.append(tau, beta), np.append(delta, -delta[0]),
+                          kind='cubic')
+        fine[k] = gw_invfouriertrans(g_ref_iw, fine_tau, w_n, tail_coef) + \
+            spline(fine_tau)
+
+    return fine_tau, fine.reshape(gtau.shape[:-1] + (fine_slices,))
+
+
+def giw_errors(work_dir, w_n, tail_coef=(1., 0., 0.), symmetry=None):
+    r"""Green functions of a finished run on the Matsubara frequencies with
+    their errors
+
+    The errors are the jackknife ones of the binned measurements of
+    :math:`G(\tau)` stored by :func:`save_errors`, they include the
+    correlations between the imaginary times. The tail only applies to the
+    diagonal site blocks.
+
+    Parameters
+    ----------
+    work_dir : str
+        Work directory of the run
+    w_n : 1D ndarray
+        Positive Matsubara frequencies, half as many as the time slices
+    tail_coef : list
+        High frequency moments of the diagonal blocks, see
+        :func:`dmft.common.gt_fouriertrans`
+    symmetry : callable
+        Linear symmetrization of the Green functions, as the paramagnetic
+        average of the flavors, applied before the errors are estimated
+
+    Returns
+    -------
+    tuple
+        :math:`G(i\omega_n)` and its error, the real and imaginary parts
+        of the error are those of the respective parts. Of shape (flavors,
+        sites, sites, frequencies)
+    """
+    with np.load(os.path.join(work_dir, 'meas_errors.npz')) as data:
+        gtau, bins, weights = data['gtau'], data['gtau_bins'], \
+            data['bin_weights']
+    slices = gtau.shape[-1]
+    tau = np.arange(slices) * np.pi / w_n[0] / slices
+    diagonal = np.eye(gtau.shape[1], dtype=bool)[..., None]
+
+    def transform(g_tau):
+        g_iw = np.where(diagonal, gt_fouriertrans(g_tau, tau, w_n, tail_coef),
+                        gt_fouriertrans(g_tau, tau, w_n, (0., 0., 0.)))
+        return g_iw if symmetry is None else symmetry(g_iw)
+
+    return transform(gtau), jackknife(bins, transform, weights)[1]
+
+
+def adaptive_dmft(weiss, giw, w_n, v, interaction, parms_user,
+                  sweeps=(500, 32000), growth=2., tol=2., n_freq=8,
+                  max_iter=40, tail_coef=(1., 0., 0.), symmetry=None,
+                  comm=None):
+    r"""DMFT loop that adapts its Monte Carlo sweeps to its convergence
+
+    Each iteration solves the impurity of the Weiss fields given by the
+    self-consistency ``weiss`` of the last Green functions. The change of
+    :math:`G(i\omega_n)` between iterations is weighed against the QMC
+    errors of both, on the first ``n_freq`` frequencies
+
+    .. math:: \chi^2 = \left\langle \frac{|\Delta \Re G(i\omega_n)|^2}
+        {\sigma_{\Re}^2} + \frac{|\Delta \Im G(i\omega_n)|^2}
+        {\sigma_{\Im}^2} \right\rangle / 2
+
+    where :math:`\sigma^2` sums the variances of both iterations and
+    the components without noise are left out, it is about 1 when the
+    changes are only noise. The loop starts with ``sweeps[0]`` sweeps. Each
+    time :math:`\chi^2 <` ``tol`` the changes can no longer be resolved
+    and the sweeps grow by ``growth``. The loop stops once this happens
+    with ``sweeps[1]`` sweeps, or after ``max_iter`` iterations.
+
+    Every iteration runs in the directory ``it{:03}`` of ``work_dir`` and
+    the schedule is stored in ``dmft_schedule.json`` in ``work_dir``.
+
+    Parameters
+    ----------
+    weiss : callable
+        Self-consistency. It takes the Green functions on the Matsubara
+        frequencies, first ``giw`` then those of shape (flavors, sites,
+        sites, frequencies) of every iteration, and returns the Weiss fields
+        of every flavor in imaginary time as :func:`imp_solver` takes them
+    giw : ndarray
+        Starting Green functions
+    w_n : 1D ndarray
+        Positive Matsubara frequencies, half as many as the time slices
+    v : ndarray
+        Auxiliary Ising fields, they carry on between the iterations
+    interaction : 2D ndarray
+        Interaction matrix, see :func:`interaction_matrix`
+    parms_user : dict
+        Simulation parameters as for :func:`imp_solver`
+    sweeps : tuple
+        Sweeps of the first iteration and most sweeps
+    growth : float
+        Factor raising the sweeps
+    tol : float
+        :math:`\chi^2` of the changes taken as noise
+    n_freq : int
+        Compared Matsubara frequencies
+    max_iter : int
+    tail_coef : list
+        High frequency moments of the diagonal blocks, see
+        :func:`giw_errors`
+    symmetry : callable
+        Linear symmetrization of the Green functions of every iteration,
+        they are compared and passed to ``weiss`` symmetrized. Without it
+        a paramagnetic loop compares the spontaneous polarizations of the
+        chains
+    comm : MPI communicator
+
+    Returns
+    -------
+    tuple
+        last :math:`G(i\omega_n)`, schedule with the ``sweeps``,
+        ``chi2`` and ``converged`` state of every iteration
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    parms = dict(parms_user, sweeps=sweeps[0])
+    schedule, errors = [], None
+    for iteration in range(max_iter):
+        parms['work_dir'] = os.path.join(parms_user['work_dir'],
+                                         'it{:03}'.format(iteration))
+        imp_solver(weiss(giw), v, interaction, parms, comm)
+        result = None
+        if comm.rank == 0:
+            result = giw_errors(parms['work_dir'], w_n, tail_coef, symmetry)
+        new_giw, new_errors = comm.bcast(result, root=0)
+
+        step = {'iteration': iteration, 'sweeps': parms['sweeps'],
+                'chi2': None, 'converged': False}
+        if errors is not None:
+            change = (new_giw - giw)[..., :n_freq]
+            noise = (np.hypot(errors.real, new_errors.real) +
+                     1j * np.hypot(errors.imag, new_errors.imag))[..., :n_freq]
+            ratios = [(part(change) / part(noise))[part(noise) > 0]**2
+                      for part in (np.real, np.imag)]
+            step['chi2'] = float(np.mean(np.concatenate(ratios)))
+            if step['chi2'] < tol:
+                step['converged'] = parms['sweeps'] >= sweeps[1]
+                parms['sweeps'] = min(int(parms['sweeps'] * growth),
+                                      sweeps[1])
+        giw, errors = new_giw, new_errors
+        schedule.append(step)
+        if step['converged']:
+            break
+
+    if comm.rank == 0:
+        with open(os.path.join(parms_user['work_dir'], 'dmft_schedule.json'),
+                  'w') as record:
+            json.dump(schedule, record, indent=2)
+    return giw, schedule
+
+
+ChainResult = namedtuple('ChainResult', [
+    'acceptance', 'negative_ratios', 'log', 'stability', 'binning',
+    'swaps', 'legendre', 'vertex', 'tuning'])
+
+
+def markov_chain(walker, parms, chain=0, therm=None, replicas=None):
+    """Thermalizes and measures on the Markov chain of the walker
+
+    Parameters
+    ----------
+    walker : :class:`dmft.hffast.HFWalker`
+    parms : dict
+        Simulation parameters
+    chain : int
+        Global index of the chain
+    therm : int
+        Thermalization sweeps, defaults to the ``therm`` parameter
+    replicas : MPI communicator
+        Chains of the other interactions to exchange configurations with,
+        see :func:`tempering_swap`
+
+    Returns
+    -------
+    ChainResult
+        ``acceptance`` of the flips, ``negative_ratios`` of the weights,
+        the Ising fields ``log`` file name and number of records, the
+        clean update drift statistics ``stability``: number of monitored clean
+        updates, mean and largest drift and last interval, the
+        :class:`dmft.mcstats.LogBinning` of the measurements ``binning``,
+        the attempted and accepted replica exchanges ``swaps``, the
+        :class:`dmft.mcstats.LogBinning` of the ``legendre`` coefficients
+        of :math:`G(\\tau)` if requested, the sums of the two-particle and
+        one particle Green functions of the ``vertex`` box with their
+        number of measurements and sum of signs if requested and the
+        update settings of the
+        chain with the trials of :func:`autotune` in ``tuning``
+    """
+    # the measurements reuse these buffers, nothing is allocated per step
+    last = measurement_vector(walker)
+    current, delta = np.empty_like(last), np.empty_like(last)
+    binning = LogBinning(last.size, dtype=last.dtype)
+    legendre = None
+    if parms['legendre']:
+        projector = legendre_projector(parms['legendre'], walker.slices,
+                                       parms['BETA'])[0].T.copy()
+        coefs = np.empty((walker.gtau.size // walker.slices,
+                          parms['legendre']), walker.gtau.dtype)
+        legendre = LogBinning(coefs.size, dtype=coefs.dtype)
+    vertex = None
+    if parms['vertex']:
+        n_fermi, n_bose = parms['vertex']
+        fourier = vertex_fourier(n_fermi, n_bose, walker.slices,
+                                 parms['BETA'])
+        vertex = [0., 0., 0, 0.]
+    log = None
+    if parms['save_logs']:
+        log = IsingLog(os.path.join(parms['work_dir'],
+                                    'ising_log_r{}.bin'.format(chain)),
+                       walker.v.size, weights=parms['save_weights'])
+    acc, anrat, done = 0, 0, 0
+    therm = parms['therm'] if therm is None else therm
+
+    interval = parms['clean_every']
+    since, drift = 0, []
+    tol = parms['clean_tol']
+    if walker.single_precision:
+        tol = max(tol, 1e-4)
+    swaps = np.zeros(2, dtype=int)
+
+    # The global flips are counted in sweeps, every therm Markov steps
+    meas = parms['meas']
+    flip_every = parms['therm'] * meas if parms['global_flip'] else 0
+    next_flip = 0
+    tuning = None
+
+    update = True
+    for mcs in range(parms['sweeps'] + therm):
+        if parms['autotune'] and mcs == therm // 2:
+            tuning = autotune(walker, parms, flip_every)
+            meas = tuning['settings']['meas']
+            flip_every = tuning['settings']['global_flip']
+            next_flip = done + flip_every
+            print('autotune chain', chain, tuning['settings'])
+            update = True
+        if flip_every and done >= next_flip:
+            walker.v[:] *= -1
+            next_flip = done + flip_every
+            update = True
+        if replicas is not None and mcs % parms['swap_every'] == 0:
+            if update:  # the swap weighs the current configuration
+                walker.clean()
+                update, since = False, 0
+            swapped = tempering_swap(walker, replicas,
+                                     mcs // parms['swap_every'] % 2)
+            swaps += swapped
+            update = bool(swapped[1])
+        if update:  # the fields changed outside the fast updates
+            walker.clean()
+            update, since = False, 0
+        elif since >= interval:  # dirty update clean up
+            drift.append(walker.clean())
+            if parms['clean_tol']:
+                interval = clean_interval(drift[-1], since, interval, tol,
+                                          parms['clean_max'])
+            since = 0
+
+        acr, nrat = walker.sweep(meas)
+        since += 1
+        done += meas
+        acc += acr
+        anrat += nrat
+
+        if mcs > therm:
+            walker.measure()
+            measurement_vector(walker, current)
+            np.subtract(current, last, out=delta)
+            binning.add(delta)
+            if legendre is not None:
+                np.dot(delta[:walker.gtau.size].reshape(-1, walker.slices),
+                       projector, out=coefs)
+                legendre.add(coefs)
+            last, current = current, last
+
+            if vertex is not None and \
+                    binning.count % parms['vertex_every'] == 0:
+                g_w = vertex_giw(walker, fourier)
+                phase = walker.weight_phase
+                vertex[0] += phase * wick_vertex(g_w, n_fermi, n_bose,
+                                                 parms['BETA'])
+                vertex[1] += phase * np.diagonal(g_w, axis1=-2, axis2=-1)
+                vertex[2] += 1
+                vertex[3] += walker.weight_sign
+
+            if log is not None and binning.count % parms['log_every'] == 0:
+                log.append(mcs, acr, walker.v,
+                           (walker.logdet, walker.weight_sign)
+                           if parms['save_weights'] else None)
+
+    stability = [len(drift), np.mean(drift) if drift else 0.,
+                 max(drift) if drift else 0., interval]
+    if log is not None:
+        log.close()
+        log = (os.path.basename(log.filename), log.records)
+
+    if tuning is None:
+        tuning = {'settings': {'meas': meas, 'Heat_bath': walker.heatbath,
+                               'double_flip_prob': walker.double_flip_prob,
+                               'global_flip': flip_every}}
+    acc /= walker.v.size * max(done, 1)
+
+    return ChainResult(acc, anrat, log, stability, binning, swaps, legendre,
+                       vertex, tuning)
+
+
+def autotune(walker, parms, flip_every):
+    r"""Chooses the update settings of the walker that give the most
+    independent measurements per second
+
+    Starting from the settings of the parameters, each of ``Heat_bath``,
+    ``double_flip_prob``, the period ``global_flip`` of the global flips in
+    sweeps, 0 to disable them, and ``meas`` is varied in turn over a few
+    candidates, keeping the others at their best value so far. Every
+    candidate runs a trial of ``autotune`` measurements, scored by
+
+    .. math:: r = \frac{n}{(1 + 2\tau_{int})\, t}\langle s\rangle^2
+
+    where :math:`\tau_{int}` is the largest integrated autocorrelation
+    time of the occupations and double occupations, :math:`t` the wall
+    time and :math:`\langle s\rangle` the average sign of the weights of
+    the configurations sampled after every measurement step.
+
+    The best settings are set on the walker, the measurement accumulators
+    are left as found. The choice depends on the timings, then chains of
+    the same seed are not reproducible.
+
+    Parameters
+    ----------
+    walker : :class:`dmft.hffast.HFWalker`
+    parms : dict
+        Simulation parameters
+    flip_every : int
+        Current period of the global flips in sweeps
+
+    Returns
+    -------
+    dict
+        ``settings`` chosen and ``trials`` a list of every tried settings
+        with its ``acceptance``, ``sign``, ``tau_int``, ``seconds`` and
+        ``rate``
+    """
+    saved = walker.state()
+    steps = parms['autotune']
+    settings = {'meas': parms['meas'], 'Heat_bath': bool(walker.heatbath),
+                'double_flip_prob': walker.double_flip_prob,
+                'global_flip': flip_every}
+    candidates = [('Heat_bath', [True, False]),
+                  ('double_flip_prob', [0., 0.25] if walker.sites > 1
+                   else []),
+                  ('global_flip', [0, max(steps * parms['meas'] // 4, 1)]),
+                  ('meas', [1, 2, 4])]
+
+    trials, rates = [], {}
+    for key, values in candidates:
+        best = None
+        for value in sorted(set(values + [settings[key]])):
+            trial = dict(settings, **{key: value})
+            label = tuple(sorted(trial.items()))
+            if label not in rates:
+                trials.append(tune_trial(walker, trial, steps,
+                                         parms['clean_every']))
+                rates[label] = trials[-1]['rate']
+            if best is None or rates[label] > best[0]:
+                best = rates[label], value
+        settings[key] = best[1]
+
+    walker.heatbath = settings['Heat_bath']
+    walker.double_flip_prob = settings['double_flip_prob']
+    saved['v'] = walker.v.copy()
+    walker.load_state(saved, rng=False)
+    return {'settings': settings, 'trials': trials}
+
+
+def tune_trial(walker, settings, steps, clean_every):
+    """Runs ``steps`` measurements of the walker with the update settings
+    of :func:`autotune` and scores them
+
+    Returns
+    -------
+    dict
+        The settings with the ``acceptance``, average ``sign``,
+        ``tau_int``, ``seconds`` and ``rate`` of independent measurements
+        per second
+    """
+    walker.heatbath = settings['Heat_bath']
+    walker.double_flip_prob = settings['double_flip_prob']
+    start = time.time()
+    walker.clean()
+    last = measurement_vector(walker)[walker.gtau.size:].real
+    binning = LogBinning(last.size)
+    acc, sign, since, swept = 0, 0., 0, 0
+    next_flip = settings['global_flip']
+    for _ in range(steps):
+        if settings['global_flip'] and swept >= next_flip:
+            walker.v[:] *= -1
+            next_flip = swept + settings['global_flip']
+            since = clean_every
+        if since >= clean_every:
+            walker.clean()
+            since = 0
+        acc += walker.sweep(settings['meas'])[0]
+        sign += walker.weight_sign
+        since += settings['meas']
+        swept += settings['meas']
+        walker.measure()
+        current = measurement_vector(walker)[walker.gtau.size:].real
+        binning.add(current - last)
+        last = current
+    seconds = time.time() - start
+
+    flips = walker.v.size * settings['meas'] * steps
+    tau = max(float(np.max(binning.tau_int(min_bins=8))), 0.)
+    sign /= steps
+    return dict(settings, acceptance=acc / flips, sign=sign, tau_int=tau,
+                seconds=seconds,
+                rate=steps * sign**2 / (1 + 2 * tau) / seconds)
+
+
+def tempering_swap(walker, replicas, parity):
+    r"""Proposes to exchange the Ising configuration of the walker with the
+    walker of a neighboring rank of ``replicas``
+
+    The ranks pair as :math:`(r, r+1)` for the even ``r`` if ``parity`` is
+    0 and the odd ones otherwise. The swap of the configurations
+    :math:`s_a, s_b` of the replicas at the interactions :math:`a, b` is
+    accepted with probability
+
+    .. math:: \min\left(1, \left|\frac{W_a(s_b)W_b(s_a)}
+        {W_a(s_a)W_b(s_b)}\right|\right)
+
+    where the own weights are those the walkers keep up to date through
+    their sweeps and the crossed ones are found by
+    :meth:`dmft.hffast.HFWalker.log_weight`.
+    Each walker keeps the magnitude of its fields and takes the spins of
+    the other. The lower rank draws the decision.
+
+    Parameters
+    ----------
+    walker : :class:`dmft.hffast.HFWalker`
+        Walker consistent with its fields, cleaned at least once
+    replicas : MPI communicator
+        Replicas ordered by interaction
+    parity : int
+
+    Returns
+    -------
+    ndarray
+        attempted and accepted swaps, each 0 or 1
+    """
+    rank = replicas.rank
+    partner = rank + 1 if rank % 2 == parity else rank - 1
+    if not 0 <= partner < replicas.size:
+        return np.array([0, 0])
+
+    spins = np.sign(walker.v)
+    theirs = np.empty_like(spins)
+    replicas.Sendrecv(spins, partner, recvbuf=theirs, source=partner)
+    own = walker.logdet
+    cross = walker.log_weight(theirs)[0]
+    their_own, their_cross = replicas.sendrecv((own, cross), partner,
+                                               source=partner)
+
+    if rank < partner:
+        log_ratio = cross + their_cross - own - their_own
+        accept = walker.uniform() < exp(min(log_ratio, 0.))
+        replicas.send(accept, partner)
+    else:
+        accept = replicas.recv(source=partner)
+    if accept:
+        walker.v[:] = theirs * np.abs(walker.v)
+    return np.array([1, int(accept)])
+
+
+def tempering_solver(g0_blocks_u, v_u, interaction, parms_user, u_values,
+                     comm=None):
+    """Solves the impurity at several interactions exchanging the
+    configurations of their Markov chains
+
+    The processes split into as many groups as interactions, each running
+    :func:`imp_solver` for its interaction in the work directory
+    ``U{u}``. The chains of neighboring interactions swap configurations
+    every ``swap_every`` sweeps, see :func:`tempering_swap`, which lets
+    them tunnel between the metallic and insulating basins of the
+    coexistence region. The swap acceptance is saved in
+    ``swap_acceptance.npy``.
+
+    Parameters
+    ----------
+    g0_blocks_u : list
+        Weiss fields in imaginary time of every interaction as for
+        :func:`imp_solver`
+    v_u : list of 2D ndarrays
+        Ising fields of every interaction, see :func:`ising_v`
+    interaction : 2D ndarray
+        Interaction matrix, see :func:`interaction_matrix`
+    parms_user : dict
+        Simulation parameters as for :func:`imp_solver`
+    u_values : list
+        Interactions in increasing order
+    comm : MPI communicator
+        Processes to split, by default ``MPI.COMM_WORLD``
+
+    Returns
+    -------
+    list
+        The Green functions of every interaction as returned by
+        :func:`imp_solver`
+    """
+    world = MPI.COMM_WORLD if comm is None else comm
+    if world.size % len(u_values):
+        raise ValueError('The processes must split evenly among the '
+                         'interactions')
+    color = world.rank * len(u_values) // world.size
+    comm = world.Split(color, world.rank)
+    replicas = world.Split(comm.rank, color)
+
+    seed = world.bcast(parms_user.get('SEED',
+                                      struct.unpack("I", os.urandom(4))[0]),
+                       root=0)
+    u_int = u_values[color]
+    parms = dict(parms_user, U=u_int, SEED=seed + color,
+                 work_dir=os.path.join(parms_user['work_dir'],
+                                       'U{}'.format(u_int)))
+    gtau = imp_solver(g0_blocks_u[color], v_u[color], interaction, parms,
+                      comm, replicas)
+
+    gtau_u = replicas.allgather(gtau)
+    comm.Free()
+    replicas.Free()
+    return gtau_u
+
+
+def task_farm(solve, points, group_size=1, work_dir='.', comm=None):
+    """Solves independent parameter points on groups of processes
+
+    The processes of ``comm`` split into groups of ``group_size``, that
+    take the next unsolved point as they become free. The points are handed
+    out by an atomic counter in a one sided communication window, without
+    a process dedicated to it. Each point is warm started from the result
+    of the nearest point solved by then in this farm, in the euclidean
+    distance of its parameters. The solved points are flagged in a second
+    window, such that files left in ``work_dir`` by earlier runs are never
+    used. Where the windows can not be created the groups take the points
+    in turns instead and warm start only from their own solved points.
+
+    The result of every point is stored in ``point{k:03}.npz`` in
+    ``work_dir`` as soon as it is solved, and at the end all of them are
+    gathered into ``farm.h5``, one group per point holding its parameters
+    as attributes.
+
+    Parameters
+    ----------
+    solve : callable
+        Called as ``solve(point, start, group)`` by all processes of a
+        group with the parameters of the point, the result of the nearest
+        solved point or None and the communicator of the group. It returns
+        the result as a dict of arrays, only the one of the first process
+        of the group is kept
+    points : list of dicts
+        Numerical parameters of every point, as ``U``, ``BETA``, ``tp``
+    group_size : int
+        Processes in every group, the last one may be smaller
+    work_dir : str
+    comm : MPI communicator
+        Processes of the farm, by default ``MPI.COMM_WORLD``
+
+    Returns
+    -------
+    list
+        Results of all points on the first process, None on the others
+    """
+    world = MPI.COMM_WORLD if comm is None else comm
+    group = world.Split(world.rank // group_size, world.rank)
+    leader = group.rank == 0
+    if world.rank == 0 and not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    # Index of the next point and flags of the solved ones, exposed by the
+    # first process. Without one sided communication the groups take the
+    # points in turns and know only of their own solved points
+    next_point = np.zeros(1, dtype=np.int64)
+    finished = np.zeros(len(points), dtype=np.int64)
+    seen = np.zeros_like(finished)
+    try:
+        counter = MPI.Win.Create(next_point if world.rank == 0 else None,
+                                 comm=world)
+        flags = MPI.Win.Create(finished if world.rank == 0 else None,
+                               finished.itemsize, comm=world)
+    except MPI.Exception:
+        counter = flags = None
+    ngroups = -(-world.size // group_size)
+    turn = world.rank // group_size
+
+    def filename(k):
+        return os.path.join(work_dir, 'point{:03}.npz'.format(k))
+
+    def distance(k, j):
+        return sum((points[k][key] - points[j].get(key, 0.))**2
+                   for key in points[k])
+
+    solved = []
+    while True:
+        task = None
+        if counter is None:
+            task, turn = turn, turn + ngroups
+        elif leader:
+            task, one = np.zeros(1, dtype=np.int64), np.ones(1, np.int64)
+            counter.Lock(0)
+            counter.Fetch_and_op(one, task, 0, op=MPI.SUM)
+            counter.Unlock(0)
+            task = int(task[0])
+        task = group.bcast(task, root=0)
+        if task >= len(points):
+            break
+
+        start = None
+        if leader:
+            if flags is not None:
+                flags.Lock(0, MPI.LOCK_SHARED)
+                flags.Get(seen, 0)
+                flags.Unlock(0)
+            done = np.flatnonzero(seen)
+            if len(done):
+                with np.load(filename(min(done, key=lambda j:
+                                          distance(task, j)))) as data:
+                    start = {key: data[key] for key in data.files}
+        start = group.bcast(start, root=0)
+
+        result = solve(points[task], start, group)
+        if leader:
+            # Written aside and renamed, others never read a partial file
+            np.savez(filename(task) + '.tmp.npz', **result)
+            os.rename(filename(task) + '.tmp.npz', filename(task))
+            solved.append((task, result))
+            if flags is None:
+                seen[task] = 1
+            else:
+                flags.Lock(0)
+                flags.Accumulate(np.ones(1, np.int64), 0,
+                                 target=(task, 1, MPI.INT64_T),
+                                 op=MPI.REPLACE)
+                flags.Unlock(0)
+
+    if counter is not None:
+        counter.Free()
+        flags.Free()
+    group.Free()
+    solved = world.gather(solved, root=0)
+    if world.rank != 0:
+        return None
+
+    results = [result for _, result in sorted(sum(solved, []),
+                                              key=lambda item: item[0])]
+    with File(os.path.join(work_dir, 'farm.h5'), 'w') as store:
+        for k, (point, result) in enumerate(zip(points, results)):
+            entry = store.create_group('point{:03}'.format(k))
+            for key, value in point.items():
+                entry.attrs[key] = value
+            for key, value in result.items():
+                entry[key] = value
+    return results
+
+
+def improved_sigma(gtau, ftau, tau, w_n, g_tail, f_tail):
+    r"""Self-energy from the improved estimator
+
+    The solver measures with the Green function the correlator
+
+    .. math:: F_{ab}(\tau) = -U\langle T (n_{\bar{\sigma} a}(\tau) - 1/2)
+        c_a(\tau) c^\dagger_b(0) \rangle
+
+    from which, by the equation of motion :math:`F = \Sigma G`,
+
+    .. math:: \Sigma(i\omega_n) = F(i\omega_n) G(i\omega_n)^{-1}
+
+    Unlike the Dyson equation it does not amplify the noise of
+    :math:`G(i\omega_n)` at high frequencies.
+
+    Parameters
+    ----------
+    gtau : ndarray (..., sites, sites, L)
+        Green functions with the conventional sign
+    ftau : ndarray (..., sites, sites, L)
+        Improved estimator, as stored by :func:`imp_solver`
+    tau : 1D ndarray
+        Imaginary times
+    w_n : 1D ndarray
+        Matsubara frequencies
+    g_tail : list
+        High frequency moments of the Green functions, see
+        :func:`dmft.common.gt_fouriertrans`
+    f_tail : list
+        High frequency moments of :math:`F`, the products of the self-energy
+        and Green function moments
+
+    Returns
+    -------
+    complex ndarray (..., sites, sites, len(w_n))
+    """
+    giw = np.moveaxis(gt_fouriertrans(gtau, tau, w_n, g_tail), -1, -3)
+    fiw = np.moveaxis(gt_fouriertrans(ftau, tau, w_n, f_tail), -1, -3)
+    # Sigma G = F is solved transposed, G^T Sigma^T = F^T
+    sigma = np.linalg.solve(np.swapaxes(giw, -1, -2), np.swapaxes(fiw, -1, -2))
+    return np.moveaxis(np.swapaxes(sigma, -1, -2), -3, -1)
+
+
+def measurement_vector(walker, out=None):
+    """The accumulated :math:`G(\\tau)`, occupations and double occupations
+    of the walker normalized per measurement and the sum of the signs as
+    one flat array, filled into ``out`` when given
+
+    The accumulated measurements are weighted by the sign, their averages
+    are divided by the average of the last entry."""
+    sizes = np.cumsum([walker.gtau.size, walker.occupation.size,
+                       walker.double_occ.size, 1])
+    if out is None:
+        out = np.empty(sizes[-1], walker.gtau.dtype)
+    np.divide(walker.gtau.reshape(-1), -walker.slices, out=out[:sizes[0]])
+    np.divide(walker.occupation, walker.slices, out=out[sizes[0]:sizes[1]])
+    np.divide(walker.double_occ, walker.slices, out=out[sizes[1]:sizes[2]])
+    out[-1] = walker.sign_sum
+    return out
+
+
+def clean_interval(drift, sweeps, interval, tol, max_interval):
+    """Sweeps to do before the next clean update of the Green functions
+
+    The drift accumulated by the fast updates is taken to grow linearly
+    with the sweeps done since the last clean update. The next interval
+    aims at half the tolerance, it shrinks at once when the tolerance is
+    exceeded but at most doubles to be safe against a lucky estimate.
+
+    Parameters
+    ----------
+    drift : float
+        Largest deviation of the fast updated Green functions found at the
+        last clean update
+    sweeps : int
+        Sweeps done before the last clean update
+    interval : int
+        Current interval between clean updates
+    tol : float
+        Tolerated drift
+    max_interval : int
+
+    Returns
+    -------
+    int
+    """
+    target = 2 * interval
+    if drift > 0:
+        target = min(target, int(0.5 * tol * sweeps / drift))
+    return max(1, min(target, max_interval))
+
+
+def save_checkpoint(work_dir, walkers, rank):
+    """Stores the Ising fields, random number states and measurement
+    accumulators of the walkers of the rank into the work directory"""
+    states = [walker.state() for walker in walkers]
+    np.savez(os.path.join(work_dir, 'checkpoint_r{}'.format(rank)),
+             **{key: np.array([state[key] for state in states])
+                for key in states[0] if key != 'g'})
+
+
+def load_checkpoint(restart_dir, walkers, rank, accumulators=False):
+    """Restores the walkers of the rank from a checkpoint
+
+    Each walker takes the state of the same walker in the same rank. When
+    the run is scaled out and that state does not exist only the Ising
+    fields of a stored walker are used and the walker keeps its own random
+    number stream.
+
+    Parameters
+    ----------
+    restart_dir : str
+        Work directory of the run that saved the checkpoint
+    walkers : list of :class:`dmft.hffast.HFWalker`
+    rank : int
+    accumulators : bool
+        Restore also the measurement accumulators
+
+    Returns
+    -------
+    bool
+        If the walkers were restored
+    """
+    ckfile = os.path.join(restart_dir, 'checkpoint_r{}.npz'.format(rank))
+    same_rank = os.path.exists(ckfile)
+    if not same_rank:
+        saved = sorted(glob(os.path.join(restart_dir, 'checkpoint_r*.npz')))
+        if not saved:
+            return False
+        ckfile = saved[rank % len(saved)]
+
+    with np.load(ckfile) as data:
+        states = {key: data[key] for key in data.files}
+    nsaved = len(states['v'])
+    for w, walker in enumerate(walkers):
+        same_chain = same_rank and w < nsaved
+        state = {key: val[w % nsaved] for key, val in states.items()}
+        walker.load_state(state, same_chain, same_chain and accumulators)
+    return True
 
-    # Recover Conventional GF sign in average
-    return [-1 * avg_g(gst, parms) for gst in Gst]
 
+def local_susceptibility(density_corr, exchange, occupation, nmeas, beta):
+    r"""Local spin and charge susceptibilities
 
-@numba.jit(nopython=True)
-def measure_chi(v, slices):
-    """Estimates the susceptibility from the Ising auxiliary fields"""
-    chi = np.zeros(slices)
-    s = np.sign(v)
-    for i in range(slices):
-        for j in range(slices):
-            k = i + j
-            if k > slices:
-                k -= slices  # Ising fields are bosonic and have PBC
-            chi[i] += s[k] * s[j]
+    .. math:: \chi_{s}(\tau) = \langle S_z(\tau) S_z(0) \rangle
+        \quad \chi_{c}(\tau) = \langle n(\tau) n(0) \rangle
+        - \langle n \rangle^2
 
+    averaged over the time translations, and their transform to the bosonic
+    Matsubara frequencies :math:`\nu_n = 2\pi n/\beta`
+
+    .. math:: \chi(i\nu_n) = \Delta\tau\sum_l e^{i\nu_n\tau_l}\chi(\tau_l)
+
+    Parameters
+    ----------
+    density_corr : ndarray (2, sites, slices)
+        Accumulated autocorrelations of the magnetization and charge of the
+        holes, see :meth:`dmft.hffast.HFWalker.measure`
+    exchange : ndarray (flavors, sites, slices)
+        Accumulated Wick exchange term of the walkers
+    occupation : ndarray (flavors * sites)
+        Averaged hole occupations
+    nmeas : float
+        Number of measurements accumulated, the sum of their signs when
+        they are weighted by it
+    beta : float
+        Inverse temperature
+
+    Returns
+    -------
+    dict
+        ``chi_spin``, ``chi_charge`` of shape (sites, slices) and
+        ``chi_spin_iw``, ``chi_charge_iw`` on the non negative frequencies
+    """
+    slices = exchange.shape[-1]
+    exch = exchange.sum(0) / slices / nmeas
+    corr = density_corr / slices / nmeas
+    charge = occupation.reshape(-1, exchange.shape[1]).sum(0)
+
+    chi = {'chi_spin': corr[0] - exch / 4,
+           'chi_charge': corr[1] - exch - charge[:, None]**2}
+    for key in list(chi):
+        chi[key + '_iw'] = beta / slices * np.fft.rfft(chi[key]).real
     return chi
 
 
-def orbital_occupation(g, occupation, slices, flavors_ind):
-    """Calculates the orbital occupation
+def vertex_fourier(n_fermi, n_bose, slices, beta):
+    r"""Transform of the time slices to the fermionic frequencies of the
+    vertex measurement box
 
-    It is relevant to remember that under this Hirsh-Fye simulation
-    the signs of the Green functions are reversed and that after this
-    observable is calculated g(0+) one has to apply n= 1-g(0+) """
+    The box holds :math:`\omega_n` for :math:`-n_f \leq n < n_f` and the
+    bosonic transfers :math:`\nu_m = 2\pi m/\beta` for
+    :math:`0 \leq m < n_b`, which needs the fermionic frequencies up to
+    :math:`\omega_{n_f - 1} + \nu_{n_b - 1}`.
 
-    for k, (spin_i, site_i) in enumerate(flavors_ind):
-        g_i = g[spin_i][
-            site_i * slices:(site_i + 1) * slices, site_i * slices:(site_i + 1) * slices]
-        occupation[k] += np.trace(g_i)
+    Returns
+    -------
+    ndarray (2 n_fermi + n_bose - 1, slices)
+        :math:`\Delta\tau e^{i\omega_n\tau_l}/\sqrt{\beta}`
+    """
+    w_n = (2 * np.arange(-n_fermi, n_fermi + n_bose - 1) + 1) * np.pi / beta
+    tau = np.arange(slices) * beta / slices
+    return np.exp(1j * np.outer(w_n, tau)) * beta / slices / np.sqrt(beta)
 
 
-def double_occupation(g, double_occ, slices, flavor_pairs):
-    """Calculates the density-density correlator between spin flavors"""
-    for k, (i, j) in enumerate(flavor_pairs):
-        spin_i, site_i = i
-        g_i = g[spin_i][
-            site_i * slices:(site_i + 1) * slices, site_i * slices:(site_i + 1) * slices]
-        spin_j, site_j = j
-        g_j = g[spin_j][
-            site_j * slices:(site_j + 1) * slices, site_j * slices:(site_j + 1) * slices]
-        double_occ[k] += np.einsum('ii,ii', g_i, g_j)
+def vertex_giw(walker, fourier):
+    r"""Green functions of the current configuration of the walker in the
+    fermionic frequencies of the vertex box
 
+    .. math:: G_f(i\omega_n, i\omega_m) = \frac{1}{\beta}
+        \int_0^\beta d\tau \int_0^\beta d\tau'
+        e^{i\omega_n\tau} G_f(\tau, \tau') e^{-i\omega_m\tau'}
 
-def susceptibility(v):
-    """Calculate the susceptibility from the Ising fields"""
-    pass
+    of every flavor on every site. Only the local blocks of the Green
+    functions are transformed, by two matrix products each, the cost is
+    linear in the sites.
+
+    Parameters
+    ----------
+    walker : :class:`dmft.hffast.HFWalker`
+        Walker with the Green functions of its current configuration
+    fourier : ndarray
+        See :func:`vertex_fourier`
+
+    Returns
+    -------
+    ndarray (flavors, sites, frequencies, frequencies)
+    """
+    L = walker.slices
+    # g[f] is column major and of the holes
+    blocks = np.array([walker.g[:, a * L:(a + 1) * L, a * L:(a + 1) * L]
+                       for a in range(walker.sites)]).swapaxes(0, 1)
+    return -np.matmul(np.matmul(fourier, blocks.swapaxes(-1, -2)),
+                      fourier.conj().T)
 
 
-def save_output(params, occupation, double_occ, acceptance, chi, vlog, ar):
+def wick_vertex(g_w, n_fermi, n_bose, beta):
+    r"""Two-particle Green function of one configuration by Wick's theorem
+
+    .. math:: G^{(2)}_{ff'}(i\omega, i\omega', i\nu) =
+        \beta\left[G_f(\omega, \omega+\nu)G_{f'}(\omega'+\nu, \omega')
+        - \delta_{ff'}G_f(\omega, \omega')G_f(\omega'+\nu, \omega+\nu)
+        \right]
+
+    in the particle-hole channel for every site.
+
+    Parameters
+    ----------
+    g_w : ndarray
+        See :func:`vertex_giw`
+    n_fermi : int
+        Positive fermionic frequencies of the box
+    n_bose : int
+        Non negative bosonic frequencies of the box
+    beta : float
+
+    Returns
+    -------
+    ndarray (flavors, flavors, sites, n_bose, 2 n_fermi, 2 n_fermi)
+    """
+    fermi = np.arange(2 * n_fermi).reshape(1, -1)
+    shift = fermi + np.arange(n_bose).reshape(-1, 1)
+    # (flavors, sites, n_bose, 2 n_fermi) of G(w, w+nu) and G(w+nu, w)
+    ahead = g_w[..., fermi, shift]
+    behind = g_w[..., shift, fermi]
+    g2 = ahead[:, None, ..., None] * behind[None, ..., None, :]
+    exchange = g_w[..., None, :2 * n_fermi, :2 * n_fermi] * \
+        g_w[..., shift[:, None, :], shift[:, :, None]]
+    for f in range(len(g_w)):
+        g2[f, f] -= exchange[f]
+    return beta * g2
+
+
+def save_vertex(work_dir, g2, giw, nmeas, beta, sign=1.):
+    r"""Stores the two-particle measurement in ``vertex.h5``
+
+    Next to the averaged two-particle Green function ``g2`` and the one
+    particle ``giw`` on all fermionic frequencies of the box it writes the
+    generalized susceptibility
+
+    .. math:: \chi_{ff'}(i\omega, i\omega', i\nu) =
+        G^{(2)}_{ff'}(i\omega, i\omega', i\nu)
+        - \beta\delta_{\nu 0} G_f(i\omega) G_{f'}(i\omega')
+
+    The four index arrays are chunked by bosonic frequency, to read the
+    susceptibility of one transfer at a time.
+
+    Parameters
+    ----------
+    work_dir : str
+    g2 : ndarray (flavors, flavors, sites, n_bose, 2 n_fermi, 2 n_fermi)
+        Accumulated :func:`wick_vertex` of all chains
+    giw : ndarray (flavors, sites, 2 n_fermi + n_bose - 1)
+        Accumulated one particle Green functions of all chains
+    nmeas : int
+        Number of accumulated measurements
+    beta : float
+    sign : float
+        Average sign of the measurements, which are weighted by it
+    """
+    n_bose, n_fermi = g2.shape[3], g2.shape[4] // 2
+    g2 = g2 / nmeas / sign
+    giw = giw / nmeas / sign
+    chi = g2.copy()
+    box = giw[..., :2 * n_fermi]
+    chi[:, :, :, 0] -= beta * box[:, None, :, :, None] * \
+        box[None, :, :, None, :]
+
+    chunks = (1, 1, 1, 1) + g2.shape[4:]
+    with File(os.path.join(work_dir, 'vertex.h5'), 'w') as output:
+        output.create_dataset('g2', data=g2, chunks=chunks)
+        output.create_dataset('chi', data=chi, chunks=chunks)
+        output['giw'] = giw
+        output['fermionic'] = (2 * np.arange(-n_fermi, n_fermi + n_bose - 1) +
+                               1) * np.pi / beta
+        output['bosonic'] = 2 * np.arange(n_bose) * np.pi / beta
+        output.attrs['BETA'] = beta
+        output.attrs['measurements'] = nmeas
+        output.attrs['sign'] = sign
+
+
+def save_output(params, occupation, double_occ, acceptance, chi,
+                drift=None):
     """Saves the simulation status"""
     if not os.path.exists(params['work_dir']):
         os.makedirs(params['work_dir'])
     np.save(params['work_dir'] + '/occupation', occupation)
     np.save(params['work_dir'] + '/double_occ', double_occ)
     np.save(params['work_dir'] + '/acceptance', acceptance)
-    np.save(params['work_dir'] + '/chi', chi)
+    for key, val in chi.items():
+        np.save(params['work_dir'] + '/' + key, val)
+    np.save(params['work_dir'] + '/seed', params['SEED'])
+    if drift is not None:
+        np.save(params['work_dir'] + '/clean_drift', drift)
+
+
+def ising_log_dtype(fields, weights=False):
+    """Record of the Ising fields log: sweep, accepted flips and the signs
+    of the fields packed in bits. With weights also the logarithm ``logw``
+    and ``sign`` of the weight of the configuration"""
+    record = [('mcs', '<i8'), ('acc', '<i4'),
+              ('v', 'u1', ((fields + 7) // 8,))]
+    if weights:
+        record += [('logw', '<f8'), ('sign', 'i1')]
+    return np.dtype(record)
+
+
+class IsingLog(object):
+    """Append only log of the Ising fields of a Markov chain
 
-    if params['save_logs']:
-        np.save(params['work_dir'] + '/v_ising', np.asarray(vlog))
-        np.save(params['work_dir'] + '/acceptance_log', np.asarray(ar))
+    The signs of the fields are packed in bits and the records are kept in
+    a small buffer, which is appended to the file when full. The memory use
+    does not grow with the length of the run.
+
+    Parameters
+    ----------
+    filename : str
+    fields : int
+        Total number of Ising fields
+    buffer_size : int
+        Records kept in memory before writing to disk
+    weights : bool
+        Record the weight of the configurations
+    """
+
+    def __init__(self, filename, fields, buffer_size=1024, weights=False):
+        self.filename = filename
+        self.buffer = np.zeros(buffer_size, ising_log_dtype(fields, weights))
+        self.pending = 0
+        self.records = 0
+        self.handle = open(filename, 'wb')
+
+    def append(self, mcs, acceptance, v, weight=None):
+        """Logs the sweep, accepted flips and current Ising fields, and for
+        a log of weights the logarithm and sign of the weight of the
+        fields"""
+        record = self.buffer[self.pending]
+        record['mcs'] = mcs
+        record['acc'] = acceptance
+        record['v'] = np.packbits(v.ravel() > 0)
+        if weight is not None:
+            record['logw'], record['sign'] = weight
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered records to the file"""
+        self.buffer[:self.pending].tofile(self.handle)
+        self.handle.flush()
+        self.records += self.pending
+        self.pending = 0
+
+    def close(self):
+        """Flushes and closes the file"""
+        self.flush()
+        self.handle.close()
+
+
+def save_log_index(work_dir, logs, fields_shape, log_every, weights=False):
+    """Writes the index ``ising_log.json`` of the logs of all chains
+
+    Parameters
+    ----------
+    work_dir : str
+    logs : list of tuples
+        file name and number of records of every chain
+    fields_shape : tuple
+        Shape of the Ising fields array
+    log_every : int
+        Measurements between records
+    weights : bool
+        The records hold the weights of the configurations
+    """
+    index = {'fields_shape': list(fields_shape),
+             'log_every': log_every,
+             'weights': weights,
+             'files': [name for name, _ in logs],
+             'records': [records for _, records in logs]}
+    with open(os.path.join(work_dir, 'ising_log.json'), 'w') as ifile:
+        json.dump(index, ifile, indent=2)
+
+
+def load_ising_log(work_dir, chain=0):
+    """Memory maps the Ising fields log of a chain
+
+    Parameters
+    ----------
+    work_dir : str
+    chain : int
+        Position of the chain in the index
+
+    Returns
+    -------
+    tuple
+        the record array with fields ``mcs``, ``acc``, the packed ``v`` and
+        if recorded ``logw`` and ``sign``, and the shape of the Ising
+        fields. :func:`unpack_ising` recovers the fields.
+    """
+    with open(os.path.join(work_dir, 'ising_log.json'), 'r') as ifile:
+        index = json.load(ifile)
+    fields_shape = tuple(index['fields_shape'])
+    dtype = ising_log_dtype(int(np.prod(fields_shape)),
+                            index.get('weights', False))
+    if index['records'][chain] == 0:
+        return np.zeros(0, dtype), fields_shape
+    return np.memmap(os.path.join(work_dir, index['files'][chain]), dtype,
+                     mode='r', shape=(index['records'][chain],)), fields_shape
+
+
+def unpack_ising(packed, fields):
+    """Unpacks the bit packed Ising fields signs into a boolean array of
+    the positive fields of shape (records, fields)"""
+    return np.unpackbits(np.asarray(packed), axis=1)[:, :fields].astype(bool)
+
+
+def reweight(work_dir, g0_blocks, lam, interaction, nbins=32):
+    r"""Reweights the logged configurations of a run to a nearby
+    interaction and chemical potential
+
+    The run must have recorded the weights of its configurations, see the
+    ``save_weights`` parameter of :func:`imp_solver`. For every logged
+    configuration the Green functions of the target parameters are
+    recalculated, which gives its observables and weight
+    :math:`W'(s)`. The expectation values at the target are
+
+    .. math:: \langle O \rangle' = \frac{\sum_s r_s O'(s)}{\sum_s r_s}
+        \quad r_s = \frac{W'(s)}{W(s)}
+
+    with errors from the jackknife of ``nbins`` consecutive blocks of
+    configurations. The overlap of the sampled and target distributions is
+    diagnosed by the effective sample size
+    :math:`(\sum_s r_s)^2/\sum_s r_s^2` and the largest share of a single
+    configuration in the total weight. The estimates can be trusted while
+    the effective sample size is a sizable fraction of the configurations.
+
+    Parameters
+    ----------
+    work_dir : str
+        Work directory of the run
+    g0_blocks : list of ndarrays
+        Weiss fields in imaginary time at the target parameters as for
+        :func:`imp_solver`. A chemical potential shift enters through them
+    lam : float or 1D ndarray
+        Magnitude of the Ising fields at the target interaction, for every
+        field, see :func:`ising_v`
+    interaction : 2D ndarray
+        Interaction matrix of the run, see :func:`interaction_matrix`
+    nbins : int
+        Number of jackknife blocks
+
+    Returns
+    -------
+    dict
+        ``gtau`` with the conventional sign, hole ``occupation`` and
+        ``double_occ`` with their errors ``_err``, and the diagnostics
+        ``ess``, ``ess_fraction`` and ``max_weight``
+    """
+    with open(os.path.join(work_dir, 'ising_log.json'), 'r') as ifile:
+        index = json.load(ifile)
+    if not index.get('weights', False):
+        raise ValueError('The run did not record the weights of its '
+                         'configurations, see save_weights')
+
+    GX = [retarded_weiss(gb) for gb in g0_blocks]
+    log_ratio, signs, samples = [], [], []
+    for chain in range(len(index['files'])):
+        records, shape = load_ising_log(work_dir, chain)
+        fields = np.where(unpack_ising(records['v'], int(np.prod(shape))),
+                          1., -1.).reshape((-1,) + shape)
+        fields *= np.reshape(lam, (-1, 1))
+        walker = hffast.HFWalker(GX, np.copy(fields[0]), interaction,
+                                 np.shape(g0_blocks[0])[-1])
+        for record, field in zip(records, fields):
+            walker.v[:] = field
+            walker.clean()
+            walker.reset()
+            walker.measure()
+            sample = measurement_vector(walker)
+            # the ratio already carries the sign of the configuration
+            samples.append(sample[:-1] / sample[-1])
+            log_ratio.append(walker.logdet - record['logw'])
+            signs.append(walker.weight_sign * record['sign'])
+
+    ratio = np.array(signs) * np.exp(np.array(log_ratio) - max(log_ratio))
+    samples = np.array(samples)
+    blocks = np.array([np.append(np.dot(r, x), r.sum()) for r, x in
+                       zip(np.array_split(ratio, nbins),
+                           np.array_split(samples, nbins))])
+    mean, error = jackknife(blocks, lambda x: x[:-1] / x[-1])
+
+    output = {'ess': ratio.sum()**2 / np.sum(ratio**2),
+              'ess_fraction': ratio.sum()**2 / np.sum(ratio**2) / len(ratio),
+              'max_weight': abs(ratio).max() / abs(ratio.sum())}
+    start = 0
+    for name, array in [('gtau', walker.gtau),
+                        ('occupation', walker.occupation),
+                        ('double_occ', walker.double_occ)]:
+        end = start + array.size
+        output[name] = mean[start:end].reshape(array.shape)
+        output[name + '_err'] = error[start:end].reshape(array.shape)
+        start = end
+    return output
+
+
+def legendre_projector(n_coef, slices, beta):
+    r"""Projection of :math:`G(\tau)` on the time slices onto its first
+    Legendre coefficients
+
+    .. math:: G_l = \sqrt{2l+1}\int_0^\beta P_l(x(\tau)) G(\tau) d\tau
+
+    where :math:`G(\tau)` is linearly interpolated between the slices, the
+    integrals are exact by Gauss-Legendre quadrature on every interval. The
+    trapezoidal rule would instead leave an error growing as
+    :math:`l^2\Delta\tau^2` on the high coefficients. The missing edge is
+    :math:`G_{ab}(\beta^-) = -\delta_{ab} - G_{ab}(0^+)`, the term of
+    :math:`G(0^+)` is folded into the projector and the constant one is
+    returned apart, it only enters the diagonal blocks. See
+    :func:`dmft.common.legendre_gtau` for the inverse.
+
+    Parameters
+    ----------
+    n_coef : int
+        Number of Legendre coefficients
+    slices : int
+        Number of time slices
+    beta : float
+        Inverse temperature
+
+    Returns
+    -------
+    tuple
+        projector (n_coef, slices), constant of the diagonal blocks
+    """
+    nodes, weights = leggauss(n_coef // 2 + 2)
+    frac = (nodes + 1) / 2
+    x_in = 2 * (np.arange(slices).reshape(-1, 1) + frac) / slices - 1
+    # (slices, nodes, n_coef) Legendre polynomials inside every interval
+    p_in = legvander(x_in, n_coef - 1) * weights.reshape(-1, 1) / 2
+    left = np.sum(p_in * (1 - frac).reshape(-1, 1), 1)
+    right = np.sum(p_in * frac.reshape(-1, 1), 1)
+
+    scale = beta / slices * np.sqrt(2 * np.arange(n_coef) + 1)
+    projector = left.T.copy()
+    projector[:, 1:] += right[:-1].T
+    projector[:, 0] -= right[-1]
+    return scale.reshape(-1, 1) * projector, -scale * right[-1]
+
+
+def save_legendre(work_dir, stats, gtau_shape, beta, sign=1.):
+    """Stores the binned Legendre coefficients of :math:`G(\\tau)` in
+    ``legendre.npz``
+
+    Saves the coefficients ``gl``, their standard errors ``gl_err`` and
+    integrated autocorrelation times ``gl_tau`` in measurements, with the
+    coefficients along the last axis of the site blocks of ``gtau_shape``.
+    :func:`dmft.common.legendre_gtau` and :func:`dmft.common.legendre_giw`
+    evaluate the Green functions from them.
+
+    Parameters
+    ----------
+    work_dir : str
+    stats : dict
+        Output of :func:`dmft.mcstats.reduce_binnings` of the projected
+        measurements, see :func:`legendre_projector`
+    gtau_shape : tuple
+        Shape of the accumulated :math:`G(\\tau)`
+    beta : float
+    sign : float
+        Average sign of the measurements, the coefficients and their errors
+        are divided by it
+    """
+    shape = tuple(gtau_shape[:-1]) + (-1,)
+    g_l = stats['mean'].reshape(shape) / sign
+    offset = legendre_projector(g_l.shape[-1], gtau_shape[-1], beta)[1]
+    for site in range(g_l.shape[1]):
+        g_l[:, site, site] += offset
+    np.savez(os.path.join(work_dir, 'legendre'), gl=g_l,
+             gl_err=stats['error'].reshape(shape) / abs(sign),
+             gl_tau=stats['tau_int'].reshape(shape))
+
+
+def save_errors(work_dir, stats, shapes):
+    """Stores the binning analysis of a run in the file ``meas_errors.npz``
+
+    For every observable, ``gtau`` with the conventional sign, hole
+    ``occupation`` and ``double_occ`` it saves the mean, the standard error
+    ``_err``, the integrated autocorrelation time in measurements ``_tau``
+    and the jackknife bins ``_bins``. ``bin_weights`` are the number of
+    measurements in every bin.
+
+    The measurements are weighted by the sign, whose statistics are saved
+    as those of the observable ``sign``. The means and the bins are
+    divided by the average sign of all measurements and of every bin, and
+    the errors by the modulus of the average sign, which neglects its own
+    fluctuation.
+
+    Parameters
+    ----------
+    work_dir : str
+    stats : dict
+        Output of :func:`dmft.mcstats.reduce_binnings`
+    shapes : list
+        Shapes of the observables in the flattened measurement
+    """
+    output = {'bin_weights': stats['bin_weights']}
+    sign, sign_bins = stats['mean'][-1].real, stats['bins'][:, -1:].real
+    start = 0
+    for name, shape in zip(['gtau', 'occupation', 'double_occ'], shapes):
+        end = start + int(np.prod(shape))
+        output[name] = stats['mean'][start:end].reshape(shape) / sign
+        output[name + '_err'] = stats['error'][start:end].reshape(shape) / \
+            abs(sign)
+        output[name + '_tau'] = stats['tau_int'][start:end].reshape(shape)
+        output[name + '_bins'] = (stats['bins'][:, start:end] /
+                                  sign_bins).reshape((-1,) + tuple(shape))
+        start = end
+    output['sign'], output['sign_err'] = sign, stats['error'][-1].real
+    output['sign_tau'] = stats['tau_int'][-1].real
+    output['sign_bins'] = sign_bins[:, 0]
+    np.savez(os.path.join(work_dir, 'meas_errors'), **output)
 
 
 def retarded_weiss(g0tau):
@@ -379,7 +2054,8 @@ def setup_PM_sim(parms):
     parms['dtau_mc'] = tau[1]
     intm = interaction_matrix(parms.get('BANDS', 1))
     v = ising_v(parms['dtau_mc'], parms['U'], len(tau) * parms['SITES'],
-                intm.shape[1], parms['spin_polarization'])
+                intm.shape[1], parms['spin_polarization'],
+                np.random.RandomState(parms.get('SEED')))
 
     return tau, w_n, gtau, giw, v, intm
 
@@ -411,6 +2087,14 @@ def do_input(help_string):
                         help='Number of Updates before measurements')
     parser.add_argument('-Niter', metavar='N', type=int,
                         default=20, help='Number of iterations')
+    parser.add_argument('-group_size', type=int, default=0,
+                        help='Solve the points of the parameter sweep '
+                        'concurrently on groups of this many processes, '
+                        '0 solves them in turn on all of them')
+    parser.add_argument('-max_sweeps', type=int, default=0,
+                        help='Adapt the sweeps of the iterations from '
+                        'sweeps up to these to the convergence and stop '
+                        'at the QMC noise, 0 runs Niter fixed iterations')
     parser.add_argument('-U', '--urange', nargs='+', type=float, default=[2.5],
                         help='Local interaction strength')
     parser.add_argument('-mu', '--MU', type=float, default=0.,
@@ -420,8 +2104,27 @@ def do_input(help_string):
 
     parser.add_argument('-l', '--save_logs', action='store_true',
                         help='Store the changes in the auxiliary field')
-    parser.add_argument('-bin', '--binned_meas', action='store_true',
-                        help='Save measurements in binned intervals every therm updates')
+    parser.add_argument('-log_every', type=int, default=1,
+                        help='Measurements between records of the '
+                        'auxiliary field log')
+    parser.add_argument('-save_weights', action='store_true',
+                        help='Record the weights of the logged auxiliary '
+                        'fields for reweighting')
+    parser.add_argument('-legendre', type=int, default=0, metavar='NL',
+                        help='Legendre coefficients of G(tau) to measure, '
+                        '0 to disable')
+    parser.add_argument('-vertex', type=int, nargs=2, default=None,
+                        metavar=('NF', 'NB'),
+                        help='Measure the two-particle Green function on NF '
+                        'positive fermionic and NB bosonic frequencies')
+    parser.add_argument('-vertex_every', type=int, default=1,
+                        help='Measurements between vertex measurements')
+    parser.add_argument('-multigrid', type=int, default=0, metavar='L',
+                        help='Time slices of the fine grid the QMC Green '
+                        'function is reconstructed on, 0 to disable')
+    parser.add_argument('-trotter', type=float, nargs='+', metavar='SCALE',
+                        help='Extrapolate the converged solution to zero '
+                        'time step from slicings refined by these factors')
     parser.add_argument('-spin_polarization', type=float, default=0.5,
                         help='Probability distribution of up/down'
                         'auxiliary spins for initial guess')
@@ -429,6 +2132,33 @@ def do_input(help_string):
                         help='Perform a global flip of the auxiliary'
                         'Ising spins with a period equal to the'
                         'thermalization steps ')
+    parser.add_argument('-seed', '--SEED', type=int,
+                        default=struct.unpack("I", os.urandom(4))[0],
+                        help='Seed of all the random number streams')
     parser.add_argument('-M', '--Heat_bath', action='store_false',
                         help='Use Metropolis importance sampling')
+    parser.add_argument('-w', '--walkers_per_rank', type=int, default=1,
+                        help='Independent Markov chains run on threads '
+                        'by every MPI process')
+    parser.add_argument('-checkpoint', action='store_true',
+                        help='Store the Markov chains to warm start the '
+                        'next DMFT iteration or a resumed job')
+    parser.add_argument('-rtherm', '--rethermalize', type=int, default=None,
+                        help='Thermalization sweeps when the Markov chains '
+                        'are warm started from a checkpoint')
+    parser.add_argument('-k', '--delay', type=int, default=1,
+                        help='Number of accepted flips to store before '
+                        'updating the Green function matrices in one block')
+    parser.add_argument('-ctol', '--clean_tol', type=float, default=1e-8,
+                        help='Tolerated numerical drift of the fast updates, '
+                        'adapts the interval between clean updates')
+    parser.add_argument('-cmax', '--clean_max', type=int, default=5000,
+                        help='Most sweeps between clean updates')
+    parser.add_argument('-autotune', type=int, default=0, metavar='MEAS',
+                        help='Measurements of every trial of update '
+                        'settings tuned in the thermalization, 0 keeps the '
+                        'given ones')
+    parser.add_argument('-single', '--single_precision', action='store_true',
+                        help='Sweep on float32 Green functions, the clean '
+                        'updates and measurements stay in float64')
     return parser
@@ -1,89 +1,903 @@
 # -*- coding: utf-8 -*-
 
+from itertools import combinations, product
 import numpy as np
 cimport numpy as np
 import cython
-from libc.math cimport exp, sqrt
+from libc.math cimport exp, fabs, log, sqrt
+from libc.stdint cimport uint64_t
 from libcpp cimport bool
 
 
-cdef extern from "hfc.h":
+cdef extern from "hfc.h" nogil:
+    ctypedef struct xoshiro256:
+        uint64_t s[4]
+    void rng_seed(xoshiro256 *rng, uint64_t seed)
+    void rng_stream(xoshiro256 *rng, uint64_t seed, size_t rank, size_t stream)
+    double uniform "rng_uniform"(xoshiro256 *rng)
     void cgnew(size_t N, double *g, double dv, size_t k)
+    void cgnew(size_t N, double *g, double dv, size_t k, double *work)
+    void cgnew_ee(size_t N, double *g, double ee, size_t k, double *work)
     void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k)
+    void cg2flip(size_t N, double *g, double *dv, size_t l, size_t k,
+                 double *work, int *ipiv)
+    void cg2flip_ee(size_t N, double *g, double *ee, size_t l, size_t k,
+                    double *work, int *ipiv)
+    int cgnewclean(size_t N, double *g, double *g0, double *v,
+                   double *b, int *ipiv)
+    double cglulogdet(size_t N, double *lu, int *ipiv, double *sign)
+    double cglogdet(size_t N, double *g0, double *v, double *b, int *ipiv,
+                    double *sign)
+    double cgdiag(size_t N, double *g, double *X, double *Y, size_t m, size_t j)
+    void cgnew_delayed(size_t N, double *g, double dv, size_t k,
+                       double *X, double *Y, size_t m)
+    void cgnew_delayed_ee(size_t N, double *g, double ee, size_t k,
+                          double *X, double *Y, size_t m)
+    void cgflush(size_t N, double *g, double *X, double *Y, size_t m)
 
-def gnew(np.ndarray[np.float64_t, ndim=2] g, double dv, size_t k):
+    void cgnew_ee(size_t N, float *g, double ee, size_t k, float *work)
+    void cg2flip_ee(size_t N, float *g, double *ee, size_t l, size_t k,
+                    float *work, int *ipiv)
+    float cgdiag(size_t N, float *g, float *X, float *Y, size_t m, size_t j)
+    void cgnew_delayed_ee(size_t N, float *g, double ee, size_t k,
+                          float *X, float *Y, size_t m)
+    void cgflush(size_t N, float *g, float *X, float *Y, size_t m)
+
+    void cgnew(size_t N, double complex *g, double dv, size_t k)
+    void cgnew_ee(size_t N, double complex *g, double ee, size_t k,
+                  double complex *work)
+    void cg2flip(size_t N, double complex *g, double *dv, size_t l, size_t k)
+    void cg2flip_ee(size_t N, double complex *g, double *ee, size_t l,
+                    size_t k, double complex *work, int *ipiv)
+    int cgnewclean(size_t N, double complex *g, double complex *g0,
+                   double *v, double complex *b, int *ipiv)
+    double cglulogdet(size_t N, double complex *lu, int *ipiv,
+                      double complex *phase)
+    double cglogdet(size_t N, double complex *g0, double *v,
+                    double complex *b, int *ipiv, double complex *phase)
+    double complex cgdiag(size_t N, double complex *g, double complex *X,
+                          double complex *Y, size_t m, size_t j)
+    void cgnew_delayed_ee(size_t N, double complex *g, double ee, size_t k,
+                          double complex *X, double complex *Y, size_t m)
+    void cgflush(size_t N, double complex *g, double complex *X,
+                 double complex *Y, size_t m)
+
+ctypedef fused scalar:
+    double
+    double complex
+
+# The sweeps also run on single precision Green functions
+ctypedef fused green:
+    float
+    double
+    double complex
+
+# Real Green functions of either precision, cleaned from double precision
+ctypedef fused real_green:
+    float
+    double
+
+def gnew(np.ndarray[scalar, ndim=2] g, double dv, size_t k):
     cdef int N=g.shape[0]
     cgnew(N, &g[0,0], dv, k)
 
-def g2flip(np.ndarray[np.float64_t, ndim=2] g, double[::1] dv, size_t l, size_t k):
+def g2flip(np.ndarray[scalar, ndim=2] g, double[::1] dv, size_t l, size_t k):
     cdef int N=g.shape[0]
     cg2flip(N, &g[0,0], &dv[0], l, k)
 
+def gnewclean(np.ndarray[scalar, ndim=2] g0t, double[::1] v):
+    """Interacting Green function of the retarded Weiss field g0t and the
+    effective Ising fields v, see :func:`dmft.hirschfye.gnewclean`. Returns
+    a Fortran ordered array of the type of g0t"""
+    cdef int N = g0t.shape[0]
+    cdef np.ndarray[scalar, ndim=2, mode='fortran'] g0 = np.asfortranarray(g0t)
+    cdef np.ndarray[scalar, ndim=2, mode='fortran'] g = np.empty_like(g0)
+    cdef np.ndarray[scalar, ndim=2, mode='fortran'] b = np.empty_like(g0)
+    cdef np.ndarray[int, ndim=1] ipiv = np.empty(N, dtype=np.intc)
+    cgnewclean(N, &g[0, 0], &g0[0, 0], &v[0], &b[0, 0], &ipiv[0])
+    return g
 
-cdef extern from "gsl/gsl_rng.h":
-    ctypedef struct gsl_rng_type:
-        pass
-    ctypedef struct gsl_rng:
-        pass
-    gsl_rng_type *gsl_rng_mt19937
-    gsl_rng *gsl_rng_alloc(gsl_rng_type * T)
-    double uniform "gsl_rng_uniform"(gsl_rng *r)
-    void cyset_seed "gsl_rng_set"(gsl_rng *r, unsigned long int)
-
-cdef extern from "gsl/gsl_randist.h":
-    double normal "gsl_ran_gaussian"(gsl_rng *r, double sigma)
 
-cdef gsl_rng *r = gsl_rng_alloc(gsl_rng_mt19937)
+cdef xoshiro256 r
+rng_seed(&r, 0)
 
 def set_seed(seed):
-    cyset_seed(r, seed)
+    rng_seed(&r, seed)
+
+def rng_state(unsigned long seed, size_t rank=0, size_t stream=0):
+    """State of the random number stream of the seed for the chain stream
+    of the rank, as started by :class:`HFWalker`. :func:`updateDHS`
+    advances it in place"""
+    cdef xoshiro256 rng
+    rng_stream(&rng, seed, rank, stream)
+    return np.array(rng.s, dtype=np.uint64)
+
+
+cdef inline size_t work_size(size_t N, int delay) noexcept nogil:
+    """Scalars needed by the sweep kernel: 4 delay buffers of N*delay plus
+    the flip updates scratch space"""
+    return 4 * N * (delay if delay > 1 else 0) + 4 * N + 4
+
+cdef inline void flip_table(double lam, double cup, double cdw,
+                            double *ee) noexcept nogil:
+    """Flip factors exp(-2 c v) - 1 of the flavors up, dw coupled with
+    coefficients cup, cdw to the Ising field v = +-lam. In order: up for
+    positive and negative field, then dw for positive and negative field"""
+    ee[0] = exp(-2. * cup * lam) - 1.
+    ee[1] = exp( 2. * cup * lam) - 1.
+    ee[2] = exp(-2. * cdw * lam) - 1.
+    ee[3] = exp( 2. * cdw * lam) - 1.
+
+@cython.cdivision(True)
+cdef inline double weight_ratio(green rat, bint Heatbath,
+                                 int *nrat) noexcept nogil:
+    """Acceptance probability of the weight ratio, counting in nrat the
+    negative ones"""
+    cdef double prob, sign
+    if green is float or green is double:
+        prob = sign = rat
+    else:
+        prob, sign = abs(rat), rat.real
+    if sign < 0:
+        nrat[0] += 1
+    if Heatbath:
+        prob = prob/(1.+prob)
+    return prob
+
+cdef inline void track_weight(green rat, double *logw,
+                              double complex *phase) noexcept nogil:
+    """Adds to logw the logarithm of the modulus of the weight ratio of an
+    accepted flip and multiplies phase by its phase, a sign for real
+    ratios"""
+    if green is float or green is double:
+        logw[0] += log(fabs(rat))
+        if rat < 0:
+            phase[0] = -phase[0]
+    else:
+        logw[0] += log(abs(rat))
+        phase[0] *= rat / abs(rat)
+
+cdef inline double real_part(green x) noexcept nogil:
+    """Real part of the Green function entry x"""
+    if green is float or green is double:
+        return x
+    else:
+        return x.real
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def updateDHS(np.ndarray[np.float64_t, ndim=2] gup,
-              np.ndarray[np.float64_t, ndim=2] gdw,
-              np.ndarray[np.float64_t, ndim=1] v,
-              int subblock_len,
-              double double_flip_prob = 0.,
-              bool Heatbath = True):
-    cdef double dv, ratup, ratdw, rat
-    cdef int j, pair, sn, N=v.shape[0], acc = 0, nrat = 0
-    cdef int jns
-    cdef int[2] slic = [1, 1]
+cdef int sweep_pair(int N, green *gup, green *gdw, double *v, double *ee,
+                    int subblock_len, double double_flip_prob,
+                    bint Heatbath, int delay, xoshiro256 *rng,
+                    green *work, int *ipiv, int *nrat, double *logw,
+                    double complex *phase) noexcept nogil:
+    """Sweep over all the N Ising fields v of the flavor pair up, dw with
+    column major Green functions gup, gdw. ee is the table of flip factors
+    of the pair, see flip_table, the sweep evaluates no exponentials. work
+    holds work_size(N, delay) scalars and ipiv 2 integers. Returns the
+    accepted flips and adds to nrat the negative weight ratios found. The
+    weight ratios of the accepted flips are tracked into logw and phase,
+    see track_weight.
+
+    For complex Green functions the flips are accepted by the modulus of
+    the weight ratio and negative ratios are those of negative real part.
+    Single precision Green functions are updated in single precision."""
+    cdef green ratup, ratdw, rat
+    cdef double eeup, eedw, prob
+    cdef double[2] ee2
+    cdef int j, sn, sj, sk, acc = 0
+    cdef int jns, pend = 0
+    cdef green *Xup = work
+    cdef green *Yup = work + N * delay
+    cdef green *Xdw = work + 2 * N * delay
+    cdef green *Ydw = work + 3 * N * delay
+    cdef green *scratch = work + (4 * N * delay if delay > 1 else 0)
     sn = int(N/subblock_len)
+
     for j in range(N):
-        dv = -2.*v[j]
-        ratup = 1. + (1. - gup[j, j])*(exp( dv)-1.)
-        ratdw = 1. + (1. - gdw[j, j])*(exp(-dv)-1.)
-        if uniform(r)>double_flip_prob:
+        sj = 0 if v[j] > 0 else 1
+        eeup, eedw = ee[sj], ee[2 + sj]
+        if delay > 1:
+            ratup = 1. + (1. - cgdiag(N, gup, Xup, Yup, pend, j))*eeup
+            ratdw = 1. + (1. - cgdiag(N, gdw, Xdw, Ydw, pend, j))*eedw
+        else:
+            ratup = 1. + (1. - gup[j*N + j])*eeup
+            ratdw = 1. + (1. - gdw[j*N + j])*eedw
+        if uniform(rng)>double_flip_prob:
             rat = ratup * ratdw
-            if rat<0:
-                nrat += 1
-            if Heatbath:
-                rat = rat/(1.+rat)
-
-            if rat > uniform(r):
+            prob = weight_ratio(rat, Heatbath, nrat)
+            if prob > uniform(rng):
                 acc += 1
                 v[j] *= -1.
-                cgnew(N, &gup[0,0],  dv, j)
-                cgnew(N, &gdw[0,0], -dv, j)
+                track_weight(rat, logw, phase)
+                if delay > 1:
+                    cgnew_delayed_ee(N, gup, eeup, j, Xup, Yup, pend)
+                    cgnew_delayed_ee(N, gdw, eedw, j, Xdw, Ydw, pend)
+                    pend += 1
+                    if pend == delay:
+                        cgflush(N, gup, Xup, Yup, pend)
+                        cgflush(N, gdw, Xdw, Ydw, pend)
+                        pend = 0
+                else:
+                    cgnew_ee(N, gup, eeup, j, scratch)
+                    cgnew_ee(N, gdw, eedw, j, scratch)
         elif sn > 1:
+            if pend > 0:
+                cgflush(N, gup, Xup, Yup, pend)
+                cgflush(N, gdw, Xdw, Ydw, pend)
+                pend = 0
             jns = j+subblock_len if j<subblock_len else j-subblock_len
-            dv = -2.*v[jns]
-            ratup *= 1. + (1. - gup[jns, jns])*(exp( dv)-1.)
-            ratdw *= 1. + (1. - gdw[jns, jns])*(exp(-dv)-1.)
+            sk = 0 if v[jns] > 0 else 1
+            # determinants of the 2x2 blocks of the two flipped fields
+            ratup = ratup * (1. + (1. - gup[jns*N + jns])*ee[sk]) - \
+                gup[j*N + jns] * gup[jns*N + j] * eeup * ee[sk]
+            ratdw = ratdw * (1. + (1. - gdw[jns*N + jns])*ee[2 + sk]) - \
+                gdw[j*N + jns] * gdw[jns*N + j] * eedw * ee[2 + sk]
             rat = ratup * ratdw
+            prob = weight_ratio(rat, Heatbath, nrat)
+            if prob > uniform(rng):
+                acc += 1
+                v[j] *= -1.
+                v[jns] *= -1.
+                track_weight(rat, logw, phase)
+                ee2[0], ee2[1] = eeup, ee[sk]
+                cg2flip_ee(N, gup, ee2, j, jns, scratch, ipiv)
+                ee2[0], ee2[1] = eedw, ee[2 + sk]
+                cg2flip_ee(N, gdw, ee2, j, jns, scratch, ipiv)
+    if pend > 0:
+        cgflush(N, gup, Xup, Yup, pend)
+        cgflush(N, gdw, Xdw, Ydw, pend)
+    return acc
 
-            if rat<0:
-                nrat += 1
-            if Heatbath:
-                rat = rat/(1.+rat)
 
-            if rat > uniform(r):
-                acc += 1
-                slic = [j, jns]
-                v[slic] *= -1.
-                g2flip(gup,  2*v[slic], j, jns)
-                g2flip(gdw, -2*v[slic], j, jns)
+def sweep_workspace(size_t N, int delay=1, dtype=np.float64):
+    """Work array of :func:`updateDHS` for N fields and the delay, of the
+    type of the Green functions"""
+    return np.empty(work_size(N, delay), dtype=dtype)
+
+def updateDHS(np.ndarray[scalar, ndim=2] gup,
+              np.ndarray[scalar, ndim=2] gdw,
+              np.ndarray[np.float64_t, ndim=1] v,
+              int subblock_len,
+              double double_flip_prob = 0.,
+              bool Heatbath = True,
+              int delay = 1,
+              np.ndarray[scalar, ndim=1] work = None,
+              np.ndarray[np.uint64_t, ndim=1] rng = None):
+    """Sweep over all the auxiliary Ising fields of the pair of flavors
+    up, dw proposing single and double flips.
+
+    When delay > 1 accepted single flips are stored and applied to the
+    Green functions in blocks of delay rank-1 updates using one dgemm.
+    The Green functions are either float64 or complex128 arrays.
+
+    work is the workspace given by :func:`sweep_workspace`, allocated on
+    each call if not given. rng is a random number state of
+    :func:`rng_state`, advanced in place, by default the sweep draws from
+    the module stream of :func:`set_seed`"""
+    cdef int N=v.shape[0], acc, nrat = 0, i
+    cdef double logw = 0.
+    cdef double complex phase = 1.
+    cdef int[2] ipiv
+    cdef double[4] ee
+    cdef xoshiro256 own
+    cdef xoshiro256 *stream = &r
+    if work is None:
+        work = np.empty(work_size(N, delay), dtype=gup.dtype)
+    elif work.shape[0] < work_size(N, delay):
+        raise ValueError('The workspace needs {} scalars'.format(
+            work_size(N, delay)))
+    if rng is not None:
+        for i in range(4):
+            own.s[i] = rng[i]
+        stream = &own
+    flip_table(fabs(v[0]), 1., -1., ee)
+    acc = sweep_pair(N, &gup[0,0], &gdw[0,0], &v[0], ee, subblock_len,
+                     double_flip_prob, Heatbath, delay, stream,
+                     &work[0], ipiv, &nrat, &logw, &phase)
+    if rng is not None:
+        for i in range(4):
+            rng[i] = own.s[i]
     return acc, nrat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int sweep_fields(green[:, :, ::1] g, double[:, ::1] v,
+                      int[:, ::1] pairs, double[:, ::1] flip_ee,
+                      int slices, double double_flip_prob, bint Heatbath,
+                      int delay, xoshiro256 *rng, green[::1] work,
+                      int *ipiv, int *nrat, double *logw,
+                      double complex *phase) noexcept nogil:
+    """One sweep of sweep_pair over every auxiliary field v with the Green
+    functions g of its pair of flavors"""
+    cdef int i, acc = 0
+    for i in range(v.shape[0]):
+        acc += sweep_pair(g.shape[1], &g[pairs[i, 0], 0, 0],
+                          &g[pairs[i, 1], 0, 0], &v[i, 0], &flip_ee[i, 0],
+                          slices, double_flip_prob, Heatbath, delay, rng,
+                          &work[0], ipiv, nrat, logw, phase)
+    return acc
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void solve_flavor(int N, scalar *gx, double *int_v, scalar *b,
+                       scalar *gnew, int *ipiv, double *logdet,
+                       double complex *phase) noexcept nogil:
+    """Solves into gnew the Green function of the retarded Weiss field gx
+    and the effective Ising fields int_v. Adds the logarithm of the modulus
+    of det B to logdet and multiplies phase by its phase"""
+    cdef double sign
+    cdef double complex det_phase
+    cgnewclean(N, gnew, gx, int_v, b, ipiv)
+    if scalar is double:
+        logdet[0] += cglulogdet(N, b, ipiv, &sign)
+        phase[0] *= sign
+    else:
+        logdet[0] += cglulogdet(N, b, ipiv, &det_phase)
+        phase[0] *= det_phase
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double replace_green(int n, real_green *g, double *gnew) noexcept nogil:
+    """Copies the n entries of gnew into g, rounded for single precision.
+    Complex Green functions are passed as their interleaved real and
+    imaginary parts. Returns the largest absolute change of an entry"""
+    cdef int i
+    cdef double drift = 0.
+    for i in range(n):
+        drift = max(drift, fabs(g[i] - gnew[i]))
+        g[i] = gnew[i]
+    return drift
+
+
+cdef class HFWalker:
+    """Markov chain of the Hirsch-Fye impurity solver
+
+    The walker owns the interacting Green functions of all flavors, the
+    auxiliary Ising fields, its random number stream and all the
+    workspace the updates need, so that sweeping and measuring run without
+    heap allocations. The sweep, measurement and clean update release the
+    GIL, independent walkers can run concurrently on threads.
+
+    The Green function of each flavor is stored column major in the
+    flavor block of ``g``, thus ``g[f]`` is the transpose of the physical
+    matrix. :meth:`state` returns them in the physical orientation.
+
+    With ``single_precision`` the Green functions are stored and updated
+    in float32 during the sweeps, which halves their memory and its
+    traffic. The clean updates are still solved in float64 and rounded,
+    and the measurements accumulate in float64.
+
+    Complex Weiss fields, as of complex hybridizations, give complex128
+    Green functions. The flips are then accepted by the modulus of the
+    weight ratio and the walker tracks the phase of the weight in
+    ``weight_phase``, ``weight_sign`` is its real part. ``gtau`` and
+    ``ftau`` accumulate complex, the occupations, double occupations and
+    susceptibilities accumulate the real part of their estimators.
+
+    The chains sample the modulus of the weights, so every measurement is
+    accumulated times the phase of its configuration, the sign for real
+    Green functions, and ``sign_sum`` accumulates the real part of the
+    phases. The expectation values are the accumulators divided by
+    ``sign_sum``, which is the number of measurements ``nmeas`` only when
+    all weights are positive.
+
+    Parameters
+    ----------
+    gx_blocks : list of 2D ndarrays
+        Retarded Weiss fields of every flavor as given by
+        :func:`dmft.hirschfye.retarded_weiss`, real or complex
+    v : 2D ndarray (fields, N)
+        Auxiliary Ising fields. It is used in place and not copied when
+        it is a contiguous float64 array
+    interaction : 2D ndarray (flavors, fields)
+        Interaction matrix, see :func:`dmft.hirschfye.interaction_matrix`
+    slices : int
+        Number of time slices in each site block
+    seed : int
+        Seed of the random number generator, shared by all walkers of a
+        simulation
+    double_flip_prob : float
+        Probability of proposing a double flip on equal time slices
+    heatbath : bool
+        Use Heat bath acceptance instead of Metropolis
+    delay : int
+        Number of accepted flips applied as one block update
+    rank : int
+        Index of the MPI process, its streams start 2^192 numbers apart
+    stream : int
+        Index of the walker in the process, its stream starts 2^128
+        numbers apart
+    single_precision : bool
+        Sweep on float32 Green functions, only for real Weiss fields
+    """
+    cdef xoshiro256 rng
+    cdef readonly np.ndarray g, gx, v, int_v, interaction, pairs
+    cdef readonly np.ndarray gtau, ftau, occupation, double_occ, hdiag
+    cdef readonly np.ndarray exchange, density_corr
+    cdef readonly int N, slices, sites, flavors, fields, nmeas
+    cdef readonly double logdet, weight_sign, sign_sum
+    cdef readonly double complex weight_phase
+    cdef public double double_flip_prob
+    cdef public bint heatbath
+    cdef readonly bint single_precision
+    cdef np.ndarray work, b, gold, ipiv, occ_ind, docc_ind, flip_ee
+    cdef np.ndarray partners, dens, spin_charge, gtau_parts, ftau_parts
+    cdef int delay
+
+    def __init__(self, gx_blocks, v, interaction, int slices,
+                 unsigned long seed=0, double double_flip_prob=0.,
+                 bint heatbath=True, int delay=1, size_t rank=0,
+                 size_t stream=0, bint single_precision=False):
+        dtype = np.complex128 if np.iscomplexobj(gx_blocks) else np.float64
+        if single_precision and dtype == np.complex128:
+            raise ValueError('The single precision sweeps need real Weiss '
+                             'fields')
+        self.gx = np.array([gx.T for gx in gx_blocks], dtype=dtype)
+        self.flavors, self.N = self.gx.shape[0], self.gx.shape[1]
+        self.slices, self.sites = slices, self.N // slices
+        self.single_precision = single_precision
+        self.g = np.zeros_like(self.gx, dtype=np.float32 if single_precision
+                               else dtype)
+
+        self.v = np.ascontiguousarray(v, dtype=np.float64).reshape(-1, self.N)
+        self.interaction = np.ascontiguousarray(interaction, dtype=np.float64)
+        self.fields = self.v.shape[0]
+        self.pairs = np.array([c.nonzero()[0] for c in self.interaction.T],
+                              dtype=np.intc).reshape(-1, 2)
+        self.int_v = np.empty((self.flavors, self.N))
+        self.flip_ee = np.empty((self.fields, 4))
+        self.flip_tables()
+
+        self.double_flip_prob = double_flip_prob
+        self.heatbath = heatbath
+        self.delay = max(delay, 1)
+        self.work = np.empty(work_size(self.N, self.delay),
+                             dtype=self.g.dtype)
+        self.b = np.empty((self.N, self.N), dtype=dtype)
+        self.gold = np.empty((self.N, self.N), dtype=dtype)
+        self.ipiv = np.empty(self.N, dtype=np.intc)
+
+        flavors_ind = list(product(range(self.flavors), range(self.sites)))
+        self.occ_ind = np.array(flavors_ind, dtype=np.intc)
+        self.docc_ind = np.array(list(combinations(flavors_ind, 2)),
+                                 dtype=np.intc).reshape(-1, 4)
+        self.gtau = np.zeros((self.flavors, self.sites, self.sites, slices),
+                             dtype=dtype)
+        self.ftau = np.zeros_like(self.gtau)
+        # float64 views of the accumulators for the measurement kernel
+        self.gtau_parts = self.gtau.view(np.float64)
+        self.ftau_parts = self.ftau.view(np.float64)
+        self.partners = np.zeros((self.flavors, self.flavors))
+        for a, b in self.pairs:
+            self.partners[a, b] = self.partners[b, a] = 1.
+        self.dens = np.empty((self.sites, slices), dtype=self.g.dtype)
+        self.hdiag = np.zeros((self.flavors, self.sites, slices))
+        self.exchange = np.zeros((self.flavors, self.sites, slices))
+        self.spin_charge = np.empty((2, self.sites, slices),
+                                    dtype=self.g.dtype)
+        self.density_corr = np.zeros((2, self.sites, slices))
+        self.occupation = np.zeros(len(self.occ_ind))
+        self.double_occ = np.zeros(len(self.docc_ind))
+        self.nmeas, self.sign_sum = 0, 0.
+        rng_stream(&self.rng, seed, rank, stream)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void flip_tables(self):
+        """Tabulates the flip factors of every field with the coefficients
+        of its pair of flavors in the interaction matrix. The Ising fields
+        of each auxiliary field are taken to be all of the same magnitude."""
+        cdef int i
+        cdef double[:, ::1] v = self.v, interaction = self.interaction
+        cdef double[:, ::1] flip_ee = self.flip_ee
+        cdef int[:, ::1] pairs = self.pairs
+        for i in range(self.fields):
+            flip_table(fabs(v[i, 0]), interaction[pairs[i, 0], i],
+                       interaction[pairs[i, 1], i], &flip_ee[i, 0])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def clean(self):
+        """Recalculates from scratch the interacting Green functions
+
+        On the way it sets ``logdet``, ``weight_phase`` and ``weight_sign``,
+        the logarithm of the modulus, the phase and the sign of the weight
+        :math:`\\prod_f \\det B_f` of the configuration, see
+        :meth:`log_weight`. Single precision Green functions are
+        recalculated in double precision and then rounded.
+
+        Returns
+        -------
+        float
+            Largest absolute deviation of the fast updated Green functions
+            from the recalculated ones, the accumulated numerical drift. For
+            complex Green functions that of their real and imaginary parts
+        """
+        cdef int f, i, j
+        cdef int N = self.N, fields = self.fields
+        cdef double[:, ::1] int_v = self.int_v, v = self.v
+        cdef double[:, ::1] interaction = self.interaction
+        cdef double[:, :, ::1] g, gx
+        cdef float[:, :, ::1] gs
+        cdef double complex[:, :, ::1] gz, gxz
+        cdef double[:, ::1] b, gold
+        cdef double complex[:, ::1] bz, goldz
+        cdef int[::1] ipiv = self.ipiv
+        cdef double drift = 0., logdet = 0.
+        cdef double complex phase = 1.
+        cdef bint single = self.single_precision
+        cdef bint cplx = self.gx.dtype == np.complex128
+        if cplx:
+            gz, gxz, bz, goldz = self.g, self.gx, self.b, self.gold
+        else:
+            gx, b, gold = self.gx, self.b, self.gold
+            if single:
+                gs = self.g
+            else:
+                g = self.g
+
+        self.flip_tables()
+        with nogil:
+            for f in range(self.flavors):
+                for j in range(N):
+                    int_v[f, j] = 0.
+                for i in range(fields):
+                    if interaction[f, i] != 0.:
+                        for j in range(N):
+                            int_v[f, j] += interaction[f, i] * v[i, j]
+                if cplx:
+                    solve_flavor(N, &gxz[f, 0, 0], &int_v[f, 0], &bz[0, 0],
+                                 &goldz[0, 0], &ipiv[0], &logdet, &phase)
+                    drift = max(drift, replace_green(
+                        2 * N * N, <double *> &gz[f, 0, 0],
+                        <double *> &goldz[0, 0]))
+                    continue
+                solve_flavor(N, &gx[f, 0, 0], &int_v[f, 0], &b[0, 0],
+                             &gold[0, 0], &ipiv[0], &logdet, &phase)
+                if single:
+                    drift = max(drift, replace_green(N * N, &gs[f, 0, 0],
+                                                     &gold[0, 0]))
+                else:
+                    drift = max(drift, replace_green(N * N, &g[f, 0, 0],
+                                                     &gold[0, 0]))
+        self.logdet, self.weight_phase = logdet, phase
+        self.weight_sign = phase.real
+        return drift
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def log_weight(self, spins):
+        """Logarithm and sign of the weight of a configuration of Ising
+        spins for the Weiss fields and couplings of this walker
+
+        The weight is :math:`\\prod_f \\det B_f` up to the constant
+        :math:`\\prod_f \\det \\mathcal{G}^0_f`, with :math:`B_f` as in
+        :func:`dmft.hirschfye.gnewclean` for the fields of magnitude of the
+        walker and the signs of ``spins``. Walkers at different
+        interactions thus weigh each other's configurations.
+
+        Parameters
+        ----------
+        spins : 2D ndarray (fields, N)
+
+        Returns
+        -------
+        tuple (log abs weight, sign)
+            For complex Weiss fields the sign is the real part of the phase
+            of the weight
+        """
+        cdef int f
+        cdef int N = self.N
+        cdef double[:, ::1] int_v = np.dot(
+            self.interaction, np.sign(spins) * np.abs(self.v))
+        cdef double[:, :, ::1] gx
+        cdef double[:, ::1] b
+        cdef double complex[:, :, ::1] gxz
+        cdef double complex[:, ::1] bz
+        cdef int[::1] ipiv = self.ipiv
+        cdef double logdet = 0., sign
+        cdef double complex phase = 1., det_phase
+        cdef bint cplx = self.gx.dtype == np.complex128
+        if cplx:
+            gxz, bz = self.gx, self.b
+        else:
+            gx, b = self.gx, self.b
+
+        with nogil:
+            for f in range(self.flavors):
+                if cplx:
+                    logdet += cglogdet(N, &gxz[f, 0, 0], &int_v[f, 0],
+                                       &bz[0, 0], &ipiv[0], &det_phase)
+                    phase *= det_phase
+                else:
+                    logdet += cglogdet(N, &gx[f, 0, 0], &int_v[f, 0],
+                                       &b[0, 0], &ipiv[0], &sign)
+                    phase *= sign
+        return logdet, phase.real
+
+    def uniform(self):
+        """Draws a uniform random number in [0, 1) from the stream of the
+        walker"""
+        return uniform(&self.rng)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def sweep(self, int n=1):
+        """Performs n sweeps over all the auxiliary fields
+
+        The weight ratios of the accepted flips keep ``logdet``,
+        ``weight_phase`` and ``weight_sign`` up to date with the
+        configuration between the clean updates.
+
+        Returns
+        -------
+        tuple (accepted flips, negative weight ratios)
+        """
+        cdef int s, acc = 0, nrat = 0
+        cdef double logw = self.logdet
+        cdef double complex phase = self.weight_phase
+        cdef int slices = self.slices, delay = self.delay
+        cdef double double_flip_prob = self.double_flip_prob
+        cdef bint heatbath = self.heatbath
+        cdef xoshiro256 *rng = &self.rng
+        cdef double[:, :, ::1] g
+        cdef float[:, :, ::1] gs
+        cdef double complex[:, :, ::1] gz
+        cdef double[::1] work
+        cdef float[::1] works
+        cdef double complex[::1] workz
+        cdef double[:, ::1] v = self.v
+        cdef int[:, ::1] pairs = self.pairs
+        cdef double[:, ::1] flip_ee = self.flip_ee
+        cdef int[::1] ipiv = self.ipiv
+        cdef bint single = self.single_precision
+        cdef bint cplx = self.g.dtype == np.complex128
+        if cplx:
+            gz, workz = self.g, self.work
+        elif single:
+            gs, works = self.g, self.work
+        else:
+            g, work = self.g, self.work
+
+        with nogil:
+            for s in range(n):
+                if cplx:
+                    acc += sweep_fields(gz, v, pairs, flip_ee, slices,
+                                        double_flip_prob, heatbath, delay,
+                                        rng, workz, &ipiv[0], &nrat, &logw,
+                                        &phase)
+                elif single:
+                    acc += sweep_fields(gs, v, pairs, flip_ee, slices,
+                                        double_flip_prob, heatbath, delay,
+                                        rng, works, &ipiv[0], &nrat, &logw,
+                                        &phase)
+                else:
+                    acc += sweep_fields(g, v, pairs, flip_ee, slices,
+                                        double_flip_prob, heatbath, delay,
+                                        rng, work, &ipiv[0], &nrat, &logw,
+                                        &phase)
+        self.logdet, self.weight_phase = logw, phase
+        self.weight_sign = phase.real
+        return acc, nrat
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def measure(self):
+        """Accumulates in one pass over the Green functions of the current
+        configuration the translationally averaged :math:`G(\\tau)` of
+        every site block, the orbital occupations and the density-density
+        correlators.
+
+        For the improved estimator of the self-energy it accumulates
+        :math:`F(\\tau)/U`, the correlator
+        :math:`\\langle (n_{\\bar{f}}(\\tau) - 1/2) c_f(\\tau) c^\\dagger_f \\rangle`
+        with the density of the flavors interacting with :math:`f` on the
+        same site, translationally averaged as :math:`G(\\tau)`. The density
+        is taken at :math:`\\tau - \\Delta\\tau/2`, the average of the
+        slices of :math:`\\tau` and the one before, which cancels the first
+        order Trotter error of the equal time product.
+
+        For the local susceptibilities it accumulates the exchange term
+        :math:`\\sum_t G(t+\\tau, t)G(t, t+\\tau)` of every flavor and site and
+        in ``density_corr`` the circular autocorrelations
+        :math:`\\sum_t m(t+\\tau)m(t)` and :math:`\\sum_t q(t+\\tau)q(t)`
+        of the magnetization and charge of the holes
+
+        .. math:: m(\\tau) = \\frac{1}{2}(h_\\downarrow - h_\\uparrow)
+            \\quad q(\\tau) = h_\\uparrow + h_\\downarrow
+
+        of every site, even flavors are spin up and odd ones spin down. The
+        equal time Green function of the configuration is left in
+        ``hdiag``.
+
+        All of them are accumulated times the phase of the configuration,
+        whose real part is added to ``sign_sum``.
+
+        As in the rest of the Hirsch-Fye solver the sign of the Green
+        functions is reversed, the accumulated quantities are of the
+        holes, :math:`1 - n`."""
+        cdef double[:, :, ::1] g
+        cdef float[:, :, ::1] gs
+        cdef double complex[:, :, ::1] gz
+        cdef double[:, :, :, ::1] gtau = self.gtau_parts
+        cdef double[:, :, :, ::1] ftau = self.ftau_parts
+        if self.g.dtype == np.complex128:
+            gz = self.g
+            accumulate(self, gz, gtau, ftau)
+        elif self.single_precision:
+            gs = self.g
+            accumulate(self, gs, gtau, ftau)
+        else:
+            g = self.g
+            accumulate(self, g, gtau, ftau)
+        self.nmeas += 1
+        self.sign_sum += self.weight_sign
+
+    def reset(self):
+        """Empties the measurement accumulators"""
+        self.gtau[:] = 0.
+        self.ftau[:] = 0.
+        self.exchange[:] = 0.
+        self.density_corr[:] = 0.
+        self.occupation[:] = 0.
+        self.double_occ[:] = 0.
+        self.nmeas, self.sign_sum = 0, 0.
+
+    def state(self):
+        """Returns a copy of the walker state
+
+        Returns
+        -------
+        dict
+            Green functions ``g``, Ising fields ``v``, random number
+            generator state ``rng`` and the measurement accumulators
+        """
+        return {'g': self.g.transpose(0, 2, 1).copy(),
+                'v': self.v.copy(),
+                'rng': np.array(self.rng.s, dtype=np.uint64),
+                'gtau': self.gtau.copy(),
+                'ftau': self.ftau.copy(),
+                'exchange': self.exchange.copy(),
+                'density_corr': self.density_corr.copy(),
+                'occupation': self.occupation.copy(),
+                'double_occ': self.double_occ.copy(),
+                'nmeas': self.nmeas,
+                'sign_sum': self.sign_sum}
+
+    def load_state(self, state, bint rng=True, bint accumulators=True):
+        """Restores the walker from a state given by :meth:`state`
+
+        The Green functions are not restored, call :meth:`clean` after
+        loading a state.
+
+        Parameters
+        ----------
+        state : dict
+        rng : bool
+            Restore the random number generator state
+        accumulators : bool
+            Restore the measurement accumulators to continue measuring
+            with the same Weiss field
+        """
+        self.v[:] = state['v']
+        if rng:
+            self.set_rng_state(state['rng'])
+        if accumulators:
+            self.gtau[:] = state['gtau']
+            self.ftau[:] = state['ftau']
+            self.exchange[:] = state['exchange']
+            self.density_corr[:] = state['density_corr']
+            self.occupation[:] = state['occupation']
+            self.double_occ[:] = state['double_occ']
+            self.nmeas = state['nmeas']
+            self.sign_sum = state['sign_sum']
+
+    def set_rng_state(self, rng_state):
+        """Restores the random number generator state as given by
+        :meth:`state`"""
+        cdef int i
+        rng_state = np.asarray(rng_state, dtype=np.uint64)
+        for i in range(4):
+            self.rng.s[i] = rng_state[i]
+
+
+cdef inline void add_lag(double *acc, int k, green x) noexcept nogil:
+    """Adds x to the entry k of the accumulator acc, which holds the
+    interleaved real and imaginary parts of complex entries"""
+    if green is float or green is double:
+        acc[k] += x
+    else:
+        acc[2 * k] += x.real
+        acc[2 * k + 1] += x.imag
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void accumulate(HFWalker walker, green[:, :, ::1] g,
+                     double[:, :, :, ::1] gtau, double[:, :, :, ::1] ftau):
+    """Measurement kernel of :meth:`HFWalker.measure` on the Green functions
+    g of either precision into the float64 views gtau, ftau of the
+    accumulators of the walker, see add_lag. The other accumulators are
+    double and take the real part of their estimators. All estimators are
+    weighted by the phase of the configuration"""
+    cdef int f, a, b, i, j, k, t, oi, oj, fi, fj
+    cdef int N = walker.N, L = walker.slices, flavors = walker.flavors
+    cdef int sites = walker.sites
+    cdef double[:, :, ::1] hdiag = walker.hdiag, exchange = walker.exchange
+    cdef green[:, :, ::1] spin_charge = walker.spin_charge
+    cdef double[:, :, ::1] density_corr = walker.density_corr
+    cdef double[:, ::1] partners = walker.partners
+    cdef green[:, ::1] dens = walker.dens
+    cdef double[::1] occupation = walker.occupation
+    cdef double[::1] double_occ = walker.double_occ
+    cdef int[:, ::1] occ_ind = walker.occ_ind, docc_ind = walker.docc_ind
+    cdef double *gt
+    cdef double *ft
+    cdef green p
+    if green is float or green is double:
+        p = walker.weight_sign
+    else:
+        p = walker.weight_phase
+
+    with nogil:
+        # g[f] is column major, g[f, j, i] is the entry i, j
+        for f in range(flavors):
+            for a in range(sites):
+                oi = a * L
+                for j in range(L):
+                    hdiag[f, a, j] = real_part(g[f, oi + j, oi + j])
+        # magnetization and charge of the holes and their autocorrelations
+        for a in range(sites):
+            for t in range(L):
+                spin_charge[0, a, t] = 0.
+                spin_charge[1, a, t] = 0.
+                for f in range(flavors):
+                    spin_charge[0, a, t] += (0.5 if f % 2 else -0.5) * \
+                        g[f, a*L + t, a*L + t]
+                    spin_charge[1, a, t] += g[f, a*L + t, a*L + t]
+            for k in range(2):
+                for j in range(L):
+                    for t in range(L):
+                        i = t + j if t + j < L else t + j - L
+                        density_corr[k, a, j] += real_part(
+                            p * spin_charge[k, a, i] * spin_charge[k, a, t])
+        for f in range(flavors):
+            # n - 1/2 of the interacting flavors, g holds the holes
+            for a in range(sites):
+                for i in range(L):
+                    t = i - 1 if i > 0 else L - 1
+                    dens[a, i] = 0.
+                    for fi in range(flavors):
+                        dens[a, i] += partners[f, fi] * (0.5 - 0.5 * (
+                            g[fi, a*L + i, a*L + i] + g[fi, a*L + t, a*L + t]))
+                    dens[a, i] *= p
+            for a in range(sites):
+                for b in range(sites):
+                    gt, ft = &gtau[f, a, b, 0], &ftau[f, a, b, 0]
+                    for j in range(L):
+                        for i in range(j):
+                            add_lag(gt, L + i - j, -p * g[f, b*L + j, a*L + i])
+                            add_lag(ft, L + i - j, -dens[a, i] * g[f, b*L + j, a*L + i])
+                        for i in range(j, L):
+                            add_lag(gt, i - j, p * g[f, b*L + j, a*L + i])
+                            add_lag(ft, i - j, dens[a, i] * g[f, b*L + j, a*L + i])
+                oi = a * L
+                for j in range(L):
+                    exchange[f, a, 0] -= real_part(p * g[f, oi + j, oi + j])
+                    for i in range(j):
+                        exchange[f, a, L + i - j] += real_part(p * g[f, oi + j, oi + i] * g[f, oi + i, oi + j])
+                    for i in range(j, L):
+                        exchange[f, a, i - j] += real_part(p * g[f, oi + j, oi + i] * g[f, oi + i, oi + j])
+        for k in range(occ_ind.shape[0]):
+            f, oi = occ_ind[k, 0], occ_ind[k, 1] * L
+            for t in range(L):
+                occupation[k] += real_part(p * g[f, oi + t, oi + t])
+        for k in range(docc_ind.shape[0]):
+            fi, oi = docc_ind[k, 0], docc_ind[k, 1] * L
+            fj, oj = docc_ind[k, 2], docc_ind[k, 3] * L
+            for t in range(L):
+                double_occ[k] += real_part(p * g[fi, oi + t, oi + t] * g[fj, oj + t, oj + t])
+                if fi == fj:  # exchange term within the same flavor
+                    double_occ[k] -= real_part(p * g[fi, oi + t, oj + t] * g[fi, oj + t, oi + t])
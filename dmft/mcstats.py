@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+r"""
+Statistics of Monte Carlo time series
+=====================================
+
+Streaming logarithmic binning to estimate the standard errors and
+integrated autocorrelation times of correlated measurements, and the
+jackknife to propagate them into derived quantities.
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+
+
+class LogBinning(object):
+    r"""Streaming logarithmic binning accumulator
+
+    Every measurement enters the level 0 and every two consecutive bins of
+    a level are averaged into a bin of the next level, such that the level
+    :math:`l` holds bins of :math:`2^l` measurements. Only the sums and
+    squared sums of each level are kept, the memory grows with the
+    logarithm of the number of measurements.
+
+    For the jackknife a fixed number of coarse bins is kept. When they are
+    all filled adjacent pairs are merged and the bin size doubles.
+
+    Complex measurements are binned as the pairs of their real and
+    imaginary parts, the real and imaginary parts of the errors and
+    autocorrelation times are those of the respective parts.
+
+    Parameters
+    ----------
+    size : int
+        Number of observables in each measurement
+    nbins : int
+        Maximum number of jackknife bins, it must be even
+    dtype : dtype
+        Type of the measurements, float or complex
+    """
+
+    def __init__(self, size, nbins=64, dtype=float):
+        self.size = size
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.sums = []
+        self.sqsums = []
+        self.nlevel = []
+        self.pending = []
+        self.waiting = []
+        self.square = np.empty(size, self.dtype)
+        self.bins = np.zeros((nbins, size), self.dtype)
+        self.filled = 0
+        self.bin_size = 1
+        self.block = np.zeros(size, self.dtype)
+        self.block_n = 0
+
+    def add(self, value):
+        """Adds the measurement of all observables
+
+        The measurement is not kept, the caller may reuse its array. Once
+        all the levels exist the accumulation works in place."""
+        value = np.asarray(value, dtype=self.dtype).reshape(self.size)
+        self.count += 1
+
+        self.block += value
+        self.block_n += 1
+        if self.block_n == self.bin_size:
+            np.divide(self.block, self.bin_size, out=self.bins[self.filled])
+            self.filled += 1
+            self.block[:] = 0.
+            self.block_n = 0
+            if self.filled == len(self.bins):
+                half = self.filled // 2
+                self.bins[:half] = 0.5 * (self.bins[::2] + self.bins[1::2])
+                self.filled = half
+                self.bin_size *= 2
+
+        level = 0
+        while True:
+            if level == len(self.sums):
+                self.sums.append(np.zeros(self.size, self.dtype))
+                self.sqsums.append(np.zeros(self.size, self.dtype))
+                self.nlevel.append(0)
+                self.pending.append(np.empty(self.size, self.dtype))
+                self.waiting.append(False)
+            self.sums[level] += value
+            if self.dtype.kind == 'c':
+                np.square(value.real, out=self.square.real)
+                np.square(value.imag, out=self.square.imag)
+            else:
+                np.square(value, out=self.square)
+            self.sqsums[level] += self.square
+            self.nlevel[level] += 1
+            if not self.waiting[level]:
+                self.pending[level][:] = value
+                self.waiting[level] = True
+                break
+            # the pair average moves up in the pending buffer, which is free
+            # again until the next measurement reaches this level
+            value, pending = self.pending[level], value
+            value += pending
+            value *= 0.5
+            self.waiting[level] = False
+            level += 1
+
+    @property
+    def mean(self):
+        """Average of the measurements"""
+        return self.sums[0] / self.count
+
+    def level_errors(self):
+        """Naive standard error of the mean at every binning level"""
+        return level_errors(self.sums, self.sqsums, self.nlevel)
+
+    def error(self, min_bins=32):
+        """Standard error of the mean, see :func:`binning_error`"""
+        return binning_error(self.level_errors(), self.nlevel, min_bins)[0]
+
+    def tau_int(self, min_bins=32):
+        """Integrated autocorrelation time, see :func:`binning_error`"""
+        return binning_error(self.level_errors(), self.nlevel, min_bins)[1]
+
+    def jackknife_bins(self):
+        """The filled jackknife bins and their number of measurements"""
+        return self.bins[:self.filled], np.repeat(self.bin_size, self.filled)
+
+
+def level_errors(sums, sqsums, nlevel):
+    """Naive standard error of the mean from the sums of the bins of each
+    binning level
+
+    Levels with less than two bins have an infinite error.
+    """
+    infinite = complex(np.inf, np.inf) if np.iscomplexobj(sums[0]) else np.inf
+    errors = np.full((len(sums), len(sums[0])), infinite,
+                     np.result_type(sums[0]))
+    for level, (lsum, lsqsum, nbins) in enumerate(zip(sums, sqsums, nlevel)):
+        if nbins > 1:
+            var = lsqsum / nbins - by_parts(np.square, lsum / nbins)
+            errors[level] = by_parts(
+                lambda x: np.sqrt(np.clip(x, 0, None) / (nbins - 1)), var)
+    return errors
+
+
+def binning_error(errors, nlevel, min_bins=32):
+    r"""Standard error and integrated autocorrelation time from the binning
+    analysis
+
+    The error is read at the coarsest level that still has ``min_bins``
+    bins, where it is expected to have reached its plateau. Then
+
+    .. math:: \tau_{int} = \frac{1}{2}\left(\frac{\sigma_l^2}{\sigma_0^2}
+        - 1\right)
+
+    in units of the measurement interval.
+
+    Parameters
+    ----------
+    errors : ndarray (levels, observables)
+        Standard errors of every binning level, see :func:`level_errors`
+    nlevel : list
+        Number of bins in every level
+    min_bins : int
+
+    Returns
+    -------
+    tuple
+        standard error, integrated autocorrelation time
+    """
+    usable = [lev for lev, nbins in enumerate(nlevel) if nbins >= min_bins]
+    level = usable[-1] if usable else 0
+    error = errors[level]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = by_parts(lambda err, err0: 0.5 * (err**2 / err0**2 - 1),
+                       error, errors[0])
+    return error, np.nan_to_num(tau)
+
+
+def reduce_binnings(binnings, min_bins=32):
+    """Joins the accumulators of independent Markov chains
+
+    The bins of the same level of all chains are pooled, and all jackknife
+    bins are collected.
+
+    Parameters
+    ----------
+    binnings : list of :class:`LogBinning`
+    min_bins : int
+
+    Returns
+    -------
+    dict
+        ``mean``, ``error``, ``tau_int`` of every observable, ``bins`` and
+        ``bin_weights``, the jackknife bins and their number of measurements
+    """
+    levels = min(len(binning.sums) for binning in binnings)
+    sums = [sum(binning.sums[lev] for binning in binnings)
+            for lev in range(levels)]
+    sqsums = [sum(binning.sqsums[lev] for binning in binnings)
+              for lev in range(levels)]
+    nlevel = [sum(binning.nlevel[lev] for binning in binnings)
+              for lev in range(levels)]
+    error, tau = binning_error(level_errors(sums, sqsums, nlevel), nlevel,
+                               min_bins)
+    bins, weights = zip(*[binning.jackknife_bins() for binning in binnings])
+
+    return {'mean': sums[0] / nlevel[0],
+            'error': error,
+            'tau_int': tau,
+            'bins': np.concatenate(bins),
+            'bin_weights': np.concatenate(weights)}
+
+
+def jackknife(bins, func, weights=None):
+    r"""Jackknife estimate and error of a function of averages
+
+    The function is evaluated on the averages leaving out every bin in turn
+
+    .. math:: f_i = f(\bar{x}_{(i)}) \quad
+        \sigma_f^2 = \frac{n-1}{n}\sum_i (f_i - \bar{f})^2
+
+    and the estimate is corrected for its bias
+    :math:`n f(\bar{x}) - (n-1)\bar{f}`. For complex functions the real
+    and imaginary parts of the error are those of the respective parts.
+
+    Parameters
+    ----------
+    bins : ndarray
+        Bin averages, first axis enumerates the bins
+    func : callable
+        Function of one averaged bin
+    weights : 1D ndarray, optional
+        Number of measurements of each bin
+
+    Returns
+    -------
+    tuple
+        estimate, error
+    """
+    bins = np.asarray(bins)
+    nbins = len(bins)
+    weights = np.ones(nbins) if weights is None else np.asarray(weights, float)
+    total = np.tensordot(weights, bins, 1)
+    shape = (-1,) + (1,) * (bins.ndim - 1)
+    leave_out = (total - weights.reshape(shape) * bins) / \
+        (weights.sum() - weights).reshape(shape)
+
+    samples = np.array([func(sample) for sample in leave_out])
+    sample_mean = samples.mean(0)
+    estimate = nbins * func(total / weights.sum()) - \
+        (nbins - 1) * sample_mean
+
+    deviation = samples - sample_mean
+    norm = (nbins - 1) / nbins
+    error = np.sqrt(norm * np.sum(deviation.real**2, 0))
+    if np.iscomplexobj(samples):
+        error = error + 1j * np.sqrt(norm * np.sum(deviation.imag**2, 0))
+    return estimate, error
+
+
+def by_parts(func, *arrays):
+    """Applies the real function func to the real parts and to the
+    imaginary parts of complex arrays apart, and to real arrays as they
+    are"""
+    if np.iscomplexobj(arrays[0]):
+        return func(*[np.real(x) for x in arrays]) + \
+            1j * func(*[np.imag(x) for x in arrays])
+    return func(*arrays)
@@ -179,6 +179,48 @@ def gf_tail(gtau, U, mu, tp):
     return gtail
 
 
+def ftau_tail(gtau, U, g_tail):
+    """First 3 moments of the tail of the improved estimator
+    :math:`F = \\Sigma G` from the local self-energy moments and those of
+    the Green function g_tail"""
+    n_site = 1 + np.diag(gtau[:, :, 0])
+    sigma_0 = np.diag(U * (n_site - 0.5))
+    sigma_1 = np.diag(U**2 * n_site * (1 - n_site))
+    return [sigma_0.reshape(2, 2, 1),
+            (sigma_0.dot(g_tail[1][:, :, 0]) + sigma_1).reshape(2, 2, 1),
+            np.zeros((2, 2, 1))]
+
+
+def get_sigmaiw_improved(gtau, ftau, tau, w_n, setup):
+    """Calculates the Self-Energy in Matsubara Frequencies from the
+    improved estimator, see :func:`dmft.hirschfye.improved_sigma`
+
+    Parameters
+    ----------
+    gtau : real ndarray
+            Imaginary time Green function of one spin, as stored
+    ftau : real ndarray
+            Improved estimator of the same spin, as stored
+    tau : real float array
+            Imaginary time points
+    w_n : real float array
+            fermionic matsubara frequencies. Only use the positive ones
+    setup : dictionary about simulation parameters
+
+    Returns
+    -------
+    complex ndarray
+            Self-Energy in matsubara frequencies in matrix shape
+    """
+    # The solver needs MPI and the compiled extension, not the plots
+    from dmft.hirschfye import improved_sigma
+
+    gtau, ftau = gtau.reshape(2, 2, -1), ftau.reshape(2, 2, -1)
+    g_tail = gf_tail(gtau, setup['U'], setup['MU'], setup['tp'])
+    return improved_sigma(gtau, ftau, tau, w_n, g_tail,
+                          ftau_tail(gtau, setup['U'], g_tail))
+
+
 def plot_it(BETA, u_int, tp, it, flavor, simt, filestr='DIMER_{simt}_B{BETA}_tp{tp}', axes=None):
     """Plot the evolution of the Green's function in DMFT iterations
 
@@ -7,13 +7,13 @@ Plotting utilities for the Single site DMFT phase diagram
 from __future__ import division, print_function, absolute_import
 import json
 import os
-from glob import glob
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.interpolate import interp1d
 import dmft.common as gf
 import dmft.ipt_imag as ipt
 import dmft.h5archive as h5
+from dmft.mcstats import jackknife
 plt.matplotlib.rcParams.update({'figure.figsize': (8, 8), 'axes.labelsize': 22,
                                 'axes.titlesize': 22, 'figure.autolayout': True})
 
@@ -147,6 +147,30 @@ def get_sigmaiw(h5parent, iteration, tau, w_n):
     return 1j * w_n - .25 * giw - 1 / giw
 
 
+def ftau_tail(gtau, U, g_tail):
+    r"""Estimates the first 3 moments of the tail of the improved estimator
+    :math:`F = \Sigma G` from those of the self-energy, see
+    :func:`gf_tail`, and of the Green function g_tail"""
+    g_t0 = gtau[0] if len(gtau.shape) == 1 else gtau[::-1, 0].reshape(2, 1)
+    n_bar = 1 + g_t0
+    sigma_0 = U * (n_bar - 0.5)
+    return [sigma_0, sigma_0 * g_tail[1] + U**2 * n_bar * (1 - n_bar), 0.]
+
+
+def get_sigmaiw_improved(sim_dir, iteration_slice, tau, w_n, setup):
+    """Returns the self-energy with the improved estimator stored by the
+    solver, see :func:`dmft.hirschfye.improved_sigma`"""
+    gtau = averager(sim_dir, 'gtau.npy', iteration_slice)
+    ftau = np.squeeze(averager(sim_dir, 'ftau.npy', iteration_slice))
+    if len(gtau.shape) == 1:  # paramagnetic, spin averaged
+        ftau = ftau.mean(0)
+    g_tail = gf_tail(gtau, setup['U'], setup['MU'])
+    giw = gf.gt_fouriertrans(gtau, tau, w_n, g_tail)
+    fiw = gf.gt_fouriertrans(ftau, tau, w_n,
+                             ftau_tail(gtau, setup['U'], g_tail))
+    return fiw / giw
+
+
 def show_conv(beta, u_int, filestr='SB_{simt}_B{beta}', n_freq=5, xlim=2, skip=5, simt='PM'):
     """Plot the evolution of the Green's function in DMFT iterations"""
     freq_arr = []
@@ -295,44 +319,191 @@ def energies(beta, filestr='SB_PM_B{}.h5'):
     return np.array(epot), np.array(ekin), ur
 
 
-def autocorrelation_function(spins_log):
+def _column_blocks(spins_log, chunk=256):
+    """Yields the columns of the log as float arrays, a chunk at a time"""
+    columns = spins_log.reshape(spins_log.shape[0], -1)
+    for start in range(0, columns.shape[1], chunk):
+        block = np.asarray(columns[:, start:start + chunk], dtype=float)
+        if spins_log.dtype == np.dtype('bool'):
+            block = 2.0 * (block - 0.5)
+        yield block
+
+
+def _autocovariance_chunks(blocks):
+    """Yields the lag sums :math:`\\sum_t x_t x_{t+d}`, the means and the
+    variances of the columns of every block
+
+    Each column is zero padded and correlated by FFT in
+    :math:`O(M\\log M)`, only a block of columns of the log is in memory,
+    which allows memory mapped logs.
+    """
+    for block in blocks:
+        meas = block.shape[0]
+        nfft = 2 ** int(np.ceil(np.log2(2 * meas)))
+        fblock = np.fft.rfft(block, nfft, axis=0)
+        yield np.fft.irfft(np.abs(fblock)**2, nfft, axis=0)[:meas], \
+            block.mean(0), block.var(0)
+
+
+def autocorrelation_function(spins_log, chunk=256):
     """Calculates the autocorrelation function of the auxiliary Ising fields
 
+    The correlations of all time slices are averaged and normalized by the
+    global mean and variance.
+
     Parameters
     ----------
     spins_log : ndarray 1D or 2D
-        Monte Carlo time evolution of the auxiliary Ising field
+        Monte Carlo time evolution of the auxiliary Ising field, it can be
+        a memory mapped array
+    chunk : int
+        Number of time slices processed at once
 
     Returns
     -------
     ndarray
     """
-
-    if spins_log.dtype == np.dtype('bool'):
-        spins_log = 2.0 * (spins_log - 0.5)
     meas = spins_log.shape[0]
-    avg = spins_log.mean()
-    std = spins_log.std()
-    if len(spins_log.shape) > 1:
-        cor_dt = np.dot(spins_log, spins_log.T)
-        cor_dt /= spins_log.shape[1]
-    else:
-        cor_dt = np.outer(spins_log, spins_log)
+    lag_sum, total, sq_total, columns = 0., 0., 0., 0
+    for lags, mean, var in _autocovariance_chunks(
+            _column_blocks(spins_log, chunk)):
+        lag_sum += lags.sum(1)
+        total += mean.sum()
+        sq_total += (var + mean**2).sum()
+        columns += len(mean)
+
+    avg = total / columns
+    avs = lag_sum / columns / (meas - np.arange(meas))
+    return (avs - avg**2) / (sq_total / columns - avg**2)
+
+
+def integrated_autocorrelation_time(autocorrelation, c_window=5.):
+    r"""Integrated autocorrelation time with automatic windowing
+
+    .. math:: \tau_{int}(W) = \frac{1}{2} + \sum_{d=1}^W \rho(d)
+
+    The window is the smallest :math:`W \geq c\tau_{int}(W)`, following
+    Sokal. It balances the noise of the long lags against the bias of a
+    short window.
+
+    Parameters
+    ----------
+    autocorrelation : ndarray
+        Normalized autocorrelation function, the lags along the first axis
+    c_window : float
+
+    Returns
+    -------
+    tuple
+        integrated autocorrelation time, window
+    """
+    tau = 0.5 + np.cumsum(autocorrelation[1:], axis=0)
+    lags = np.arange(1, len(autocorrelation)).reshape(
+        (-1,) + (1,) * (autocorrelation.ndim - 1))
+    inside = lags < c_window * tau
+    window = np.where(inside.all(0), len(tau), np.argmin(inside, 0) + 1)
+    flat = tau.reshape(len(tau), -1)
+    return flat[window.ravel() - 1, np.arange(flat.shape[1])].reshape(
+        window.shape), window
 
-    avs = np.array([np.trace(cor_dt, i) for i in range(meas)])
-    avs /= meas - np.arange(meas)
 
-    return (avs - avg**2) / std**2
+def _ising_log_blocks(packed, fields, chunk=256):
+    """Yields the Ising fields signs of a bit packed log, a chunk of
+    fields at a time"""
+    chunk = 8 * max(1, chunk // 8)
+    for start in range(0, fields, chunk):
+        block = np.unpackbits(np.asarray(packed[:, start // 8:
+                                                (start + chunk) // 8]),
+                              axis=1)[:, :fields - start]
+        yield 2.0 * block - 1.
 
 
-def collect_bined_saves():
-    binede_dat = glob('gtau_bin_*')
-    G = np.array([np.load(dfile) for dfile in binede_dat])
-    gtau = G.mean(1)
-    tau, w_n = gf.tau_wn_setup(dict(BETA=32., N_MATSUBARA=32))
-    fw = gf.matsubara_freq(32., 64, -63)
+def ising_autocorrelation(work_dir, chain=0, chunk=256, c_window=5.):
+    """Integrated autocorrelation times of a log of the Ising fields
+
+    The bit packed log is memory mapped and analyzed by chunks of fields.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory of the simulation with the Ising fields logs
+    chain : int
+        Markov chain to analyze, see :func:`dmft.hirschfye.load_ising_log`
+    chunk : int
+        Number of fields processed at once
+    c_window : float
+        Window parameter, see :func:`integrated_autocorrelation_time`
+
+    Returns
+    -------
+    tuple
+        integrated autocorrelation time of every field and of the global
+        autocorrelation function
+    """
+    # The solver needs MPI and the compiled extension, not the plots
+    from dmft.hirschfye import load_ising_log
+
+    records, fields_shape = load_ising_log(work_dir, chain)
+    fields = int(np.prod(fields_shape))
+    meas = len(records)
+    norm = (meas - np.arange(meas))[:, None]
+
+    field_tau = []
+    lag_sum, total, sq_total = 0., 0., 0.
+    for lags, mean, var in _autocovariance_chunks(
+            _ising_log_blocks(records['v'], fields, chunk)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho = np.nan_to_num((lags / norm - mean**2) / var)
+        field_tau.append(integrated_autocorrelation_time(rho, c_window)[0])
+        lag_sum += lags.sum(1)
+        total += mean.sum()
+        sq_total += (var + mean**2).sum()
+
+    avg = total / fields
+    rho = (lag_sum / fields / norm[:, 0] - avg**2) / (sq_total / fields - avg**2)
+    global_tau, _ = integrated_autocorrelation_time(rho, c_window)
+    return np.concatenate(field_tau), global_tau
+
+
+def sigma_jackknife(sim_dir, iteration, setup=None):
+    r"""Self-energy and quasiparticle weight with their jackknife errors
+
+    Uses the binned :math:`G(\tau)` stored by the solver in
+    ``meas_errors.npz``, averaged over spin, and the self-consistency of
+    the Bethe lattice as in :func:`get_sigmaiw`. The quasiparticle weight
+    is estimated from the first Matsubara frequency
+
+    .. math:: Z = \left(1 - \frac{\Im\Sigma(i\omega_0)}{\omega_0}\right)^{-1}
+
+    Parameters
+    ----------
+    sim_dir : str
+        Simulation directory containing the setup file
+    iteration : str
+        Name of the iteration folder
+    setup : dict, optional
+        Simulation parameters, read from sim_dir if not given
+
+    Returns
+    -------
+    tuple : :math:`\Sigma(i\omega_n)`, its error, :math:`Z`, its error
+    """
+    if setup is None:
+        with open(sim_dir + '/setup', 'r') as read:
+            setup = json.load(read)
+    tau, w_n = gf.tau_wn_setup(setup)
+    with np.load(os.path.join(sim_dir, iteration, 'meas_errors.npz')) as data:
+        gtau_bins = data['gtau_bins'].mean(1)[:, 0, 0]
+        weights = data['bin_weights']
+
+    def sigma(gtau):
+        giw = gf.gt_fouriertrans(gtau, tau, w_n,
+                                 gf_tail(gtau, setup['U'], setup['MU']))
+        return 1j * w_n - setup.get('t', .5)**2 * giw - 1 / giw
 
-    giw = gf.gt_fouriertrans(gtau, tau, w_n, [1., 0., .25 + 2.5**2 / 4])
+    def quasiparticle_weight(gtau):
+        return 1 / (1 - sigma(gtau)[0].imag / w_n[0])
 
-    sgiw = np.concatenate((giw.conj().T[::-1], giw.T))
-    np.savez('bined', w_n=fw, giw=sgiw)
+    sigma_iw, sigma_err = jackknife(gtau_bins, sigma, weights)
+    zet, zet_err = jackknife(gtau_bins, quasiparticle_weight, weights)
+    return sigma_iw, sigma_err, zet, zet_err
@@ -77,6 +77,9 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
     for iter_count in range(last_loop, last_loop + setup['Niter']):
         work_dir = os.path.join(save_dir, 'it{:03}'.format(iter_count))
         setup['work_dir'] = work_dir
+        # Warm start the Markov chains from the previous iteration
+        setup['restart_dir'] = os.path.join(save_dir,
+                                            'it{:03}'.format(iter_count - 1))
 
         if not setup['AFM']:  # Paramagnetic averaging
             gtu = .5 * (gtu + gtd)
@@ -21,8 +21,8 @@ import dmft.plot.hf_single_site as pss
 COMM = MPI.COMM_WORLD
 
 
-def dmft_loop_pm(simulation, U, g_iw_start=None):
-    """Implementation of the solver"""
+def dmft_loop_pm(simulation, U, g_iw_start=None, comm=COMM):
+    """Implementation of the solver, on the processes of comm"""
     setup = {'t':           .5,
              'SITES':       1,
             }
@@ -40,7 +40,12 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
     if g_iw_start is not None:
         giw = g_iw_start
 
-    gtau = gf.gw_invfouriertrans(giw, tau, w_n, [1., 0., .25])
+    # G(tau) enters the self-consistency on the fine grid of the multigrid
+    tau_ft = tau
+    if setup.get('multigrid'):
+        tau_ft = np.arange(setup['multigrid']) * setup['BETA'] / setup['multigrid']
+
+    gtau = gf.gw_invfouriertrans(giw, tau_ft, w_n, [1., 0., .25])
     save_dir = os.path.join(setup['ofile'].format(**setup), current_u)
     try:
         with open(save_dir + '/setup', 'r') as conf:
@@ -52,21 +57,47 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
     except (IOError, OSError):
         last_loop = 0
 
+    if setup.get('max_sweeps'):
+        # Sweeps adapted to the convergence, stops once changes are noise
+        def paramagnetic(g_iw):
+            # enforce Half-fill, particle-hole symmetry
+            return np.broadcast_to(1j * g_iw.imag.mean(0), g_iw.shape)
+
+        def weiss(g_iw):
+            g_iw = np.reshape(g_iw, (-1, len(w_n)))
+            if setup['AFM']:
+                g_iw = g_iw[[1, 0]]
+            g0iw = 1/(1j*w_n + setup['MU'] - setup['t']**2 * g_iw)
+            g0tau = gf.gw_invfouriertrans(g0iw, tau, w_n, [1., 0., .25])
+            return list(g0tau) if setup['AFM'] else [g0tau[0]] * 2
+
+        giw, _ = hf.adaptive_dmft(
+            weiss, giw, w_n, v_aux, intm,
+            dict(setup, work_dir=os.path.join(save_dir, 'adaptive')),
+            (setup['sweeps'], setup['max_sweeps']), max_iter=setup['Niter'],
+            tail_coef=[1., 0., setup['t']**2 + U**2 / 4],
+            symmetry=None if setup['AFM'] else paramagnetic, comm=comm)
+        return np.squeeze(giw) if setup['AFM'] else giw[0, 0, 0]
+
     for iter_count in range(last_loop, last_loop + setup['Niter']):
         # For saving in the h5 file
         work_dir = os.path.join(save_dir, 'it{:03}'.format(iter_count))
         setup['work_dir'] = work_dir
+        # Warm start the Markov chains from the previous iteration
+        setup['restart_dir'] = os.path.join(save_dir,
+                                            'it{:03}'.format(iter_count - 1))
 
-        if COMM.rank == 0:
+        if comm.rank == 0:
             print('On loop', iter_count, 'beta', setup['BETA'], 'U', setup['U'])
 
-        giw = gf.gt_fouriertrans(gtau, tau, w_n,
+        giw = gf.gt_fouriertrans(gtau, tau_ft, w_n,
                                  pss.gf_tail(gtau, U, setup['MU']))
 
         if setup['AFM']:
             g0iw = 1/(1j*w_n + setup['MU'] - setup['t']**2 * giw[[1, 0]])
             g0tau = gf.gw_invfouriertrans(g0iw, tau, w_n, [1., 0., .25])
-            gtu, gtd = hf.imp_solver([g0tau[0], g0tau[1]], v_aux, intm, setup)
+            gtu, gtd = hf.imp_solver([g0tau[0], g0tau[1]], v_aux, intm, setup,
+                                     comm)
             gtau = np.squeeze([gtu, gtd])
 
         else:
@@ -75,17 +106,37 @@ def dmft_loop_pm(simulation, U, g_iw_start=None):
 
             g0iw = 1/(1j*w_n + setup['MU'] - setup['t']**2 * giw)
             g0tau = gf.gw_invfouriertrans(g0iw, tau, w_n, [1., 0., .25])
-            gtu, gtd = hf.imp_solver([g0tau]*2, v_aux, intm, setup)
+            gtu, gtd = hf.imp_solver([g0tau]*2, v_aux, intm, setup, comm)
             gtau = np.squeeze(0.5 * (gtu+gtd))
 
-
-        if COMM.rank == 0:
+        if setup.get('legendre'):
+            # Filter the noise of G(tau) through its Legendre coefficients
+            g_l = None
+            if comm.rank == 0:
+                g_l = np.load(os.path.join(work_dir, 'legendre.npz'))['gl']
+            g_l = np.squeeze(comm.bcast(g_l))
+            if not setup['AFM']:
+                g_l = g_l.mean(0)
+            gtau = gf.legendre_gtau(g_l, tau, setup['BETA'])
+
+        if setup.get('multigrid'):
+            _, gtau = hf.multigrid_gtau(gtau, g0iw, w_n, U, setup['multigrid'],
+                                        [1., 0., setup['t']**2 + U**2 / 4])
+
+        if comm.rank == 0:
             np.save(work_dir + '/gtau', gtau)
             with open(save_dir + '/setup', 'w') as conf:
                 setup['last_loop'] = iter_count
                 json.dump(setup, conf, indent=2)
         sys.stdout.flush()
 
+    if setup.get('trotter'):
+        blocks = list(g0iw) if setup['AFM'] else [g0iw] * 2
+        hf.trotter_extrapolation(
+            blocks, w_n, intm,
+            dict(setup, work_dir=os.path.join(save_dir, 'trotter')),
+            setup['trotter'], [1., 0., .25], comm)
+
     return giw
 
 
@@ -96,6 +147,19 @@ if __name__ == "__main__":
                        help='Use the self-consistency for Antiferromagnetism')
     SETUP = vars(SETUP.parse_args())
 
-    G_iw = None
-    for u in SETUP['urange']:
-        G_iw = dmft_loop_pm(SETUP, u, G_iw)
+    if SETUP['group_size']:
+        # Groups of processes solve the interactions, warm started from
+        # the nearest one solved
+        def solve(point, start, group):
+            return {'giw': dmft_loop_pm(SETUP, point['U'],
+                                        start and start['giw'], group)}
+
+        simt = 'AFM' if SETUP['AFM'] else 'PM'
+        hf.task_farm(solve, [{'U': u} for u in SETUP['urange']],
+                     SETUP['group_size'],
+                     os.path.join(SETUP['ofile'].format(simt=simt, **SETUP),
+                                  'farm'))
+    else:
+        G_iw = None
+        for u in SETUP['urange']:
+            G_iw = dmft_loop_pm(SETUP, u, G_iw)
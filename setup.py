@@ -34,7 +34,7 @@ setup(
                            include_dirs=[np.get_include()],
                            language="c++",
                            extra_compile_args=["-std=c++11"],
-                           libraries=['gsl', 'openblas']),
+                           libraries=['openblas']),
                  ],
     classifiers=[
         "Intended Audience :: Developers",
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+r"""
+Benchmarks of the Hirsch-Fye solver
+===================================
+
+Times the kernels of the Hirsch-Fye solver, :func:`dmft.hffast.updateDHS`,
+:func:`dmft.hffast.gnew`, :func:`dmft.hffast.g2flip`, the clean update in
+python :func:`dmft.hirschfye.gnewclean` and compiled
+:func:`dmft.hffast.gnewclean`, :func:`dmft.hirschfye.retarded_weiss`, the
+walker sweep and the whole :func:`dmft.hirschfye.imp_solver`, over a grid
+of time slices ``L``, ``SITES`` and interactions ``U``.
+
+Every case reports the median seconds per call, the proposed flips and
+sweeps per second where they apply and the peak of the memory allocated
+by numpy during one call. The results are written as json, and compared
+against a baseline json of a previous run, failing on the cases that
+became slower than the threshold allows.
+
+A fixed seed solver run of the single band half filled Hubbard model is
+checked against the reference Green function of the tests and, with a
+baseline, against the baseline results within their statistical errors,
+such that a speed up can not silently change the physics.
+
+Run it from the repository root, no MPI launcher is needed::
+
+    python tests/bench_hf.py -o bench.json
+    python tests/bench_hf.py -baseline bench.json
+
+It is not collected by pytest.
+"""
+
+from __future__ import division, absolute_import, print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import product
+import numpy as np
+import dmft
+import dmft.hffast as hffast
+import dmft.hirschfye as hf
+
+
+# Reference of test_solver at U=2, MU=0, half of it by symmetry
+GTAU_REF = np.array([-0.5, -0.335, -0.246, -0.196, -0.164, -0.144, -0.129,
+                     -0.118, -0.11, -0.104, -0.099, -0.095, -0.092, -0.09,
+                     -0.089, -0.087, -0.087])
+
+PHYSICS_PARAMS = {'BETA': 16., 'N_MATSUBARA': 16, 't': 0.5, 'BANDS': 1,
+                  'SITES': 1, 'U': 2., 'MU': 0., 'spin_polarization': 0.5,
+                  'sweeps': 3000, 'therm': 1000, 'meas': 3, 'SEED': 4213,
+                  'save_logs': False, 'global_flip': True}
+
+
+def setup_case(slices, sites, u_int, seed=4213):
+    """Retarded Weiss field of a cluster of ``sites`` with a small
+    hopping between them and its Ising fields"""
+    parms = dict(PHYSICS_PARAMS, N_MATSUBARA=slices // 2, SITES=sites,
+                 U=u_int, SEED=seed)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0blocks = np.array([[g0t if i == j else 0.2 * g0t
+                          for j in range(sites)] for i in range(sites)])
+    return parms, g0blocks, v, intm
+
+
+def timeit(call, repeat, min_time):
+    """Median seconds per call, every repetition calls enough times to
+    last ``min_time``"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        times.append((time.perf_counter() - start) / number)
+    return float(np.median(times))
+
+
+def peak_memory(call):
+    """Peak of the memory in MB traced while calling once"""
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2.**20
+
+
+def kernel_calls(slices, sites, u_int, delay, sweeps, seed):
+    """Benchmarked calls of one case and their proposed flips and sweeps
+    per call"""
+    parms, g0blocks, v, intm = setup_case(slices, sites, u_int, seed)
+    g0ttp = hf.retarded_weiss(g0blocks)
+    v0 = np.squeeze(v).copy()
+    N = v0.size
+    kroneker = np.eye(N)
+    gup = hffast.gnewclean(g0ttp, v0)
+    gdw = hffast.gnewclean(g0ttp, -v0)
+    state = {'v': v0.copy(), 'k': 0}
+    work = hffast.sweep_workspace(N, delay)
+    rng = hffast.rng_state(seed)
+
+    def dhs():
+        hffast.updateDHS(gup, gdw, state['v'], slices, 0., True, delay,
+                         work, rng)
+
+    def gnew():
+        k = state['k'] = (state['k'] + 1) % N
+        hffast.gnew(gup, -2 * state['v'][k], k)
+        state['v'][k] *= -1
+
+    def g2flip():
+        first = state['k'] = (state['k'] + 1) % N
+        k = (first + slices) % N if sites > 1 else (first + 1) % N
+        hffast.g2flip(gup, -2 * state['v'][[first, k]], first, k)
+        state['v'][[first, k]] *= -1
+
+    def walker_init():
+        walker = hffast.HFWalker([g0ttp] * 2, v.copy(), intm, slices, seed,
+                                 0., True, delay)
+        walker.clean()
+        return walker
+
+    walker = walker_init()
+
+    def solver():
+        work_dir = tempfile.mkdtemp(prefix='bench_hf')
+        sparms = dict(parms, sweeps=sweeps, therm=sweeps // 4, meas=1,
+                      global_flip=False, work_dir=work_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                hf.imp_solver([g0blocks] * 2, v.copy(), intm, sparms)
+        finally:
+            shutil.rmtree(work_dir)
+
+    return [('updateDHS', dhs, N, 1),
+            ('gnew', gnew, 1, 0),
+            ('g2flip', g2flip, 2, 0),
+            ('gnewclean', lambda: hf.gnewclean(g0ttp, v0, kroneker), 0, 0),
+            ('gnewclean_c', lambda: hffast.gnewclean(g0ttp, v0), 0, 0),
+            ('retarded_weiss', lambda: hf.retarded_weiss(g0blocks), 0, 0),
+            ('walker_init', walker_init, 0, 0),
+            ('walker_sweep', walker.sweep, N, 1),
+            ('imp_solver', solver, N * sweeps * 5 // 4, sweeps * 5 // 4)]
+
+
+def run_kernels(args):
+    """Times all kernels on the grid"""
+    results = []
+    for slices, sites, u_int in product(args.L, args.SITES, args.U):
+        for name, call, flips, sweeps in kernel_calls(
+                slices, sites, u_int, args.delay, args.sweeps, args.seed):
+            if args.kernels and name not in args.kernels:
+                continue
+            seconds = timeit(call, args.repeat, args.min_time)
+            case = {'kernel': name, 'L': slices, 'SITES': sites, 'U': u_int,
+                    'seconds': seconds, 'calls_per_s': 1 / seconds,
+                    'peak_mb': peak_memory(call)}
+            if flips:
+                case['flips_per_s'] = flips / seconds
+            if sweeps:
+                case['sweeps_per_s'] = sweeps / seconds
+            results.append(case)
+            print('{kernel:>15} L={L:<4} SITES={SITES} U={U:<4} '
+                  '{seconds:10.3e} s {peak_mb:8.2f} MB'.format(**case),
+                  '{:10.3e} flips/s'.format(case['flips_per_s'])
+                  if flips else '')
+    return results
+
+
+def physics_check():
+    """Fixed seed solver run of the half filled single band Hubbard model
+    after one DMFT step from the non interacting Green function"""
+    work_dir = tempfile.mkdtemp(prefix='bench_hf')
+    parms = dict(PHYSICS_PARAMS, work_dir=work_dir)
+    try:
+        tau, w_n, g0t, giw, v, intm = hf.setup_PM_sim(parms)
+        g0iw = 1 / (1j * w_n + parms['MU'] - .25 * giw)
+        g0t = hf.gw_invfouriertrans(g0iw, tau, w_n, [1., -parms['MU'], 0.])
+        with contextlib.redirect_stdout(io.StringIO()):
+            hf.imp_solver([g0t, g0t], v, intm, parms)
+        errors = np.load(os.path.join(work_dir, 'meas_errors.npz'))
+        gtau = errors['gtau'].mean(0).ravel()
+        gtau_err = errors['gtau_err'].mean(0).ravel()
+        double_occ = float(errors['double_occ'][0])
+        double_occ_err = float(errors['double_occ_err'][0])
+    finally:
+        shutil.rmtree(work_dir)
+
+    half = len(GTAU_REF)
+    return {'gtau': gtau.tolist(), 'gtau_err': gtau_err.tolist(),
+            'double_occ': double_occ, 'double_occ_err': double_occ_err,
+            'reference_deviation':
+            float(np.abs(gtau[:half] - GTAU_REF).max())}
+
+
+def compare(results, physics, baseline, threshold, sigmas):
+    """Lists the regressions against the baseline"""
+    failures = []
+    if physics is not None and physics['reference_deviation'] > 6e-3:
+        failures.append('physics: G(tau) deviates {:.2e} from the '
+                        'reference'.format(physics['reference_deviation']))
+    if baseline is None:
+        return failures
+
+    previous = {(case['kernel'], case['L'], case['SITES'], case['U']): case
+                for case in baseline['kernels']}
+    for case in results:
+        key = (case['kernel'], case['L'], case['SITES'], case['U'])
+        if key not in previous:
+            continue
+        ratio = case['seconds'] / previous[key]['seconds']
+        case['baseline_ratio'] = ratio
+        if ratio > 1 + threshold:
+            failures.append('{} L={} SITES={} U={}: {:.2f} times slower'
+                            .format(*(key + (ratio,))))
+
+    base = baseline.get('physics')
+    if physics is None or base is None:
+        return failures
+    for name in ['gtau', 'double_occ']:
+        diff = np.abs(np.subtract(physics[name], base[name]))
+        err = np.hypot(physics[name + '_err'], base[name + '_err'])
+        if np.any(diff > sigmas * err):
+            failures.append('physics: {} moved {:.1f} standard errors from '
+                            'the baseline'.format(name, np.max(diff / err)))
+    physics['identical'] = physics['gtau'] == base['gtau'] and \
+        physics['double_occ'] == base['double_occ']
+    return failures
+
+
+def machine():
+    """Description of the environment of the run"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with contextlib.redirect_stdout(io.StringIO()) as config:
+        np.show_config()
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': commit, 'dmft': dmft.__version__,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'numpy_config': config.getvalue(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'node': platform.node(),
+            'omp_threads': os.environ.get('OMP_NUM_THREADS')}
+
+
+def do_input():
+    """Command line of the benchmarks"""
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the Hirsch-Fye solver',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-L', type=int, nargs='+', default=[32, 64, 128],
+                        help='Time slices')
+    parser.add_argument('-SITES', type=int, nargs='+', default=[1, 2],
+                        help='Cluster sizes')
+    parser.add_argument('-U', type=float, nargs='+', default=[2., 5.],
+                        help='Local interactions')
+    parser.add_argument('-kernels', nargs='+',
+                        help='Benchmark only these kernels')
+    parser.add_argument('-delay', type=int, default=1,
+                        help='Delayed updates of the sweeps')
+    parser.add_argument('-sweeps', type=int, default=200,
+                        help='Measurement sweeps of the solver runs')
+    parser.add_argument('-seed', type=int, default=4213)
+    parser.add_argument('-repeat', type=int, default=5,
+                        help='Timings of every case, the median is kept')
+    parser.add_argument('-min_time', type=float, default=0.05,
+                        help='Shortest seconds of every timing')
+    parser.add_argument('-o', '--output', default='bench_hf.json',
+                        help='Json file of the results')
+    parser.add_argument('-baseline',
+                        help='Json results of a previous run to compare to')
+    parser.add_argument('-threshold', type=float, default=0.2,
+                        help='Tolerated fraction of slow down')
+    parser.add_argument('-sigmas', type=float, default=4.,
+                        help='Tolerated standard errors of the physics '
+                        'against the baseline')
+    parser.add_argument('-no_physics', action='store_true',
+                        help='Skip the fixed seed solver check')
+    return parser
+
+
+def main(argv=None):
+    args = do_input().parse_args(argv)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as bfile:
+            baseline = json.load(bfile)
+
+    results = run_kernels(args)
+    physics = None
+    if not args.no_physics:
+        physics = physics_check()
+        print('physics: double occupation {double_occ:.4f} +- '
+              '{double_occ_err:.4f}, largest deviation of G(tau) from the '
+              'reference {reference_deviation:.2e}'.format(**physics))
+    failures = compare(results, physics, baseline, args.threshold,
+                       args.sigmas)
+
+    report = {'machine': machine(), 'settings': vars(args),
+              'kernels': results, 'physics': physics,
+              'max_rss_mb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss / 1024.,
+              'failures': failures}
+    with open(args.output, 'w') as ofile:
+        json.dump(report, ofile, indent=2)
+
+    for failure in failures:
+        print('FAILED', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -100,3 +100,21 @@ def test_tail_fit_semicirc():
     moment = np.array((-1, 0, 0.25))
     print(fit_moments - moment)
     assert np.allclose(moment, fit_moments, atol=7e-3)
+
+
+@pytest.mark.parametrize("energy", [0., 0.7])
+def test_legendre_transforms(energy, beta=10.):
+    """The Legendre coefficients of a free fermion recover its imaginary
+    time and Matsubara Green functions"""
+    x, weights = np.polynomial.legendre.leggauss(80)
+    tau_q = beta * (x + 1) / 2
+    g_q = -np.exp(-energy * tau_q) / (1 + np.exp(-beta * energy))
+    g_l = np.sqrt(2 * np.arange(30) + 1) * beta / 2 * \
+        np.dot(weights * g_q, np.polynomial.legendre.legvander(x, 29))
+
+    tau = np.linspace(0, beta, 41)
+    assert np.allclose(gf.legendre_gtau(g_l, tau, beta),
+                       -np.exp(-energy * tau) / (1 + np.exp(-beta * energy)))
+    w_n = gf.matsubara_freq(beta, 64)
+    assert np.allclose(gf.legendre_giw(np.array([g_l, g_l]), w_n, beta),
+                       1 / (1j * w_n - energy))
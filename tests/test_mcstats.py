@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the Monte Carlo statistics tools
+"""
+
+from __future__ import division, absolute_import, print_function
+import numpy as np
+import pytest
+import dmft.mcstats as mcs
+
+
+def ar1_series(corr, size, seed=0):
+    """Gaussian autoregressive series of unit variance"""
+    rng = np.random.RandomState(seed)
+    noise = rng.normal(size=size) * np.sqrt(1 - corr**2)
+    series = np.empty(size)
+    series[0] = rng.normal()
+    for i in range(1, size):
+        series[i] = corr * series[i - 1] + noise[i]
+    return series
+
+
+@pytest.mark.parametrize("corr", [0., 0.8])
+def test_log_binning(corr):
+    """Binning recovers the error and autocorrelation time of a
+    correlated series"""
+    series = ar1_series(corr, 2**15)
+    binning = mcs.LogBinning(2)
+    for value in series:
+        binning.add([value, 2 * value])
+
+    assert np.allclose(binning.mean, [series.mean(), 2 * series.mean()])
+    tau = 0.5 * (1 + corr) / (1 - corr) - 0.5
+    assert np.allclose(binning.tau_int(), tau, atol=0.1 + 0.15 * tau)
+    error = np.sqrt((1 + 2 * tau) / series.size)
+    assert np.allclose(binning.error(), [error, 2 * error], rtol=0.2)
+
+    bins, weights = binning.jackknife_bins()
+    assert 32 <= len(bins) <= 64
+    assert np.allclose(np.average(bins, axis=0, weights=weights),
+                       binning.mean)
+
+
+def test_log_binning_complex():
+    """Complex measurements are binned by their real and imaginary parts"""
+    real, imag = ar1_series(0.8, 2**14), ar1_series(0., 2**14, seed=1)
+    binning = mcs.LogBinning(1, dtype=complex)
+    reference = [mcs.LogBinning(1), mcs.LogBinning(1)]
+    for re_value, im_value in zip(real, imag):
+        binning.add(re_value + 1j * im_value)
+        reference[0].add(re_value)
+        reference[1].add(im_value)
+
+    assert np.allclose(binning.mean, real.mean() + 1j * imag.mean())
+    assert np.allclose(binning.error(), reference[0].error() +
+                       1j * reference[1].error())
+    assert np.allclose(binning.tau_int(), reference[0].tau_int() +
+                       1j * reference[1].tau_int())
+
+
+def test_reduce_binnings():
+    """Independent chains pool their statistics"""
+    chains = [ar1_series(0.5, 4096, seed) for seed in range(3)]
+    binnings = [mcs.LogBinning(1) for _ in chains]
+    for binning, series in zip(binnings, chains):
+        for value in series:
+            binning.add(value)
+    stats = mcs.reduce_binnings(binnings)
+    assert np.allclose(stats['mean'], np.mean(chains))
+    assert np.allclose(stats['error'], np.sqrt(3. / len(chains) / 4096),
+                       rtol=0.2)
+    assert len(stats['bins']) == len(stats['bin_weights'])
+
+
+def test_jackknife():
+    """The jackknife of the average is the standard error and removes the
+    bias of non linear functions"""
+    rng = np.random.RandomState(1)
+    bins = rng.normal(2., 0.5, size=(50, 3))
+    estimate, error = mcs.jackknife(bins, lambda x: x)
+    assert np.allclose(estimate, bins.mean(0))
+    assert np.allclose(error, bins.std(0, ddof=1) / np.sqrt(50))
+
+    estimate, error = mcs.jackknife(bins[:, 0], lambda x: x**2)
+    assert np.allclose(estimate,
+                       bins[:, 0].mean()**2 - bins[:, 0].var(ddof=1) / 50)
+
+    estimate, error = mcs.jackknife(bins[:, 0], lambda x: np.exp(1j * x))
+    assert abs(estimate - np.exp(2j)) < 3 * abs(error)
+    assert error.real > 0 and error.imag > 0
@@ -8,12 +8,16 @@ Created on Tue Nov 25 12:44:23 2014
 from __future__ import division, absolute_import, print_function
 from itertools import product
 from random import randrange
+import json
 import os
 import numpy as np
 import scipy.linalg as la
+import h5py
 import pytest
+import dmft.common as gf
 import dmft.common_complex as cgf
 import dmft.hirschfye as hf
+import dmft.ipt_imag as ipt
 import dmft.plot.hf_single_site as phf
 import dmft.hffast as hffast
 
@@ -34,6 +38,37 @@ def test_autocorrelation_function():
     assert (np.max(autocorrelation[1:100]) < 0.15).all()
 
 
+def test_ising_autocorrelation(tmpdir):
+    """The FFT estimator matches the direct sum and the windowed
+    integrated autocorrelation time of a Markov chain of known time"""
+    rng = np.random.RandomState(2)
+    sample = rng.rand(300, 3) > 0.5
+    spins = 2. * (sample - 0.5)
+    avs = np.array([np.sum(spins[d:] * spins[:300 - d]) / (300 - d) / 3
+                    for d in range(300)])
+    reference = (avs - spins.mean()**2) / spins.var()
+    assert np.allclose(phf.autocorrelation_function(sample, chunk=2),
+                       reference)
+
+    flip = 0.1  # each field flips with this probability per measurement
+    spins_log = np.cumsum(rng.rand(2**14, 10) < flip, axis=0) % 2 == 0
+    log = hf.IsingLog(str(tmpdir.join('ising_log_r0.bin')), 10, 1000)
+    for mcs, spins in enumerate(spins_log):
+        log.append(mcs, 0, 2. * spins - 1)
+    log.close()
+    hf.save_log_index(str(tmpdir), [('ising_log_r0.bin', log.records)],
+                      (1, 10), 1)
+    records, shape = hf.load_ising_log(str(tmpdir))
+    assert np.array_equal(hf.unpack_ising(records['v'], 10), spins_log)
+    assert np.array_equal(records['mcs'], np.arange(2**14))
+
+    slice_tau, global_tau = phf.ising_autocorrelation(str(tmpdir), chunk=3)
+    tau = 0.5 * (2 - 2 * flip) / (2 * flip)
+    assert slice_tau.shape == (10,)
+    assert np.allclose(slice_tau, tau, rtol=0.2)
+    assert np.allclose(global_tau, tau, rtol=0.1)
+
+
 @pytest.mark.parametrize("chempot, u_int, updater",
                          product([0, 0.3], [2, 2.3], [hf.gnew, hffast.gnew]))
 def test_hf_fast_updatecond(chempot, u_int, updater):
@@ -126,6 +161,31 @@ def test_retardedweissfield_and_back(sites):
     assert np.allclose(g0t, col_g0t)
 
 
+@pytest.mark.parametrize("delay, double_flip_prob", product([1, 8], [0, 0.3]))
+def test_hf_complex_sweep(delay, double_flip_prob):
+    """The compiled complex kernels keep a complex Green function consistent
+    with the Ising fields"""
+    np.random.seed(5)
+    g0ttp = hf.retarded_weiss(generate_random_gf(16, 2))
+    assert g0ttp.dtype == np.complex128
+    v = np.squeeze(hf.ising_v(1., 2.3, g0ttp.shape[0]))
+    gup = hffast.gnewclean(g0ttp, v)
+    gdw = hffast.gnewclean(g0ttp, -v)
+    assert np.allclose(gup, hf.gnewclean(g0ttp, v, np.eye(v.size)))
+
+    acc, _ = hffast.updateDHS(gup, gdw, v, 16, double_flip_prob, True, delay,
+                              rng=hffast.rng_state(3))
+    assert acc > 0
+    assert np.allclose(gup, hffast.gnewclean(g0ttp, v))
+    assert np.allclose(gdw, hffast.gnewclean(g0ttp, -v))
+
+    gflip = np.copy(gup)
+    hffast.g2flip(gflip, -2 * v[[3, 20]], 3, 20)
+    hffast.gnew(gflip, -2 * v[7], 7)
+    v[[3, 20, 7]] *= -1
+    assert np.allclose(gflip, hffast.gnewclean(g0ttp, v))
+
+
 @pytest.mark.parametrize("chempot, u_int, updater",
                          product([0, 0.3], [2, 2.3], [hf.g2flip, hffast.g2flip]))
 def test_hf_fast_2flip(chempot, u_int, updater):
@@ -206,3 +266,745 @@ def test_solver_dimer(chempot, u_int, gend):
     assert np.allclose(np.zeros_like(g0t), g[0, 1], atol=6e-3)
     assert np.allclose(np.zeros_like(g0t), g[1, 0], atol=6e-3)
     assert np.allclose(gend, g[1, 1], atol=6e-3)
+
+
+def test_solver_complex_dimer():
+    """A gauge phase on the hopping of the dimer leaves the weights as they
+    are. The chains on the complex Weiss fields are those of the real ones
+    and their Green functions carry the phase"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=2, sweeps=1000,
+                 therm=200, legendre=8)
+    tau, w_n, _, Giw, v, intm = hf.setup_PM_sim(parms)
+    zeta = 1j * w_n - .25 * Giw
+    det = zeta**2 - 0.25
+    g0t = hf.gw_invfouriertrans(zeta / det, tau, w_n)
+    g0t_ab = hf.gw_invfouriertrans(0.5 / det, tau, w_n, [0., 0.5, 0.])
+    gb0t = np.array([[g0t, g0t_ab], [g0t_ab, g0t]])
+    gauge = np.exp(1j * np.array([0., 0.7])).reshape(2, 1, 1)
+    gb0t_z = gauge * gb0t * gauge.conj().swapaxes(0, 1)
+
+    results = []
+    for name, blocks in [('real', gb0t), ('complex', gb0t_z)]:
+        parms['work_dir'] = os.path.join(SOLVER_PARAMS['ofile'], name)
+        gtau = hf.imp_solver([blocks] * 2, np.copy(v), intm, parms)
+        results.append((np.array(gtau), np.load(os.path.join(
+            parms['work_dir'], 'occupation.npy'))))
+    (gtau, occupation), (gtau_z, occupation_z) = results
+
+    assert gtau_z.dtype == np.complex128
+    assert np.allclose(gtau_z, gauge * gtau * gauge.conj().swapaxes(0, 1))
+    assert np.allclose(occupation_z, occupation)
+    assert np.allclose(np.load(os.path.join(parms['work_dir'],
+                                            'average_sign.npy')), 1.)
+    with np.load(os.path.join(parms['work_dir'], 'meas_errors.npz')) as errs:
+        assert np.allclose(errs['gtau'], gtau_z)
+        assert np.allclose(errs['sign'], 1.)
+        assert np.all(errs['gtau_err'].real[:, 0, 1] > 0)
+        assert np.all(errs['gtau_err'].imag[:, 0, 1] > 0)
+
+    walker = hffast.HFWalker([hf.retarded_weiss(gb0t_z)] * 2, np.copy(v),
+                             intm, 2 * parms['N_MATSUBARA'])
+    with pytest.raises(ValueError):
+        hffast.HFWalker([hf.retarded_weiss(gb0t_z)] * 2, np.copy(v), intm,
+                        2 * parms['N_MATSUBARA'], single_precision=True)
+    walker.clean()
+    walker.sweep(3)
+    logdet, phase = walker.logdet, walker.weight_phase
+    assert np.allclose([logdet, phase.real], walker.log_weight(walker.v))
+    walker.clean()
+    assert np.allclose([logdet, phase], [walker.logdet, walker.weight_phase])
+
+
+def test_hf_walker_phase():
+    """A hopping phase that no gauge removes gives complex weights, every
+    measurement is accumulated times the phase of its configuration"""
+    parms = dict(UPDATE_PARAMS, U=2., MU=0., SITES=2)
+    tau, w_n, _, Giw, v, intm = hf.setup_PM_sim(parms)
+    zeta = 1j * w_n - .25 * Giw
+    det = zeta**2 - 0.25
+    g0t = hf.gw_invfouriertrans(zeta / det, tau, w_n)
+    g0t_ab = hf.gw_invfouriertrans(0.5 / det, tau, w_n, [0., 0.5, 0.])
+    g0t_ab = np.exp(0.7j) * g0t_ab
+    gx = hf.retarded_weiss(np.array([[g0t, g0t_ab], [g0t_ab, g0t]]))
+    walker = hffast.HFWalker([gx, gx], v, intm, 32, 4213)
+    walker.clean()
+    walker.sweep(5)
+    walker.measure()
+
+    phase = walker.weight_phase
+    assert abs(phase.imag) > 1e-3
+    assert np.allclose(abs(phase), 1.)
+    assert walker.sign_sum == phase.real
+    state = walker.state()
+    gup, gdw = state['g']
+    params = dict(SITES=2, N_MATSUBARA=16)
+    assert np.allclose(state['gtau'] / -32., phase *
+                       np.array([-hf.avg_g(gup, params),
+                                 -hf.avg_g(gdw, params)]))
+    assert np.allclose(state['occupation'], (phase * np.array(
+        [np.trace(gup[:32, :32]), np.trace(gup[32:, 32:]),
+         np.trace(gdw[:32, :32]), np.trace(gdw[32:, 32:])])).real)
+    measured = hf.measurement_vector(walker)
+    assert measured[-1] == walker.sign_sum
+
+
+@pytest.mark.parametrize("delay, double_flip_prob", product([2, 7, 32], [0, 0.3]))
+def test_hf_delayed_update(delay, double_flip_prob):
+    """Delayed block updates of the Green functions match the rank-1 sweep"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=2)
+    _, _, g0t, _, v, _ = hf.setup_PM_sim(parms)
+    v = np.squeeze(v)
+    g0ttp = hf.retarded_weiss(np.array([[g0t, 0.2 * g0t], [0.2 * g0t, g0t]]))
+    kroneker = np.eye(v.size)
+    gup = hf.gnewclean(g0ttp, v, kroneker)
+    gdw = hf.gnewclean(g0ttp, -v, kroneker)
+    g_ref, v_ref = [np.copy(gup), np.copy(gdw)], np.copy(v)
+
+    rng = hffast.rng_state(1234)
+    for _ in range(3):
+        hffast.updateDHS(g_ref[0], g_ref[1], v_ref, 32, double_flip_prob,
+                         rng=rng)
+    rng = hffast.rng_state(1234)
+    work = hffast.sweep_workspace(v.size, delay)
+    for _ in range(3):
+        hffast.updateDHS(gup, gdw, v, 32, double_flip_prob, True, delay,
+                         work, rng)
+
+    assert np.array_equal(v, v_ref)
+    assert np.allclose(gup, g_ref[0])
+    assert np.allclose(gdw, g_ref[1])
+    assert np.allclose(gup, hf.gnewclean(g0ttp, v, kroneker))
+
+
+@pytest.mark.parametrize("delay", [1, 16])
+def test_hf_walker_sweep(delay):
+    """The walker sweep reproduces the updateDHS kernel and its state"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=2)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(np.array([[g0t, 0.2 * g0t], [0.2 * g0t, g0t]]))
+    kroneker = np.eye(v.size)
+    gup = hf.gnewclean(g0ttp, v[0], kroneker)
+    gdw = hf.gnewclean(g0ttp, -v[0], kroneker)
+    v_ref = np.copy(v[0])
+
+    walker = hffast.HFWalker([g0ttp, g0ttp], v, intm, 32, 4213, 0.2,
+                             True, delay)
+    walker.clean()
+    state = walker.state()
+    assert np.shares_memory(walker.v, v)
+    assert np.allclose(state['g'], [gup, gdw])
+
+    rng = hffast.rng_state(4213)
+    for _ in range(3):
+        hffast.updateDHS(gup, gdw, v_ref, 32, 0.2, rng=rng)
+    walker.sweep(3)
+    walker.measure()
+
+    state = walker.state()
+    assert np.array_equal(v[0], v_ref)
+    assert np.array_equal(state['rng'], rng)
+    logdet, sign = walker.log_weight(walker.v)
+    assert np.allclose(walker.logdet, logdet)
+    assert walker.weight_sign == sign
+    assert np.allclose(state['g'], [gup, gdw])
+    params = dict(SITES=2, N_MATSUBARA=16)
+    assert np.allclose(state['gtau'] / -32.,
+                       [-hf.avg_g(gup, params), -hf.avg_g(gdw, params)])
+    assert np.allclose(state['occupation'],
+                       [np.trace(gup[:32, :32]), np.trace(gup[32:, 32:]),
+                        np.trace(gdw[:32, :32]), np.trace(gdw[32:, 32:])])
+    site_0, site_1 = slice(0, 32), slice(32, 64)
+    same_flavor = (np.trace(gup[site_0, site_0] * gup[site_1, site_1]) -
+                   np.trace(gup[site_0, site_1] * gup[site_1, site_0].T))
+    assert np.allclose(state['double_occ'][0], same_flavor)
+    assert np.allclose(state['double_occ'][1],
+                       np.trace(gup[site_0, site_0] * gdw[site_0, site_0]))
+    assert state['nmeas'] == 1
+
+
+def test_hf_local_susceptibility():
+    """The spin and charge correlators follow Wick's theorem on a
+    configuration and the equal time sum rules"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=1)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    walker = hffast.HFWalker([g0ttp, g0ttp], v, intm, 32, 4213)
+    walker.clean()
+    walker.sweep(3)
+    walker.measure()
+    occupation = walker.occupation / 32.
+    chi = hf.local_susceptibility(walker.density_corr, walker.exchange,
+                                  occupation, 1, parms['BETA'])
+
+    gup, gdw = walker.state()['g']
+    hole = [np.diag(gup), np.diag(gdw)]
+    spin = [-0.5, 0.5]
+    corr = sum(spin[i] * spin[j] * np.outer(hole[i], hole[j])
+               for i in range(2) for j in range(2))
+    dens = sum(np.outer(hole[i], hole[j]) for i in range(2) for j in range(2))
+    for g in (gup, gdw):
+        exch = g * g.T - np.diag(np.diag(g))
+        corr -= exch / 4
+        dens -= exch
+    lag = np.subtract.outer(np.arange(32), np.arange(32)) % 32
+    chi_s = np.bincount(lag.ravel(), corr.ravel()) / 32
+    chi_c = np.bincount(lag.ravel(), dens.ravel()) / 32 - occupation.sum()**2
+    assert np.allclose(chi['chi_spin'][0], chi_s)
+    assert np.allclose(chi['chi_charge'][0], chi_c)
+    assert np.allclose(chi['chi_spin_iw'][0, 0], parms['BETA'] * chi_s.mean())
+
+    n_up, n_dw = 1 - occupation
+    docc = walker.double_occ[0] / 32. - 1 + n_up + n_dw
+    assert np.allclose(chi['chi_spin'][0, 0], (n_up + n_dw - 2 * docc) / 4)
+    assert np.allclose(chi['chi_charge'][0, 0],
+                       n_up + n_dw + 2 * docc - (n_up + n_dw)**2)
+
+
+def test_hf_clean_drift():
+    """The clean update reports the drift of the fast updates and the
+    interval between them adapts to the tolerance"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=1)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    walker = hffast.HFWalker([g0ttp, g0ttp], v, intm, 32, 4213, delay=4)
+    walker.clean()
+    walker.sweep(20)
+    drift = walker.clean()
+    assert 0 < drift < 1e-8
+    assert walker.clean() < 1e-14
+
+    assert hf.clean_interval(1e-6, 100, 100, 1e-8, 5000) == 1
+    assert hf.clean_interval(0.25, 100, 1000, 2., 5000) == 400
+    assert hf.clean_interval(1e-13, 100, 100, 1e-8, 5000) == 200
+    assert hf.clean_interval(0., 4000, 4000, 1e-8, 5000) == 5000
+
+
+@pytest.mark.parametrize("delay", [1, 8])
+def test_hf_walker_single_precision(delay):
+    """Float32 sweeps follow the double precision chain of the same seed
+    and the clean update restores them from double precision"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=1)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    walkers = [hffast.HFWalker([g0ttp, g0ttp], np.copy(v), intm, 32, 4213,
+                               delay=delay, single_precision=single)
+               for single in (False, True)]
+    assert walkers[1].g.dtype == np.float32
+    assert walkers[1].g.nbytes == walkers[0].g.nbytes // 2
+    for walker in walkers:
+        walker.clean()
+        walker.sweep(4)
+    assert np.all(walkers[0].v == walkers[1].v)
+    assert np.allclose(walkers[0].g, walkers[1].g, atol=1e-4)
+    assert 1e-8 < walkers[1].clean() < 1e-4
+    assert np.allclose(walkers[0].clean(), 0, atol=1e-8)
+    assert np.allclose(walkers[0].g, walkers[1].g, atol=1e-6)
+
+    for walker in walkers:
+        walker.measure()
+    assert walkers[1].gtau.dtype == np.float64
+    assert np.allclose(walkers[0].gtau, walkers[1].gtau, atol=1e-5)
+
+
+@pytest.mark.parametrize("chempot, u_int, gend", SINGLE_BAND_GF_REF[:1])
+def test_solver_single_precision(chempot, u_int, gend):
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1,
+                 single_precision=True,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'single'))
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    g = np.squeeze(0.5 * (gtu + gtd))
+    assert np.allclose(gend, g, atol=6e-3)
+
+
+@pytest.mark.parametrize("bands, sign", [(2, 1), (3, -1)])
+def test_hf_walker_multiorbital(bands, sign):
+    """The compiled sweep over all fields of the interaction matrix keeps
+    the Green functions consistent with the fields"""
+    parms = dict(UPDATE_PARAMS, MU=0.2, U=2.5, SITES=1, BANDS=bands)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+    intm = sign * intm
+    assert v.shape == (bands * (2 * bands - 1), 32)
+    walker = hffast.HFWalker([g0ttp] * 2 * bands, v, intm, 32, 4213, 0.2,
+                             delay=4)
+    walker.clean()
+    acc, _ = walker.sweep(3)
+    assert acc > 0
+    g = walker.state()['g']
+    kroneker = np.eye(32)
+    for flavor, g_f in enumerate(g):
+        assert np.allclose(g_f, hf.gnewclean(g0ttp, np.dot(intm[flavor], v),
+                                             kroneker))
+
+
+@pytest.mark.parametrize("chempot, u_int, gend", SINGLE_BAND_GF_REF)
+def test_solver_walkers(chempot, u_int, gend):
+    """Chains on threads share the statistics of a rank"""
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1,
+                 sweeps=1500, walkers_per_rank=2, save_logs=True, log_every=4,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'walkers'))
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    g = np.squeeze(0.5 * (gtu + gtd))
+    assert np.allclose(gend, g, atol=6e-3)
+
+    with np.load(os.path.join(parms['work_dir'], 'meas_errors.npz')) as errs:
+        assert np.allclose(errs['gtau'], [gtu, gtd])
+        assert np.all(errs['gtau_err'] > 0) and np.all(errs['gtau_err'] < 2e-2)
+        assert np.all(errs['occupation_tau'] >= 0)
+        assert errs['gtau_bins'].shape[1:] == (2, 1, 1, 32)
+        assert np.allclose(np.average(errs['gtau_bins'], axis=0,
+                                      weights=errs['bin_weights']),
+                           errs['gtau'], atol=5e-3)
+
+    records, shape = hf.load_ising_log(parms['work_dir'], 1)
+    assert shape == v.shape
+    assert len(records) == (1500 - 1) // 4
+    assert np.all(np.diff(records['mcs']) == 4)
+
+
+def test_hf_walker_rng_streams():
+    """Walkers draw from reproducible, independent and restorable streams"""
+    parms = dict(UPDATE_PARAMS, MU=0., U=2.5, SITES=1, SEED=7)
+    _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    g0ttp = hf.retarded_weiss(g0t)
+
+    walkers = [hffast.HFWalker([g0ttp] * 2, np.copy(v), intm, 32, 11,
+                               rank=rank, stream=stream)
+               for rank, stream in [(0, 0), (0, 0), (0, 1), (1, 0)]]
+    for walker in walkers:
+        walker.clean()
+        walker.sweep(2)
+
+    assert np.array_equal(walkers[0].v, walkers[1].v)
+    assert not np.array_equal(walkers[0].v, walkers[2].v)
+    assert not np.array_equal(walkers[0].v, walkers[3].v)
+    assert not np.array_equal(walkers[2].state()['rng'],
+                              walkers[3].state()['rng'])
+
+    state = walkers[2].state()
+    walkers[2].sweep(3)
+    restart = hffast.HFWalker([g0ttp] * 2, state['v'], intm, 32, 0)
+    restart.set_rng_state(state['rng'])
+    restart.clean()
+    restart.sweep(3)
+    assert np.array_equal(restart.v, walkers[2].v)
+    assert np.array_equal(restart.state()['rng'], walkers[2].state()['rng'])
+
+
+def test_solver_warm_restart(tmpdir):
+    """Markov chains restart from the checkpoint of a previous run"""
+    chempot, u_int, gend = SINGLE_BAND_GF_REF[0]
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=chempot, SITES=1, sweeps=1500,
+                 checkpoint=True, work_dir=str(tmpdir.join('it000')))
+    tau, w_n, g0t, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n, [1., -parms['MU'], 0.])
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    with np.load(str(tmpdir.join('it000', 'checkpoint_r0.npz'))) as first:
+        assert np.array_equal(first['v'][0], v)
+        assert first['nmeas'][0] == parms['sweeps'] - 1
+
+    parms.update(work_dir=str(tmpdir.join('it001')), rethermalize=10,
+                 restart_dir=str(tmpdir.join('it000')),
+                 restart_accumulators=True)
+    gtu, gtd = hf.imp_solver([g0t, g0t], np.ones_like(v), intm, parms)
+    with np.load(str(tmpdir.join('it001', 'checkpoint_r0.npz'))) as second:
+        assert second['nmeas'][0] == 2 * (parms['sweeps'] - 1)
+    g = np.squeeze(0.5 * (gtu + gtd))
+    assert np.allclose(gend, g, atol=6e-3)
+
+
+def test_richardson():
+    """The extrapolation recovers a polynomial in the squared time step
+    and propagates the errors"""
+    dtau = np.array([0.5, 1 / 3, 0.25])
+    values = np.array([[1. + 2 * dt**2, -0.5 + dt**2 - 3 * dt**4]
+                       for dt in dtau])
+    errors = np.full_like(values, 1e-3)
+    extrapolated, err = hf.richardson(dtau, values, errors, order=2)
+    assert np.allclose(extrapolated, [1., -0.5])
+    assert np.all(err > 1e-3)
+
+    extrapolated, err = hf.richardson(dtau, values[:, 0], errors[:, 0])
+    assert np.allclose(extrapolated, 1.)
+    assert err < hf.richardson(dtau, values[:, 0], errors[:, 0], 2)[1]
+
+
+def test_trotter_extrapolation():
+    """The slicings run on their own seeds and their common times are
+    extrapolated"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, N_MATSUBARA=8,
+                 sweeps=1000, therm=200,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'trotter'))
+    tau, w_n, _, Giw, _, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n + parms['MU'] - .25 * Giw)
+    result = hf.trotter_extrapolation([G0iw, G0iw], w_n, intm, parms)
+
+    assert np.allclose(result['dtau'], [1., 2 / 3, 0.5])
+    assert np.allclose(result['tau'], np.arange(8) * 2.)
+    assert result['gtau'].shape == (2, 1, 1, 8)
+    assert result['gtau_slicings'].shape == (3, 2, 1, 1, 8)
+    assert np.allclose(result['gtau'][..., 0], -0.5, atol=0.03)
+    assert 0 < result['double_occ'][0] < 0.25
+    assert np.allclose(result['epot'], 2. * result['double_occ'].sum())
+    assert np.all(result['double_occ_err'] > 0)
+    for length in [16, 24, 32]:
+        assert os.path.exists(os.path.join(parms['work_dir'],
+                                           'L{}'.format(length),
+                                           'meas_errors.npz'))
+    assert os.path.exists(os.path.join(parms['work_dir'],
+                                       'trotter_extrapolation.npz'))
+
+
+def test_multigrid_gtau():
+    """The fine grid reconstruction from the reference model is closer to
+    the fine solution than the interpolation of the coarse points"""
+    parms = dict(UPDATE_PARAMS, BETA=16., N_MATSUBARA=256)
+    tau, w_n = hf.tau_wn_setup(parms)
+    g0iw = 1 / (1j * w_n - .25 * hf.greenF(w_n, D=1.))
+    coarse = np.arange(16) * 1.
+
+    target_iw, _ = ipt.single_band_ipt_solver(2.2, g0iw, w_n, tau)
+    target = hf.gw_invfouriertrans(target_iw, tau, w_n, [1., 0., 0.25 + 1.21])
+    qmc = target[::32]
+
+    fine_tau, fine = hf.multigrid_gtau(np.array([qmc, qmc]), g0iw, w_n, 2.,
+                                       512, [1., 0., 0.25 + 1.])
+    assert np.allclose(fine_tau, tau)
+    assert fine.shape == (2, 512)
+    assert np.allclose(fine[:, ::32], qmc, atol=1e-4)
+    linear = np.interp(tau, np.append(coarse, 16.),
+                       np.append(qmc, -1 - qmc[0]))
+    assert np.max(abs(fine[0] - target)) < 0.2 * np.max(abs(linear - target))
+
+
+def test_hf_walker_log_weight():
+    """The weights of crossed configurations of walkers at different
+    interactions are the determinants of the clean update matrices"""
+    parms = dict(UPDATE_PARAMS, MU=0., SITES=1, SEED=5)
+    walkers, spins = [], []
+    for u_int in [2., 2.5]:
+        _, _, g0t, _, v, intm = hf.setup_PM_sim(dict(parms, U=u_int))
+        walker = hffast.HFWalker([hf.retarded_weiss(g0t)] * 2, v, intm, 32)
+        walker.clean()
+        walkers.append(walker)
+        spins.append(np.sign(v))
+
+    for walker, own in zip(walkers, spins):
+        assert np.allclose(walker.log_weight(own), (walker.logdet, 1.))
+        for spin in spins:
+            fields = np.dot(intm, spin * abs(walker.v))
+            dets = [la.det(np.eye(32) - (np.exp(vf) - 1) *
+                           (walker.gx[f].T - np.eye(32)))
+                    for f, vf in enumerate(fields)]
+            assert np.allclose(walker.log_weight(spin),
+                               (np.log(abs(np.prod(dets))),
+                                np.sign(np.prod(dets))))
+
+    walker.v[:, 3] *= -1
+    g = walker.g.copy()
+    ratio = np.prod([1 + (1 - g[f, 3, 3]) * (np.exp(2 * v) - 1)
+                     for f, v in enumerate(np.dot(intm, walker.v[:, 3]))])
+    walker.clean()
+    assert np.allclose(np.exp(walker.logdet - walker.log_weight(spins[1])[0]),
+                       ratio)
+
+
+class FakeReplicas(object):
+    """Two replicas seen from ``rank``, the partner answers with its
+    ``spins``, its own and crossed log weights and its swap decision"""
+    size = 2
+
+    def __init__(self, rank, spins, weights, accept=None):
+        self.rank = rank
+        self.spins, self.weights, self.accept = spins, weights, accept
+        self.sent = []
+
+    def Sendrecv(self, sendbuf, dest, recvbuf, source):
+        self.sent.append(np.copy(sendbuf))
+        recvbuf[:] = self.spins
+
+    def sendrecv(self, sendobj, dest, source):
+        self.sent.append(sendobj)
+        return self.weights
+
+    def send(self, obj, dest):
+        self.sent.append(obj)
+
+    def recv(self, source):
+        return self.accept
+
+
+def test_tempering_swap():
+    """The swap of two walkers at different interactions weighs them by
+    the crossed weights, the accepted walkers keep their own field
+    magnitudes and their weights are those of the crossed configurations"""
+    walkers = []
+    for u_int in [2., 3.]:
+        parms = dict(UPDATE_PARAMS, U=u_int, MU=0., SITES=1)
+        _, _, g0t, _, v, intm = hf.setup_PM_sim(parms)
+        g0ttp = hf.retarded_weiss(g0t)
+        walker = hffast.HFWalker([g0ttp, g0ttp], v, intm, 32,
+                                 4213 + int(u_int))
+        walker.clean()
+        walker.sweep(20)
+        walker.clean()
+        walkers.append(walker)
+    low, high = walkers
+    spins = [np.sign(walker.v) for walker in walkers]
+    fields = [walker.v.copy() for walker in walkers]
+    cross = [low.log_weight(spins[1]), high.log_weight(spins[0])]
+    log_ratio = cross[0][0] + cross[1][0] - low.logdet - high.logdet
+    assert not np.allclose(abs(low.v), abs(high.v))
+
+    # the lower rank draws the decision from the four weights
+    rng = low.state()['rng']
+    replicas = FakeReplicas(0, spins[1], (high.logdet, cross[1][0]))
+    assert hf.tempering_swap(low, replicas, 0)[0] == 1
+    sent_spins, sent_weights, accept = replicas.sent
+    assert np.array_equal(sent_spins, spins[0])
+    assert np.allclose(sent_weights, (low.logdet, cross[0][0]))
+    low.v[:] = fields[0]
+    low.set_rng_state(rng)
+    assert accept == (low.uniform() < np.exp(min(log_ratio, 0.)))
+
+    # the accepted swap as seen from the higher rank of each walker
+    for own, walker, other in [(0, low, 1), (1, high, 0)]:
+        weights = (walkers[other].logdet, cross[other][0])
+        replicas = FakeReplicas(1, spins[other], weights, accept=True)
+        assert np.array_equal(hf.tempering_swap(walker, replicas, 0), [1, 1])
+        assert np.allclose(replicas.sent[1], (walker.logdet, cross[own][0]))
+        assert np.array_equal(walker.v, spins[other] * abs(fields[own]))
+    for own, walker in enumerate(walkers):
+        walker.clean()
+        assert np.allclose((walker.logdet, walker.weight_sign), cross[own])
+
+
+def test_tempering_solver():
+    """A single replica runs as the plain solver without swaps"""
+    parms = dict(SOLVER_PARAMS, MU=0., SITES=1, sweeps=300, therm=100,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'tempering'))
+    tau, w_n, g0t, _, v, intm = hf.setup_PM_sim(dict(parms, U=2.))
+    gtau_u = hf.tempering_solver([[g0t, g0t]], [v], intm, parms, [2.])
+    assert len(gtau_u) == 1 and np.shape(gtau_u[0]) == (2, 1, 1, 32)
+    assert np.load(os.path.join(parms['work_dir'], 'U2.0',
+                                'swap_acceptance.npy')) == 0
+
+    with pytest.raises(ValueError):
+        hf.tempering_solver([[g0t, g0t]] * 2, [v] * 2, intm, parms,
+                            [2., 2.5, 3.])
+
+
+def test_reweight():
+    """Reweighting to the parameters of the run is the plain average of the
+    logged configurations, moving to a larger interaction lowers the double
+    occupation"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, sweeps=1000, therm=200,
+                 save_logs=True, save_weights=True, log_every=4,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'reweight'))
+    tau, w_n, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    records, _ = hf.load_ising_log(parms['work_dir'])
+    assert np.all(records['sign'] == 1)
+
+    same = hf.reweight(parms['work_dir'], [g0t, g0t], abs(v[0, 0]), intm)
+    assert np.allclose(same['ess'], len(records))
+    assert np.allclose(same['max_weight'], 1. / len(records))
+    assert same['gtau'].shape == (2, 1, 1, 32)
+    assert np.allclose(same['gtau'][..., 0], -0.5, atol=0.05)
+
+    stronger = hf.reweight(parms['work_dir'], [g0t, g0t],
+                           np.arccosh(np.exp(tau[1] * 2.2 / 2)), intm)
+    assert 0.1 < stronger['ess_fraction'] < 1.
+    assert stronger['double_occ'][0] < same['double_occ'][0]
+
+    parms['save_weights'] = False
+    parms['work_dir'] += '_noweights'
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+    with pytest.raises(ValueError):
+        hf.reweight(parms['work_dir'], [g0t, g0t], abs(v[0, 0]), intm)
+
+
+def test_improved_sigma():
+    """The improved estimator agrees with the Dyson equation at low
+    frequencies and follows the atomic tail without its noise. Decoupled
+    dimer sites have the local self-energy"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, N_MATSUBARA=32,
+                 sweeps=2000, therm=300,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'improved'))
+    tau, w_n, _, Giw, v, intm = hf.setup_PM_sim(parms)
+    G0iw = 1 / (1j * w_n - .25 * Giw)
+    g0t = hf.gw_invfouriertrans(G0iw, tau, w_n)
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    ftau = np.load(os.path.join(parms['work_dir'], 'ftau.npy'))
+    assert ftau.shape == (2, 1, 1, 64)
+
+    gtau = 0.5 * (gtu + gtd)
+    g_tail = phf.gf_tail(np.squeeze(gtau), 2., 0.)
+    f_tail = phf.ftau_tail(np.squeeze(gtau), 2., g_tail)
+    sigma = hf.improved_sigma(gtau, ftau.mean(0), tau, w_n, g_tail,
+                              f_tail)[0, 0]
+    dyson = 1 / G0iw - 1 / hf.gt_fouriertrans(np.squeeze(gtau), tau, w_n,
+                                             g_tail)
+    assert np.allclose(sigma[:4], dyson[:4], atol=0.03)
+    tail = sigma.imag[16:] * w_n[16:]
+    assert np.allclose(tail, -1., atol=0.05)
+    assert np.std(tail) < np.std(dyson.imag[16:] * w_n[16:])
+
+    parms.update(SITES=2,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'improved2'))
+    tau, w_n, _, _, v, intm = hf.setup_PM_sim(parms)
+    zero = np.zeros_like(g0t)
+    gb0t = np.array([[g0t, zero], [zero, g0t]])
+    gtu, gtd = hf.imp_solver([gb0t] * 2, v, intm, parms)
+    ftau = np.load(os.path.join(parms['work_dir'], 'ftau.npy'))
+    assert ftau.shape == (2, 2, 2, 64)
+    eye = np.eye(2).reshape(2, 2, 1)
+    sigma = hf.improved_sigma(0.5 * (gtu + gtd), ftau.mean(0), tau, w_n,
+                              [eye * c for c in g_tail],
+                              [eye * c for c in f_tail])
+    for site in range(2):
+        assert np.allclose(sigma[site, site, :4], dyson[:4], atol=0.1)
+        assert np.allclose(sigma[site, site, 16:].imag * w_n[16:], -1.,
+                           atol=0.1)
+    assert np.allclose(sigma[0, 1], 0.)
+
+
+def test_legendre_accumulation():
+    """The binned Legendre coefficients reproduce the accumulated
+    :math:`G(\\tau)` and decay for the smooth Green function. At half
+    filling the odd ones cancel in the spin average"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, sweeps=1000, therm=200,
+                 legendre=16,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'legendre'))
+    tau, w_n, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    legendre = np.load(os.path.join(parms['work_dir'], 'legendre.npz'))
+    assert legendre['gl'].shape == (2, 1, 1, 16)
+    assert np.all(legendre['gl_err'] > 0)
+
+    gl_tau = gf.legendre_gtau(legendre['gl'], tau, parms['BETA'])
+    assert np.allclose(gl_tau[:, 0, 0], [gtu[0, 0], gtd[0, 0]], atol=0.02)
+    assert np.allclose(legendre['gl'][..., 1::2].sum(0), 0, atol=0.01)
+    assert np.abs(legendre['gl'][..., -2]).max() < \
+        np.abs(legendre['gl'][..., 0]).min() / 10
+
+
+@pytest.mark.parametrize("u_int", [0., 2.])
+def test_vertex_measurement(u_int):
+    """Without interaction the generalized susceptibility is the bubble
+    :math:`-\\beta G(i\\omega)G(i\\omega+i\\nu)`, with it the spin
+    fluctuations of the local moment enhance its magnetic channel"""
+    parms = dict(SOLVER_PARAMS, U=u_int, MU=0., SITES=1, sweeps=400,
+                 therm=100, vertex=[4, 3], vertex_every=2,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'],
+                                       'vertex{}'.format(u_int)))
+    tau, w_n, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    hf.imp_solver([g0t, g0t], v, intm, parms)
+
+    with h5py.File(os.path.join(parms['work_dir'], 'vertex.h5'), 'r') as vx:
+        assert vx['chi'].shape == (2, 2, 1, 3, 8, 8)
+        assert vx['chi'].chunks == (1, 1, 1, 1, 8, 8)
+        chi = vx['chi'][:, :, 0]
+        giw = vx['giw'][:, 0]
+        assert np.allclose(vx['fermionic'][4:6], w_n[:2])
+
+    bubble = -parms['BETA'] * np.array(
+        [[giw[f, :8] * giw[f, nu:nu + 8] for nu in range(3)]
+         for f in range(2)])
+    chi_m = chi[0, 0] - chi[0, 1]
+    if u_int == 0.:
+        assert np.allclose(chi[0, 1], 0, atol=1e-12)
+        assert np.allclose(chi[[0, 1], [0, 1]],
+                           bubble[..., None] * np.eye(8))
+    else:
+        assert np.abs(chi[0, 1, 0]).max() > 1
+        assert chi_m[0].real.sum() > 2 * bubble[0, 0].real.sum()
+    # the static susceptibility is invariant under w -> -w conjugated
+    assert np.allclose(chi_m[0], chi_m[0, ::-1, ::-1].conj(),
+                       atol=0.1 * np.abs(chi_m[0]).max())
+
+
+def test_adaptive_dmft():
+    """The sweeps grow as the changes of the Bethe lattice loop reach the
+    noise, and the loop stops at the largest sweeps"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, therm=200,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'adaptive'))
+    tau, w_n, _, giw, v, intm = hf.setup_PM_sim(parms)
+
+    def weiss(g_iw):
+        g0iw = 1 / (1j * w_n - .25 * np.reshape(g_iw, (-1, len(w_n)))[0])
+        return [hf.gw_invfouriertrans(g0iw, tau, w_n)] * 2
+
+    def paramagnetic(g_iw):
+        return np.broadcast_to(g_iw.mean(0), g_iw.shape)
+
+    giw, schedule = hf.adaptive_dmft(weiss, giw, w_n, v, intm, parms,
+                                     (100, 400), max_iter=12,
+                                     symmetry=paramagnetic)
+    sweeps = [step['sweeps'] for step in schedule]
+    assert sweeps[0] == 100 and np.all(np.diff(sweeps) >= 0)
+    assert schedule[-1]['converged'] and sweeps[-1] == 400
+    assert schedule[-1]['chi2'] < 2.
+    assert giw.shape == (2, 1, 1, len(w_n))
+    assert np.allclose(giw[0], giw[1])
+    assert np.allclose(giw[0, 0, 0, :4].real, 0, atol=0.02)
+
+    with open(os.path.join(parms['work_dir'], 'dmft_schedule.json')) as rec:
+        assert json.load(rec) == schedule
+
+
+def test_task_farm(tmpdir):
+    """The points are solved in groups, warm started from the nearest
+    one solved by the farm and gathered into one store"""
+    points = [{'U': 1., 'BETA': 10.}, {'U': 3., 'BETA': 10.},
+              {'U': 2.6, 'BETA': 12.}]
+    # Left by an earlier run, it must not warm start any point
+    np.savez(str(tmpdir.join('point002.npz')), gtau=np.full(4, -1.))
+
+    def solve(point, start, group):
+        assert group.size == 1
+        return {'gtau': np.full(4, point['U']),
+                'start': start['gtau'][0] if start else np.nan}
+
+    results = hf.task_farm(solve, points, work_dir=str(tmpdir))
+    assert np.isnan(results[0]['start'])
+    assert results[1]['start'] == 1.
+    assert results[2]['start'] == 3.
+
+    with h5py.File(str(tmpdir.join('farm.h5')), 'r') as store:
+        assert list(store) == ['point000', 'point001', 'point002']
+        assert store['point002'].attrs['BETA'] == 12.
+        assert np.allclose(store['point002/gtau'], 2.6)
+
+
+def test_autotune():
+    """The chain tries update settings in its thermalization, keeps the
+    best scored one and measures with it as without tuning"""
+    parms = dict(SOLVER_PARAMS, U=2., MU=0., SITES=1, sweeps=1000, therm=200,
+                 autotune=40,
+                 work_dir=os.path.join(SOLVER_PARAMS['ofile'], 'autotune'))
+    tau, w_n, g0t, _, v, intm = hf.setup_PM_sim(parms)
+    gtu, gtd = hf.imp_solver([g0t, g0t], v, intm, parms)
+    with open(os.path.join(parms['work_dir'], 'autotune.json')) as record:
+        tuning, = json.load(record)
+    trials = tuning['trials']
+    assert len(trials) >= 3
+    best = max(trials, key=lambda trial: trial['rate'])
+    assert all(tuning['settings'][key] == best[key]
+               for key in tuning['settings'])
+    assert all(0 < trial['acceptance'] < 1 for trial in trials)
+    assert all(trial['sign'] == 1 for trial in trials)
+    assert all(trial['global_flip'] % parms['meas'] == 0 for trial in trials)
+
+    occupation = np.load(os.path.join(parms['work_dir'], 'occupation.npy'))
+    assert np.allclose(occupation.sum(), 1., atol=0.05)
+    assert np.allclose(gtu[0, 0, 0] + gtd[0, 0, 0], -1, atol=0.05)
+    assert 0 < np.load(os.path.join(parms['work_dir'],
+                                    'acceptance.npy')) < 1